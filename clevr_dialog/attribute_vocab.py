@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Bitmask encoding of CLEVR object attributes.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+
+# Attribute values in CLEVR, each assigned a fixed bit.
+CLEVR_ATTRIBUTES = {
+    "shape": ("cube", "sphere", "cylinder"),
+    "size": ("large", "small"),
+    "material": ("rubber", "metal"),
+    "color": (
+        "gray",
+        "red",
+        "blue",
+        "green",
+        "brown",
+        "purple",
+        "cyan",
+        "yellow",
+    ),
+}
+# Masks are stored as uint64 in the compatibility index.
+MAX_ATTRIBUTES = 64
+
+ATTRIBUTE_VOCAB = [value for values in CLEVR_ATTRIBUTES.values() for value in values]
+ATTRIBUTE_BITS = {value: index for index, value in enumerate(ATTRIBUTE_VOCAB)}
+
+
+def get_attribute_bit(value):
+    """Bit position for an attribute value, extending the vocabulary if unseen.
+
+    Args:
+        value: Attribute value, e.g., "red"
+
+    Returns:
+        bit: Position of the bit for the value
+    """
+    bit = ATTRIBUTE_BITS.get(value, None)
+    if bit is None:
+        bit = len(ATTRIBUTE_VOCAB)
+        if bit >= MAX_ATTRIBUTES:
+            raise ValueError("Too many attribute values: {}!".format(value))
+        ATTRIBUTE_VOCAB.append(value)
+        ATTRIBUTE_BITS[value] = bit
+    return bit
+
+
+def encode_attributes(attributes):
+    """Encodes a set of attribute values as an integer bitmask.
+
+    Args:
+        attributes: Iterable of attribute values
+
+    Returns:
+        mask: Integer with one bit set per attribute value
+    """
+    mask = 0
+    for value in attributes:
+        mask |= 1 << get_attribute_bit(value)
+    return mask
+
+
+def decode_attributes(mask):
+    """Decodes an integer bitmask back into a set of attribute values.
+
+    Args:
+        mask: Integer bitmask from encode_attributes
+
+    Returns:
+        attributes: Set of attribute values
+    """
+    return set(
+        value for bit, value in enumerate(ATTRIBUTE_VOCAB) if mask & (1 << bit)
+    )
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,435 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Benchmarks the stages of stitching on synthetic CLEVR-Dialog data.
+
+Measures the throughput and peak memory of reading, segmentation, checking
+mergeability, sampling, merging and saving, and of the end-to-end
+generate_dataset for several numbers of workers. Results are saved as JSON.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import collections
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import merge_dialogs
+from dataset_writer import DatasetWriter
+from dialog import Dialog
+from json_stream import iter_json_array
+from kway_stitching import plan_batch
+from synthetic_data import save_synthetic_data
+from triple_sampler import SAMPLERS
+
+
+# Version of the results format.
+BENCHMARK_VERSION = 2
+# Interval between samples of the memory of generate_dataset.
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def measure(function, num_items, track_memory=True):
+    """Runs a stage, timed and (separately) with its memory tracked.
+
+    Args:
+        function: Stage to run, without arguments
+        num_items: Number of items processed by the stage, for throughput
+        track_memory: Run the stage a second time to track its peak memory
+            (tracing slows down execution, so is not done while timing)
+
+    Returns:
+        result: Statistics of the stage
+    """
+    gc.collect()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    function()
+    wall_time = time.perf_counter() - start_wall
+    cpu_time = time.process_time() - start_cpu
+    result = {
+        "num_items": num_items,
+        "wall_seconds": wall_time,
+        "cpu_seconds": cpu_time,
+        "items_per_second": num_items / max(wall_time, 1e-9),
+    }
+    if track_memory:
+        gc.collect()
+        tracemalloc.start()
+        function()
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+def check_samplers(train_json, num_samples, max_deviations=5):
+    """Checks that the triple samplers draw from the same triples.
+
+    The rejection sampler measures the acceptance rate that the signature
+    sampler estimates from its compatibility counts, over the same dialogs
+    (with a context recaller); these agree, within sampling error, only if
+    both samplers are uniform over the same triples.
+
+    Args:
+        train_json: Path to the (synthetic) CLEVR-Dialog file, with dialogs
+            with and without a context recaller
+        num_samples: Number of triples sampled by each sampler
+        max_deviations: Standard errors the rates can differ by
+
+    Returns:
+        result: Acceptance rate of each sampler, and their standard error
+    """
+    dialogs = []
+    for image in iter_json_array(train_json):
+        for dialog_index in range(len(image["dialogs"])):
+            dialogs.append(Dialog(image, dialog_index))
+            dialogs[-1].segment_dialog(keep_graphs=False)
+    rates = {}
+    variances = {}
+    for name, sampler_class in sorted(SAMPLERS.items()):
+        triple_sampler = sampler_class(dialogs)
+        for _ in range(num_samples):
+            triple_sampler.sample()
+        rates[name] = float(triple_sampler.get_acceptance_rate())
+        # Binomial error of the draws accepted, scaled to the acceptance rate.
+        accepted = triple_sampler.num_accepted / triple_sampler.num_sampled
+        scale = rates[name] / accepted
+        variances[name] = (
+            scale ** 2 * accepted * (1 - accepted) / triple_sampler.num_sampled
+        )
+    error = float(sum(variances.values()) ** 0.5)
+    if abs(rates["rejection"] - rates["signature"]) > max_deviations * error:
+        raise ValueError(
+            "Samplers disagree: acceptance rate {:.4f} (rejection), {:.4f} "
+            "(signature)!".format(rates["rejection"], rates["signature"])
+        )
+    return {"acceptance_rates": rates, "standard_error": error}
+
+
+def benchmark_stages(train_json, num_samples, sampler, track_memory=True):
+    """Benchmarks each stage of stitching in this process.
+
+    Args:
+        train_json: Path to the (synthetic) CLEVR-Dialog file
+        num_samples: Number of triples checked, sampled, merged and saved
+        sampler: Name of the triple sampler (see triple_sampler.SAMPLERS)
+        track_memory: Track the peak memory of each stage
+
+    Returns:
+        results: Statistics of each stage
+    """
+    results = {}
+    images = list(iter_json_array(train_json))
+    num_dialogs = sum(len(ii["dialogs"]) for ii in images)
+    results["load"] = measure(
+        lambda: list(iter_json_array(train_json)), len(images), track_memory
+    )
+
+    def segment():
+        dialogs = [Dialog(ii, jj) for ii in images for jj in range(len(ii["dialogs"]))]
+        for ii in dialogs:
+            ii.segment_dialog(keep_graphs=False)
+        return dialogs
+
+    results["segment_dialog"] = measure(segment, num_dialogs, track_memory)
+    dialogs = [ii for ii in segment() if ii.context_recaller]
+    del images
+
+    random.seed(0)
+    triples = [random.sample(dialogs, 3) for _ in range(num_samples)]
+    results["check_mergeability"] = measure(
+        lambda: [Dialog.check_mergeability(*ii) for ii in triples],
+        num_samples,
+        track_memory,
+    )
+
+    triple_sampler = SAMPLERS[sampler](dialogs)
+    results["sample"] = measure(
+        lambda: [triple_sampler.sample() for _ in range(num_samples)],
+        num_samples,
+        track_memory,
+    )
+    results["sample"]["acceptance_rate"] = triple_sampler.get_acceptance_rate()
+
+    triples = [triple_sampler.sample() for _ in range(num_samples)]
+    results["merge_two_dialogs"] = measure(
+        lambda: [Dialog.merge_two_dialogs(*ii[:2]) for ii in triples],
+        num_samples,
+        track_memory,
+    )
+    results["merge_three_dialogs"] = measure(
+        lambda: [Dialog.merge_three_dialogs(*ii) for ii in triples],
+        num_samples,
+        track_memory,
+    )
+    results["plan_batch"] = measure(
+        lambda: plan_batch(triples), num_samples, track_memory
+    )
+    # Planning does not depend on compatibility, any 8 dialogs will do.
+    tuples = [random.sample(dialogs, 8) for _ in range(num_samples)]
+    results["plan_batch_8"] = measure(
+        lambda: plan_batch(tuples), num_samples, track_memory
+    )
+
+    merged = [Dialog.merge_dialogs(*ii) for ii in triples]
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as save_root:
+
+        def save():
+            with DatasetWriter(save_root, "benchmark") as writer:
+                for ii in merged:
+                    writer.write(ii)
+
+        results["save"] = measure(save, num_samples, track_memory)
+        file_size = os.path.getsize(
+            os.path.join(save_root, "deep_clevr_dialog_benchmark.json")
+        )
+        results["save"]["mb_per_second"] = (
+            file_size / 2 ** 20 / max(results["save"]["wall_seconds"], 1e-9)
+        )
+    return results
+
+
+def get_tree_rss(pid):
+    """Resident memory (in bytes) of a process and its descendants.
+
+    Read from /proc, so only available on Linux (None otherwise).
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    children = collections.defaultdict(list)
+    rss = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry), "r") as file_id:
+                # Fields after the command name, from the state (3rd) on.
+                fields = file_id.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry))
+        rss[int(entry)] = int(fields[21]) * page_size
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        total += rss.get(current, 0)
+        pending.extend(children[current])
+    return total
+
+
+def run_generate_dataset(args, output_queue):
+    # Runs in a fresh process, so that its resource usage is its own.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.dup2(devnull, sys.stderr.fileno())
+    start_wall = time.perf_counter()
+    merge_dialogs.generate_dataset(args)
+    wall_time = time.perf_counter() - start_wall
+    usage = [
+        resource.getrusage(ii)
+        for ii in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    ]
+    output_queue.put(
+        {
+            "wall_seconds": wall_time,
+            "cpu_seconds": sum(ii.ru_utime + ii.ru_stime for ii in usage),
+            # Kilobytes on Linux.
+            "peak_rss_mb": usage[0].ru_maxrss / 1024,
+        }
+    )
+
+
+def benchmark_generate_dataset(train_json, val_json, worker_counts, sampler):
+    """Benchmarks merge_dialogs.generate_dataset end to end.
+
+    Args:
+        train_json, val_json: Paths to the (synthetic) CLEVR-Dialog files
+        worker_counts: Numbers of workers to benchmark with
+        sampler: Name of the triple sampler (see triple_sampler.SAMPLERS)
+
+    Returns:
+        results: Statistics of each run
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for num_workers in worker_counts:
+        with tempfile.TemporaryDirectory(prefix="benchmark_") as save_root:
+            args = {
+                "clevr_train_json": train_json,
+                "clevr_val_json": val_json,
+                "save_root": save_root,
+                "num_workers": num_workers,
+                "sampler": sampler,
+                "cache_root": None,
+                "output_format": "json",
+                "num_shards": 1,
+                "compress": False,
+            }
+            output_queue = context.Queue()
+            process = context.Process(
+                target=run_generate_dataset, args=(args, output_queue)
+            )
+            process.start()
+            # Sample the memory of all the processes until done.
+            peak_tree_rss = None
+            while True:
+                tree_rss = get_tree_rss(process.pid)
+                if tree_rss is not None:
+                    peak_tree_rss = max(peak_tree_rss or 0, tree_rss)
+                try:
+                    result = output_queue.get(timeout=RSS_SAMPLE_SECONDS)
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        raise RuntimeError("generate_dataset failed!")
+            process.join()
+            if peak_tree_rss is not None:
+                # Sum over the main process and the workers.
+                result["peak_total_rss_mb"] = peak_tree_rss / 2 ** 20
+
+            num_stitched = 0
+            for file_name in os.listdir(save_root):
+                if file_name.endswith(".json"):
+                    with open(os.path.join(save_root, file_name), "r") as file_id:
+                        num_stitched += len(json.load(file_id))
+        result["num_workers"] = num_workers
+        result["num_items"] = num_stitched
+        result["items_per_second"] = num_stitched / max(result["wall_seconds"], 1e-9)
+        print(
+            "generate_dataset ({} workers): {:.2f}s, {:.0f} dialogs/s".format(
+                num_workers, result["wall_seconds"], result["items_per_second"]
+            )
+        )
+        results.append(result)
+    return results
+
+
+def main(args):
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as data_root:
+        train_json = os.path.join(data_root, "synthetic_train.json")
+        val_json = os.path.join(data_root, "synthetic_val.json")
+        print("Generating synthetic data: {}".format(data_root))
+        save_synthetic_data(train_json, args["num_train_images"], args["seed"])
+        save_synthetic_data(
+            val_json, args["num_val_images"], args["seed"] + 1, split="val"
+        )
+
+        print("Benchmarking stages:")
+        stages = benchmark_stages(
+            train_json, args["num_samples"], args["sampler"], not args["skip_memory"]
+        )
+        for stage, result in stages.items():
+            print(
+                "{}: {:.0f} items/s{}".format(
+                    stage,
+                    result["items_per_second"],
+                    ", peak {:.1f} MB".format(result["peak_memory_mb"])
+                    if "peak_memory_mb" in result
+                    else "",
+                )
+            )
+
+        print("Checking samplers:")
+        samplers = check_samplers(train_json, args["num_samples"])
+        print(
+            "Acceptance rates: {}, standard error {:.4f}".format(
+                ", ".join(
+                    "{:.4f} ({})".format(rate, name)
+                    for name, rate in samplers["acceptance_rates"].items()
+                ),
+                samplers["standard_error"],
+            )
+        )
+
+        print("Benchmarking generate_dataset:")
+        end_to_end = benchmark_generate_dataset(
+            train_json, val_json, args["num_workers"], args["sampler"]
+        )
+
+    results = {
+        "version": BENCHMARK_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": args,
+        "environment": {
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": stages,
+        "samplers": samplers,
+        "generate_dataset": end_to_end,
+    }
+    print("Saving results: {}".format(args["save_json_path"]))
+    with open(args["save_json_path"], "w") as file_id:
+        json.dump(results, file_id, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--save_json_path",
+        default="benchmark_results.json",
+        help="Path to save the results (JSON)",
+    )
+    parser.add_argument(
+        "--num_train_images",
+        type=int,
+        default=2000,
+        help="Number of synthetic train images (the first 500 make val)",
+    )
+    parser.add_argument(
+        "--num_val_images",
+        type=int,
+        default=500,
+        help="Number of synthetic val images (make test)",
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=10000,
+        help="Number of triples for the per-stage benchmarks",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="Numbers of workers for generate_dataset",
+    )
+    parser.add_argument(
+        "--sampler",
+        default="signature",
+        choices=sorted(SAMPLERS),
+        help="Sampler for compatible triples",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the data")
+    parser.add_argument(
+        "--skip_memory", action="store_true", help="Do not track peak memory"
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)
@@ -13,6 +13,9 @@ Author(s): Satwik Kottur
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 import argparse
+import copy
+
+from dialog_graph import find_attribute_clash
 
 
 def pretty_print_dialog(dialog):
@@ -55,21 +58,20 @@ def merge_update_scene_graph(orig_graph, graph_item):
 
     # 1. Go through each new object
     # 2. Find its batch in objects
-    #   a. If found, assert for a clash of attributes, update
+    #   a. If found, check for a clash of attributes, update
     #   b. If novel, just add the object as is
     for new_obj in graph_item["objects"]:
-        match_found = False
         obj = objects.get(new_obj["id"], None)
 
         if obj:
-            # Assert for existing entries.
-            for attr in new_obj:
-                try:
-                    assert new_obj[attr] == obj.get(
-                        attr, new_obj[attr]
-                    ), "Some of the attributes do not match!"
-                except:
-                    pdb.set_trace()
+            # Check existing entries.
+            attr = find_attribute_clash(obj, new_obj)
+            if attr is not None:
+                raise ValueError(
+                    "Attribute {} of object {} does not match!".format(
+                        attr, new_obj["id"]
+                    )
+                )
 
             # Add additional keys.
             objects[new_obj["id"]].update(new_obj)
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Vectorized index to check mergeability of segmented dialogs.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+
+
+class CompatibilityIndex:
+    """Attribute bitmasks of the last context recaller of each dialog.
+
+    Mirrors Dialog.check_mergeability: dialogs are compatible if none of the
+    known attributes of one is a focus attribute of another. Dialogs without
+    a context recaller are never compatible.
+    """
+
+    def __init__(self, known, focus, valid, num_compatible=None):
+        """Builds the index over attribute bitmasks.
+
+        Args:
+            known: Array of known attribute masks, one per dialog
+            focus: Array of focus attribute masks, one per dialog
+            valid: Boolean array, False for dialogs without a context recaller
+            num_compatible: Array of the number of dialogs compatible with
+                each dialog, if counted already (see count_compatible)
+        """
+        self.known = np.asarray(known, dtype=np.uint64)
+        self.focus = np.asarray(focus, dtype=np.uint64)
+        self.valid = np.asarray(valid, dtype=bool)
+        self.num_dialogs = len(self.valid)
+        self.num_compatible = None
+        if num_compatible is not None:
+            self.num_compatible = np.asarray(num_compatible, dtype=np.int64)
+
+    @classmethod
+    def from_dialogs(cls, dialogs):
+        """Builds the index over segmented dialogs.
+
+        Args:
+            dialogs: List of Dialog objects after segment_dialog
+        """
+        known = np.zeros(len(dialogs), dtype=np.uint64)
+        focus = np.zeros(len(dialogs), dtype=np.uint64)
+        valid = np.zeros(len(dialogs), dtype=bool)
+        for index, dialog in enumerate(dialogs):
+            if not dialog.context_recaller:
+                continue
+            known[index] = dialog.context_recaller[-1]["known_mask"]
+            focus[index] = dialog.context_recaller[-1]["focus_mask"]
+            valid[index] = True
+        return cls(known, focus, valid)
+
+    def __len__(self):
+        return self.num_dialogs
+
+    def is_pair_compatible(self, first, second):
+        """Checks compatibility for a batch of pairs.
+
+        Args:
+            first, second: Arrays (or scalars) of dialog indices
+
+        Returns:
+            compatible: Boolean array, one entry per pair
+        """
+        first = np.asarray(first)
+        second = np.asarray(second)
+        return (
+            self.valid[first]
+            & self.valid[second]
+            & ((self.known[first] & self.focus[second]) == 0)
+            & ((self.known[second] & self.focus[first]) == 0)
+        )
+
+    def is_compatible(self, first, second, third=None):
+        """Checks compatibility for a batch of pairs or triples.
+
+        Args:
+            first, second, third: Arrays (or scalars) of dialog indices
+
+        Returns:
+            compatible: Boolean array, one entry per pair/triple
+        """
+        compatible = self.is_pair_compatible(first, second)
+        if third is not None:
+            compatible &= self.is_pair_compatible(first, third)
+            compatible &= self.is_pair_compatible(second, third)
+        return compatible
+
+    def is_compatible_triples(self, triples):
+        """Checks compatibility for a (N, 3) array of dialog indices.
+        """
+        triples = np.asarray(triples)
+        return self.is_compatible(triples[:, 0], triples[:, 1], triples[:, 2])
+
+    def is_compatible_tuples(self, tuples):
+        """Checks compatibility for a (N, k) array of dialog indices, k >= 2.
+        """
+        tuples = np.asarray(tuples)
+        compatible = np.ones(len(tuples), dtype=bool)
+        for first in range(tuples.shape[1]):
+            for second in range(first + 1, tuples.shape[1]):
+                compatible &= self.is_pair_compatible(
+                    tuples[:, first], tuples[:, second]
+                )
+        return compatible
+
+    def count_compatible(self, block_size=1024):
+        """Number of (other) dialogs compatible with each dialog.
+
+        Compatibility only depends on the (known, focus) signature, so it is
+        counted between distinct signatures, block_size of them at a time.
+
+        Returns:
+            num_compatible: Array with the number of dialogs compatible with
+                each dialog, 0 for dialogs without a context recaller
+        """
+        signatures = np.stack([self.known, self.focus], axis=1)[self.valid]
+        signatures, group_ids, group_sizes = np.unique(
+            signatures, axis=0, return_inverse=True, return_counts=True
+        )
+        known, focus = signatures[:, 0], signatures[:, 1]
+        group_counts = np.zeros(len(signatures), dtype=np.int64)
+        for start in range(0, len(signatures), block_size):
+            block = slice(start, start + block_size)
+            compatible = ((known[block, None] & focus[None, :]) == 0) & (
+                (known[None, :] & focus[block, None]) == 0
+            )
+            # Other dialogs only: a dialog is compatible with itself, or not.
+            group_counts[block] = compatible @ group_sizes - (
+                (known[block] & focus[block]) == 0
+            )
+        num_compatible = np.zeros(self.num_dialogs, dtype=np.int64)
+        num_compatible[self.valid] = group_counts[group_ids.reshape(-1)]
+        return num_compatible
+
+    def compatible_with(self, index):
+        """Dialogs that are compatible with a given dialog.
+
+        Args:
+            index: Index of the dialog
+
+        Returns:
+            indices: Sorted array of compatible dialog indices, excluding index
+        """
+        others = np.arange(self.num_dialogs)
+        compatible = self.is_pair_compatible(np.full_like(others, index), others)
+        compatible[index] = False
+        return np.flatnonzero(compatible)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,395 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Exact counting, enumeration and sampling of compatible triples of dialogs.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import bisect
+import functools
+import json
+import random
+
+import numpy as np
+
+from compatibility_index import CompatibilityIndex
+from run_stats import NULL_STATS
+
+
+# Counts are tabulated over all subsets of the attributes that can clash.
+MAX_ATTRIBUTE_BITS = 20
+
+
+def compact_masks(masks, bits):
+    """Keeps only the given bits of masks, renumbered from 0.
+    """
+    compact = np.zeros(len(masks), dtype=np.int64)
+    for new_bit, bit in enumerate(bits):
+        selected = (masks >> np.uint64(bit)) & np.uint64(1)
+        compact |= selected.astype(np.int64) << new_bit
+    return compact
+
+
+def get_subset_counts(known, num_bits):
+    """Number of masks that are a subset of each mask (zeta transform).
+
+    Args:
+        known: Array of masks
+        num_bits: Number of bits of the masks
+
+    Returns:
+        counts: Array of size 2^num_bits, counts[m] = #{k in known: k <= m}
+    """
+    counts = np.bincount(known, minlength=1 << num_bits).astype(np.int64)
+    for bit in range(num_bits):
+        view = counts.reshape(-1, 2, 1 << bit)
+        view[:, 1, :] += view[:, 0, :]
+    return counts
+
+
+class CompatibleTriples:
+    """Exact set of ordered triples of distinct, compatible dialogs.
+
+    Dialogs are compatible if none of the known attributes of one is a focus
+    attribute of another (see Dialog.check_mergeability). Given the focus
+    attributes (f1, f2, f3) of a triple, the condition splits per dialog: the
+    known attributes of the first must avoid f2 | f3, and so on. Dialogs are
+    thus grouped into classes by focus signature, and the number of triples
+    with focus classes (i, j, l) is
+
+        N(i, fj | fl) * (N(j, fi | fl) - [i == j])
+            * (N(l, fi | fj) - [l == i] - [l == j])
+
+    where N(x, U) is the number of dialogs of class x whose known attributes
+    avoid U, tabulated for all U with a subset sum over the attributes. This
+    takes O(F^3) for F focus classes, independently of the number of dialogs.
+
+    Triples are ordered (by focus classes, then first, second and third
+    dialog), so that they can be enumerated, and any of them obtained from
+    its rank; this gives uniform sampling without replacement by drawing
+    distinct ranks.
+    """
+
+    def __init__(
+        self, dialogs, index=None, owned=None, cache_size=4, stats=NULL_STATS
+    ):
+        """Groups dialogs by focus signature and counts the compatible triples.
+
+        Args:
+            dialogs: List of Dialog objects after segment_dialog
+            index: CompatibilityIndex over the dialogs, built if not given
+            owned: Boolean array of dialogs allowed as the first dialog (all
+                by default), see triple_keys.get_partitions
+            cache_size: Number of classes whose block counts are cached, for
+                ranking
+            stats: RunStats to record the time spent counting
+        """
+        self.dialogs = dialogs
+        self.get_block_counts = functools.lru_cache(maxsize=cache_size)(
+            self.compute_block_counts
+        )
+        if index is None:
+            index = CompatibilityIndex.from_dialogs(dialogs)
+        valid_ids = np.flatnonzero(index.valid)
+        known, focus = index.known[valid_ids], index.focus[valid_ids]
+
+        # Only attributes known by some dialog and in focus of another clash.
+        relevant = int(np.bitwise_or.reduce(known, initial=np.uint64(0)))
+        relevant &= int(np.bitwise_or.reduce(focus, initial=np.uint64(0)))
+        bits = [bit for bit in range(64) if relevant >> bit & 1]
+        if len(bits) > MAX_ATTRIBUTE_BITS:
+            raise ValueError("Too many attributes to count: {}!".format(len(bits)))
+        self.num_bits = len(bits)
+        self.full_mask = (1 << self.num_bits) - 1
+        known, focus = compact_masks(known, bits), compact_masks(focus, bits)
+
+        # Classes of dialogs with the same focus signature.
+        self.focus_masks, class_ids = np.unique(focus, return_inverse=True)
+        class_ids = class_ids.reshape(-1)
+        order = np.argsort(class_ids, kind="stable")
+        boundaries = np.searchsorted(
+            class_ids[order], np.arange(len(self.focus_masks) + 1)
+        )
+        self.members = []
+        self.member_known = []
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            self.members.append(valid_ids[order[start:end]])
+            self.member_known.append(known[order[start:end]])
+        if owned is None:
+            self.owned_members = self.members
+            self.owned_known = self.member_known
+        else:
+            owned = np.asarray(owned, dtype=bool)
+            selected = [owned[ii] for ii in self.members]
+            self.owned_members = [ii[jj] for ii, jj in zip(self.members, selected)]
+            self.owned_known = [
+                ii[jj] for ii, jj in zip(self.member_known, selected)
+            ]
+        # Complement of the union of the focus of each pair of classes.
+        self.avoid = self.full_mask ^ (
+            self.focus_masks[:, None] | self.focus_masks[None, :]
+        )
+
+        with stats.stage("compatibility"):
+            # Counts of all classes, N(x, U) = subset_counts[~U, x].
+            max_size = max([len(ii) for ii in self.members], default=0)
+            self.subset_counts = np.zeros(
+                (self.full_mask + 1, len(self.members)),
+                dtype=np.uint16 if max_size < 1 << 16 else np.int64,
+            )
+            for class_id, known in enumerate(self.member_known):
+                self.subset_counts[:, class_id] = get_subset_counts(
+                    known, self.num_bits
+                )
+            # Sums are done in floating point when exact (much faster).
+            bound = max_size ** 3 * max(len(self.members), 1) ** 2
+            self.count_dtype = np.float64 if bound < 2 ** 53 else np.int64
+            # Reused across classes, allocating it each time is slower.
+            buffer = np.empty((len(self.members),) * 2, dtype=self.count_dtype)
+            self.first_counts = np.array(
+                [self.count_first(ii, buffer) for ii in range(len(self.members))],
+                dtype=np.int64,
+            )
+        # Cumulative number of triples over the class of the first dialog.
+        self.first_cumulative = np.cumsum(self.first_counts)
+        self.num_compatible = (
+            int(self.first_cumulative[-1]) if len(self.first_cumulative) else 0
+        )
+
+        num_dialogs = len(dialogs)
+        num_owned = num_dialogs if owned is None else int(owned.sum())
+        self.num_triples = num_owned * (num_dialogs - 1) * (num_dialogs - 2)
+
+    def __len__(self):
+        return self.num_compatible
+
+    def get_first_free(self, first_class):
+        """Which classes the (owned) dialogs of a class can be merged with.
+
+        Returns:
+            free: (D, F) array, whether the known attributes of each distinct
+                known signature of the class avoid the focus of each class
+            weights: Number of dialogs with each known signature
+        """
+        known, weights = np.unique(self.owned_known[first_class], return_counts=True)
+        free = (known[:, None] & self.focus_masks[None, :]) == 0
+        return free, weights
+
+    def count_first(self, first_class, buffer=None):
+        """Number of triples whose first dialog is of a given class.
+
+        Sums compute_block_counts without forming it: the number of first
+        dialogs factorizes over the second and third classes, so the sum is
+        a product with the (D, F) free matrix, and the - [..] terms are
+        corrected for along the diagonal and the row of the first class.
+
+        Args:
+            first_class: Class of the first dialog
+            buffer: Optional (F, F) array of count_dtype, used as scratch
+        """
+        if not len(self.owned_known[first_class]):
+            return 0
+        # sizes_t[y, x] = N(x, f_first | f_y).
+        sizes_t = self.subset_counts[self.avoid[first_class]]
+        pairs = np.multiply(sizes_t, sizes_t.T, out=buffer, dtype=self.count_dtype)
+        free, weights = self.get_first_free(first_class)
+        free = free.astype(self.count_dtype)
+        weights = weights.astype(self.count_dtype)
+        total = weights @ np.sum((free @ pairs) * free, axis=1)
+
+        # Number of first dialogs for the blocks (x, x) and (x, first_class).
+        firsts_diagonal = weights @ free
+        firsts_column = (weights * free[:, first_class]) @ free
+        total -= 2 * (firsts_column @ sizes_t[first_class])
+        total -= firsts_diagonal @ np.diagonal(sizes_t)
+        total += 2 * firsts_diagonal[first_class]
+        return int(round(total)) if self.count_dtype is np.float64 else int(total)
+
+    def compute_block_counts(self, first_class):
+        """Number of triples for each (second, third) class, given the first.
+
+        Returns:
+            counts: (F, F) int64 array over the classes of the second and
+                third dialogs
+        """
+        free, weights = self.get_first_free(first_class)
+        free = free.astype(np.int64)
+        firsts = (free.T * weights) @ free
+        # sizes_t[y, x] = N(x, f_first | f_y).
+        sizes_t = self.subset_counts[self.avoid[first_class]].astype(np.int64)
+        seconds = sizes_t.T.copy()
+        seconds[first_class, :] -= 1
+        thirds = sizes_t
+        thirds[:, first_class] -= 1
+        thirds[np.diag_indices_from(thirds)] -= 1
+        # Negative counts only occur where there is no first dialog.
+        return firsts * seconds * thirds
+
+    def get_set(self, class_id, avoid_mask, owned=False):
+        """Sorted dialogs of a class whose known attributes are in avoid_mask.
+        """
+        members = self.owned_members if owned else self.members
+        known = self.owned_known if owned else self.member_known
+        return members[class_id][(known[class_id] & ~avoid_mask) == 0]
+
+    @staticmethod
+    def select(dialog_set, position, excluded=()):
+        """Dialog at a position of a sorted set, skipping excluded dialogs.
+        """
+        skipped = sorted(
+            bisect.bisect_left(dialog_set, ii) for ii in excluded if ii in dialog_set
+        )
+        for excluded_position in skipped:
+            if position >= excluded_position:
+                position += 1
+        return int(dialog_set[position])
+
+    def unrank(self, rank):
+        """Triple of dialog indices with a given rank (0 <= rank < len(self)).
+        """
+        if not 0 <= rank < self.num_compatible:
+            raise IndexError("Triple rank out of range!")
+        first_class = int(np.searchsorted(self.first_cumulative, rank, side="right"))
+        if first_class:
+            rank -= int(self.first_cumulative[first_class - 1])
+        block_counts = self.get_block_counts(first_class).reshape(-1)
+        block_cumulative = np.cumsum(block_counts)
+        block = int(np.searchsorted(block_cumulative, rank, side="right"))
+        if block:
+            rank -= int(block_cumulative[block - 1])
+        second_class, third_class = divmod(block, len(self.members))
+
+        firsts, seconds, thirds = self.get_block_sets(
+            first_class, second_class, third_class
+        )
+        num_seconds = len(seconds) - (second_class == first_class)
+        num_thirds = len(thirds) - (third_class == first_class)
+        num_thirds -= third_class == second_class
+        rank, third_position = divmod(rank, num_thirds)
+        first_position, second_position = divmod(rank, num_seconds)
+        first = self.select(firsts, first_position)
+        second = self.select(seconds, second_position, [first])
+        third = self.select(thirds, third_position, [first, second])
+        return first, second, third
+
+    def get_block_sets(self, first_class, second_class, third_class):
+        """Candidate dialogs for each position, given the focus classes.
+        """
+        return (
+            self.get_set(
+                first_class, self.avoid[second_class, third_class], owned=True
+            ),
+            self.get_set(second_class, self.avoid[first_class, third_class]),
+            self.get_set(third_class, self.avoid[first_class, second_class]),
+        )
+
+    def iter_triples(self):
+        """Yields all the triples of dialog indices, in order of rank.
+
+        Streams the triples, holding only the counts of one class at a time.
+        """
+        num_classes = len(self.members)
+        for first_class in range(num_classes):
+            if not self.first_counts[first_class]:
+                continue
+            block_counts = self.compute_block_counts(first_class)
+            for second_class, third_class in zip(*np.nonzero(block_counts)):
+                firsts, seconds, thirds = self.get_block_sets(
+                    first_class, second_class, third_class
+                )
+                for first in firsts.tolist():
+                    for second in seconds.tolist():
+                        if second == first:
+                            continue
+                        for third in thirds.tolist():
+                            if third != first and third != second:
+                                yield first, second, third
+
+    def sample_ranks(self, num_samples):
+        """Distinct ranks drawn uniformly (with the random module).
+        """
+        if num_samples > self.num_compatible:
+            raise ValueError(
+                "Only {} compatible triples, cannot sample {}!".format(
+                    self.num_compatible, num_samples
+                )
+            )
+        return random.sample(range(self.num_compatible), num_samples)
+
+    def sample_without_replacement(self, num_samples):
+        """Distinct triples drawn uniformly, in random order.
+
+        Returns:
+            triples: List of triples of Dialog objects
+        """
+        ranks = self.sample_ranks(num_samples)
+        # Unrank in order, so that the counts of each class are computed once.
+        unranked = {rank: self.unrank(rank) for rank in sorted(ranks)}
+        return [[self.dialogs[ii] for ii in unranked[rank]] for rank in ranks]
+
+    def get_acceptance_rate(self):
+        """Acceptance rate that rejection sampling would have (exact).
+        """
+        return self.num_compatible / max(self.num_triples, 1)
+
+
+def main(args):
+    from segment_store import SegmentStore, segmented_split
+
+    print("Reading: {}".format(args["input_json_path"]))
+    with segmented_split(args["input_json_path"]) as store_path:
+        dialogs = SegmentStore(store_path)
+        triples = CompatibleTriples(dialogs, dialogs.get_compatibility_index())
+        print("# dialogs: {}".format(len(dialogs)))
+        print("# focus classes: {}".format(len(triples.members)))
+        print("# ordered triples: {}".format(triples.num_triples))
+        print("# compatible ordered triples: {}".format(len(triples)))
+        print("# compatible unordered triples: {}".format(len(triples) // 6))
+        if args["save_path"] is None:
+            return
+
+        dialog_keys = dialogs.get_dialog_keys().tolist()
+        if args["num_samples"] is None:
+            print("Saving compatible triples: {}".format(args["save_path"]))
+            stream = triples.iter_triples()
+        else:
+            print("Saving sampled triples: {}".format(args["save_path"]))
+            random.seed(args["random_seed"])
+            stream = map(triples.unrank, triples.sample_ranks(args["num_samples"]))
+        with open(args["save_path"], "w") as file_id:
+            for triple in stream:
+                file_id.write(json.dumps([dialog_keys[ii] for ii in triple]) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--input_json_path", required=True, help="Path to CLEVR-Dialog JSON file"
+    )
+    parser.add_argument(
+        "--save_path",
+        default=None,
+        help="Path to stream the compatible triples (of dialog keys) to",
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=None,
+        help="Only save this many triples, sampled without replacement",
+    )
+    parser.add_argument(
+        "--random_seed", type=int, default=None, help="Seed for sampling"
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)
@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Incremental writers for stitched dialogs.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import gzip
+import hashlib
+import json
+import os
+
+from json_stream import iter_json_array
+
+
+OUTPUT_FORMATS = ("json", "jsonl")
+# Prefix of the files of stitched dialogs.
+DATASET_PREFIX = "deep_clevr_dialog"
+
+
+def get_dataset_files(save_root, split, prefix=DATASET_PREFIX):
+    """Paths to the files of a saved split, in either output format.
+
+    Args:
+        save_root: Folder the split was saved to
+        split: Name of the split
+        prefix: Prefix of the files (e.g., of recipes, see stitch_recipes)
+
+    Returns:
+        file_paths: List with the JSON file, or the JSON Lines shards listed
+            in the manifest
+    """
+    manifest_path = os.path.join(save_root, "{}_{}.manifest.json".format(prefix, split))
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file_id:
+            manifest = json.load(file_id)
+        return [os.path.join(save_root, ii["file_name"]) for ii in manifest["shards"]]
+    for file_name in ("{}_{}.json", "{}_{}.json.gz"):
+        file_path = os.path.join(save_root, file_name.format(prefix, split))
+        if os.path.exists(file_path):
+            return [file_path]
+    raise FileNotFoundError("No stitched dialogs for {}: {}".format(split, save_root))
+
+
+def iter_dataset_file(file_path):
+    """Yields the stitched dialogs of a JSON or JSON Lines file (or .gz).
+    """
+    if ".jsonl" not in os.path.basename(file_path):
+        yield from iter_json_array(file_path)
+        return
+    open_file = gzip.open if file_path.endswith(".gz") else open
+    with open_file(file_path, "rt") as file_id:
+        for line in file_id:
+            if line.strip():
+                yield json.loads(line)
+
+
+def truncate_files(save_root, manifest):
+    """Truncates saved files to the sizes in their manifest, dropping what an
+    interrupted run appended after saving it.
+
+    Args:
+        save_root: Folder the files were saved to
+        manifest: Manifest of the files (see DatasetWriter.close)
+    """
+    if manifest["format"] == "json" and manifest["compression"] is not None:
+        raise ValueError("Compressed JSON cannot be appended to, use jsonl!")
+    # The closing bracket of a JSON list is removed when appending to it.
+    closing = b"]" if manifest["format"] == "json" else b""
+    for saved in manifest["shards"]:
+        file_path = os.path.join(save_root, saved["file_name"])
+        num_bytes = saved["num_bytes"] - len(closing)
+        if os.path.getsize(file_path) < num_bytes:
+            raise ValueError("File shorter than saved: {}!".format(file_path))
+        os.truncate(file_path, num_bytes)
+        with open(file_path, "ab") as file_id:
+            file_id.write(closing)
+
+
+class HashingFile:
+    """Binary file that keeps a checksum and size of the bytes written.
+
+    When appending, the checksum and size include the existing bytes.
+    """
+
+    def __init__(self, file_path, append=False, chunk_size=1 << 22):
+        self.checksum = hashlib.sha256()
+        self.num_bytes = 0
+        if append:
+            with open(file_path, "rb") as file_id:
+                for chunk in iter(lambda: file_id.read(chunk_size), b""):
+                    self.checksum.update(chunk)
+                    self.num_bytes += len(chunk)
+        self.file_id = open(file_path, "ab" if append else "wb")
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.num_bytes += len(data)
+        return self.file_id.write(data)
+
+    def flush(self):
+        self.file_id.flush()
+
+    def close(self):
+        self.file_id.close()
+
+
+class DatasetWriter:
+    """Writes stitched dialogs of a split as they are produced.
+
+    Two formats are supported:
+    (a) json: a single JSON list, {prefix}_{split}.json (same content as
+        dumping the full list at once)
+    (b) jsonl: JSON Lines, round-robin over num_shards files
+        {prefix}_{split}-{shard}-of-{num_shards}.jsonl, with a manifest
+        {prefix}_{split}.manifest.json listing the number of records, size
+        and sha256 checksum of each shard
+    Either can be gzip compressed (.gz), in which case sizes and checksums
+    are for the compressed files. The prefix is deep_clevr_dialog by default.
+
+    Given the manifest of saved files (see close), stitched dialogs are
+    appended to them instead, continuing round-robin over the shards (a
+    compressed shard gets another gzip member). Files are first truncated to
+    the sizes in the manifest, dropping what an interrupted run appended.
+
+    Files are only finalized (closing bracket, manifest) by close, not when
+    leaving a with block on an error (see close_files); the manifest of files
+    saved before is removed when writing them again, so that files left
+    unfinished never pass for a complete split.
+    """
+
+    def __init__(
+        self,
+        save_root,
+        split,
+        output_format="json",
+        num_shards=1,
+        compress=False,
+        prefix=DATASET_PREFIX,
+        append_to=None,
+    ):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Output format invalid: {}!".format(output_format))
+        if output_format == "json" and num_shards != 1:
+            raise ValueError("JSON output cannot be sharded, use jsonl!")
+        self.save_root = save_root
+        self.split = split
+        self.prefix = prefix
+        self.output_format = output_format
+        self.compress = compress
+        self.num_records = 0
+
+        if output_format == "json":
+            file_names = ["{}_{}.json".format(prefix, split)]
+        else:
+            file_names = [
+                "{}_{}-{:05d}-of-{:05d}.jsonl".format(
+                    prefix, split, shard_id, num_shards
+                )
+                for shard_id in range(num_shards)
+            ]
+        if compress:
+            file_names = [ii + ".gz" for ii in file_names]
+        manifest_path = os.path.join(
+            save_root, "{}_{}.manifest.json".format(prefix, split)
+        )
+        if append_to is None and os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        if append_to is not None:
+            if [ii["file_name"] for ii in append_to["shards"]] != file_names:
+                raise ValueError("Files do not match the manifest: {}!".format(split))
+            truncate_files(save_root, append_to)
+            if output_format == "json":
+                # Continue the list.
+                file_path = os.path.join(save_root, file_names[0])
+                os.truncate(file_path, os.path.getsize(file_path) - 1)
+        self.shards = []
+        for shard_id, file_name in enumerate(file_names):
+            raw_file = HashingFile(
+                os.path.join(save_root, file_name), append_to is not None
+            )
+            if append_to is not None:
+                checksum = raw_file.checksum.copy()
+                if output_format == "json":
+                    checksum.update(b"]")
+                if checksum.hexdigest() != append_to["shards"][shard_id]["sha256"]:
+                    raise ValueError("File changed since saved: {}!".format(file_name))
+            if compress:
+                file_id = gzip.GzipFile(
+                    file_name, "wb", compresslevel=6, fileobj=raw_file, mtime=0
+                )
+            else:
+                file_id = raw_file
+            self.shards.append(
+                {"file_name": file_name, "raw_file": raw_file, "file": file_id}
+            )
+        self.file_paths = [os.path.join(save_root, ii) for ii in file_names]
+        self.shard_counts = [0] * len(self.shards)
+        # Bytes written to each (uncompressed) file.
+        self.shard_bytes = [0] * len(self.shards)
+        if append_to is not None:
+            self.num_records = append_to["num_records"]
+            self.shard_counts = [ii["num_records"] for ii in append_to["shards"]]
+            self.shard_bytes = [ii["raw_file"].num_bytes for ii in self.shards]
+        elif output_format == "json":
+            self.shards[0]["file"].write(b"[")
+            self.shard_bytes[0] = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self.close_files()
+
+    def write(self, record):
+        """Writes one stitched dialog.
+        """
+        return self.write_json(json.dumps(record))
+
+    def write_json(self, data):
+        """Writes one stitched dialog, already serialized to JSON.
+
+        Returns:
+            location: Tuple (shard_id, offset, num_bytes) of the record in
+                its (uncompressed) file, see record_index
+        """
+        shard_id = self.num_records % len(self.shards)
+        data = data.encode("utf-8")
+        if self.output_format == "json":
+            prefix, suffix = (b", " if self.num_records else b""), b""
+        else:
+            prefix, suffix = b"", b"\n"
+        offset = self.shard_bytes[shard_id] + len(prefix)
+        self.shards[shard_id]["file"].write(prefix + data + suffix)
+        self.shard_bytes[shard_id] = offset + len(data) + len(suffix)
+        self.shard_counts[shard_id] += 1
+        self.num_records += 1
+        return shard_id, offset, len(data)
+
+    def close_files(self):
+        """Closes the files without finalizing them (see close), e.g., after
+        an error: no closing bracket (json) nor manifest (jsonl) is written.
+        """
+        for shard in self.shards:
+            shard["file"].close()
+            if self.compress:
+                shard["raw_file"].close()
+
+    def close(self):
+        """Closes the files and writes the manifest (for jsonl).
+
+        Returns:
+            manifest: Dictionary with the number of records, size and checksum
+                of each file
+        """
+        if self.output_format == "json":
+            self.shards[0]["file"].write(b"]")
+        self.close_files()
+
+        manifest = {
+            "split": self.split,
+            "format": self.output_format,
+            "compression": "gzip" if self.compress else None,
+            "num_records": self.num_records,
+            "shards": [
+                {
+                    "file_name": shard["file_name"],
+                    "num_records": count,
+                    "num_bytes": shard["raw_file"].num_bytes,
+                    "sha256": shard["raw_file"].checksum.hexdigest(),
+                }
+                for shard, count in zip(self.shards, self.shard_counts)
+            ],
+        }
+        if self.output_format == "jsonl":
+            manifest_path = os.path.join(
+                self.save_root, "{}_{}.manifest.json".format(self.prefix, self.split)
+            )
+            with open(manifest_path, "w") as file_id:
+                json.dump(manifest, file_id, indent=2)
+        return manifest
+
+
+if __name__ == "__main__":
+    pass
@@ -13,14 +13,25 @@ Author(s): Satwik Kottur
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import argparse
-import copy
 import itertools
 import random
+import sys
 
+from attribute_vocab import encode_attributes
 from dialog_graph import DialogGraph
 
 
 class Dialog:
+    __slots__ = (
+        "image_filename",
+        "image_index",
+        "split",
+        "data",
+        "dialog_index",
+        "context_recaller",
+        "dialog_graph",
+    )
+
     def __init__(self, dialog_bundle, index):
         # Add attributes.
         for key in ("image_filename", "image_index", "split"):
@@ -45,18 +56,23 @@ class Dialog:
         for datum in self.data["dialog"]:
             del datum["context_index"]
 
-    def segment_dialog(self):
+    def segment_dialog(self, keep_graphs=True):
         """Segment the dialog based on dependencies.
 
         Identify following types of questions:
         (a) Context recaller
         (b) Independent questions
+
+        Args:
+            keep_graphs: Keep the scene graphs after segmentation, otherwise
+                compact the dialog (see compact)
         """
         # Update the graphs.
         for round_id, round_datum in enumerate(self.data["graph"]["history"]):
             self.dialog_graph.merge_update_scene_graph(round_datum)
 
-        focus_attrs = []
+        focus_attrs = set()
+        num_focus_items = 0
         dialog_history = self.data["graph"]["history"]
         for round_id, round_datum in enumerate(self.data["dialog"]):
             # Context recaller.
@@ -66,71 +82,112 @@ class Dialog:
                 if round_id == 0:
                     continue
                 # Check known attributes.
-                turn_graph = self.dialog_graph.turn_graphs[round_id + 1]
-                known_attrs = self.dialog_graph.get_known_attributes(turn_graph)
-                focus_attrs = [
-                    ii["focus_desc"]
-                    for ii in dialog_history[: round_id + 2]
-                    if "focus_desc" in ii
-                ]
-                all_focus_attrs = set(
-                    ii[jj]
-                    for ii in focus_attrs
-                    if ii is not None
-                    for jj in ii["required"]
-                )
+                known_attrs = self.dialog_graph.get_turn_known_attributes(round_id + 1)
+                # Accumulate focus attributes up to the current round.
+                for history_item in dialog_history[num_focus_items : round_id + 2]:
+                    focus_desc = history_item.get("focus_desc", None)
+                    if focus_desc is not None:
+                        focus_attrs.update(
+                            focus_desc[jj] for jj in focus_desc["required"]
+                        )
+                num_focus_items = round_id + 2
                 new_context_datum = {
                     "round_id": round_id,
-                    "known_attrs": copy.deepcopy(known_attrs),
-                    "focus_attrs": copy.deepcopy(all_focus_attrs),
+                    "known_attrs": known_attrs,
+                    "focus_attrs": set(focus_attrs),
+                    "known_mask": encode_attributes(known_attrs),
+                    "focus_mask": encode_attributes(focus_attrs),
                     "turn_focus_attrs": dialog_history[round_id + 1]["focus_desc"],
                 }
                 self.context_recaller.append(new_context_datum)
+        if not keep_graphs:
+            self.compact()
+
+    def compact(self):
+        """Keeps only what stitching and saving need.
+
+        The scene graph history and the turn graphs are released (only the
+        dependence of each history item is kept), and the strings of the
+        caption and rounds are interned, so that they are shared across
+        dialogs (templates, answers and most questions repeat). Printing the
+        dialog with its graphs is no longer possible.
+        """
+        self.data = {
+            "caption": sys.intern(self.data["caption"]),
+            "dependence": self.get_dependence(),
+            "dialog": [
+                {
+                    key: sys.intern(value) if isinstance(value, str) else value
+                    for key, value in turn.items()
+                }
+                for turn in self.data["dialog"]
+            ],
+        }
+        self.dialog_graph = None
+
+    def get_dependence(self):
+        """Round each scene graph history item depends on (None if any).
+
+        Item 0 is the caption, and item round_id + 1 the round round_id.
+        """
+        if "dependence" in self.data:
+            return self.data["dependence"]
+        return [ii.get("dependence", None) for ii in self.data["graph"]["history"]]
 
     @staticmethod
-    def check_mergeability(first_dialog, second_dialog, third_dialog=None):
+    def check_mergeability(first_dialog, second_dialog, *other_dialogs):
         """Check if a dialog is mergeable with self.
 
         Args:
-            first_dialog, second_dialog, third_dialog: the sequence of dialogs
+            first_dialog, second_dialog, other_dialogs: the sequence of dialogs
+                (any number of them, e.g., a third one)
         """
         dialogs = (first_dialog, second_dialog)
-        if third_dialog is not None:
-            dialogs += (third_dialog,)
+        dialogs += tuple(dd for dd in other_dialogs if dd is not None)
+        # Dialogs without a context recaller cannot be split to stitch.
+        if not all(dd.context_recaller for dd in dialogs):
+            return False
 
-        focus = [dd.context_recaller[-1]["focus_attrs"] for dd in dialogs]
-        known = [dd.context_recaller[-1]["known_attrs"] for dd in dialogs]
-        compatible = True
+        focus = [dd.context_recaller[-1]["focus_mask"] for dd in dialogs]
+        known = [dd.context_recaller[-1]["known_mask"] for dd in dialogs]
         for id1, id2 in itertools.permutations(range(len(dialogs)), 2):
-            compatible = compatible and len(known[id1].intersection(focus[id2])) == 0
-        if compatible:
-            Dialog.merge_dialogs(*dialogs)
-        return compatible
+            if known[id1] & focus[id2]:
+                return False
+        return True
 
     @staticmethod
-    def merge_dialogs(*dialogs):
-        """Merging dialogs (two or three at a time).
+    def plan_dialogs(*dialogs):
+        """Plans the stitching of dialogs (two or more at a time).
+
+        See kway_stitching to plan a batch of them at once.
+
+        Returns:
+            plan: StitchPlan, to materialize into the merged dialog
         """
         if len(dialogs) == 2:
-            merged_data = Dialog.merge_two_dialogs(*dialogs)
-        elif len(dialogs) == 3:
-            merged_data = Dialog.merge_three_dialogs(*dialogs)
+            spans = Dialog.plan_two_dialogs(*dialogs)
+        elif len(dialogs) >= 3:
+            spans = Dialog.plan_many_dialogs(*dialogs)
         else:
-            raise ValueError("Dialogs need to be of length 2 or 3!")
+            raise ValueError("Dialogs need to be of length 2 or more!")
+        return StitchPlan(dialogs, spans)
 
-        # Get the merged dialog.
-        merged_dialog = {"data": merged_data}
-        for key in ("image_filename", "image_index", "split", "dialog_index"):
-            merged_dialog[key] = [getattr(dd, key) for dd in dialogs]
-        return merged_dialog
+    @staticmethod
+    def merge_dialogs(*dialogs):
+        """Merging dialogs (two or more at a time).
+        """
+        return Dialog.plan_dialogs(*dialogs).materialize()
 
     @staticmethod
-    def merge_two_dialogs(first_dialog, second_dialog, merge_type="ABAB"):
-        """Merging two dialogs that are compatible.
+    def plan_two_dialogs(first_dialog, second_dialog, merge_type="ABAB"):
+        """Plans the stitching of two dialogs that are compatible.
 
         Args:
             first_dialog, second_dialog: the sequence of dialogs (A, B)
             merge_type: One of the ABA or ABAB merge types
+
+        Returns:
+            spans: List of (context_index, round_start, round_end)
         """
         if merge_type == "ABA":
             # A-B-A stitching.
@@ -143,81 +200,87 @@ class Dialog:
         else:
             raise ValueError("Mergetype invalid!")
 
-        # Add dialog indices.
-        first_dialog.add_context_index(0)
-        second_dialog.add_context_index(1)
-        new_dialog = [{"context_index": 0, "caption": first_dialog.data["caption"]}]
-        new_dialog.extend(first_dialog.data["dialog"][: first_split["round_id"]])
-        new_dialog.append(
-            {"context_index": 1, "caption": second_dialog.data["caption"]}
-        )
+        spans = [(0, 0, first_split["round_id"])]
         if second_split is None:
-            new_dialog.extend(second_dialog.data["dialog"])
+            spans.append((1, 0, None))
         else:
-            new_dialog.extend(second_dialog.data["dialog"][: second_split["round_id"]])
-        new_dialog.extend(first_dialog.data["dialog"][first_split["round_id"] :])
+            spans.append((1, 0, second_split["round_id"]))
+        spans.append((0, first_split["round_id"], None))
         if second_split is not None:
-            new_dialog.extend(second_dialog.data["dialog"][second_split["round_id"] :])
-        new_dialog = copy.deepcopy(new_dialog)
-        # Remove dialog indices.
-        first_dialog.clear_context_index()
-        second_dialog.clear_context_index()
-        # Debug.
-        # print(Dialog.print_merged_dialog(new_dialog))
-        return new_dialog
+            spans.append((1, second_split["round_id"], None))
+        return spans
 
     @staticmethod
-    def merge_three_dialogs(first_dialog, second_dialog, third_dialog):
-        """Merging three dialogs that are compatible.
+    def plan_three_dialogs(first_dialog, second_dialog, third_dialog):
+        """Plans the stitching of three dialogs that are compatible.
 
         Args:
             first_dialog, second_dialog, third_dialog: the sequence of dialogs
+
+        Returns:
+            spans: List of (context_index, round_start, round_end)
         """
-        dialogs = {0: first_dialog, 1: second_dialog, 2: third_dialog}
-        splits = {
-            ii: random.choice(dd.context_recaller)["round_id"]
-            for ii, dd in dialogs.items()
-        }
-        # Add dialog indices.
-        for index, dialog in dialogs.items():
-            dialog.add_context_index(index)
+        return Dialog.plan_many_dialogs(first_dialog, second_dialog, third_dialog)
+
+    @staticmethod
+    def plan_many_dialogs(*dialogs):
+        """Plans the stitching of three or more dialogs that are compatible.
 
-        seen_dialogs = []
-        new_dialog = []
+        Each dialog is split at a random context recaller, and appears twice
+        (head, then tail); each turn goes to a dialog drawn among the other
+        ones not done yet, or to the same one if none is left.
+
+        Args:
+            dialogs: the sequence of dialogs
+
+        Returns:
+            spans: List of (context_index, round_start, round_end)
+        """
+        splits = [random.choice(dd.context_recaller)["round_id"] for dd in dialogs]
+
+        # Number of times each dialog appeared.
+        counts = [0] * len(dialogs)
+        spans = []
         # Randomly select a dialog.
         current_id = -1
-        while len(seen_dialogs) < 6:
+        for _ in range(2 * len(dialogs)):
             candidate_ids = [
                 ii
-                for ii in dialogs
-                if (ii != current_id and seen_dialogs.count(ii) < 2)
+                for ii, count in enumerate(counts)
+                if (ii != current_id and count < 2)
             ]
             if len(candidate_ids) > 0:
                 current_id = random.choice(candidate_ids)
 
-            if current_id not in seen_dialogs:
-                new_dialog.append(
-                    {
-                        "context_index": current_id,
-                        "caption": dialogs[current_id].data["caption"],
-                    }
-                )
-                new_dialog.extend(
-                    dialogs[current_id].data["dialog"][: splits[current_id]]
-                )
+            if not counts[current_id]:
+                spans.append((current_id, 0, splits[current_id]))
             else:
-                new_dialog.extend(
-                    dialogs[current_id].data["dialog"][splits[current_id] :]
-                )
-            seen_dialogs.append(current_id)
+                spans.append((current_id, splits[current_id], None))
+            counts[current_id] += 1
+        return spans
 
-        new_dialog = copy.deepcopy(new_dialog)
-        # Remove dialog indices.
-        for index, dialog in dialogs.items():
-            dialog.clear_context_index()
-        # Debug.
-        # print(Dialog.print_merged_dialog(new_dialog))
-        return new_dialog
+    @staticmethod
+    def merge_two_dialogs(first_dialog, second_dialog, merge_type="ABAB"):
+        """Merging two dialogs that are compatible.
+
+        Args:
+            first_dialog, second_dialog: the sequence of dialogs (A, B)
+            merge_type: One of the ABA or ABAB merge types
+        """
+        dialogs = (first_dialog, second_dialog)
+        spans = Dialog.plan_two_dialogs(first_dialog, second_dialog, merge_type)
+        return StitchPlan(dialogs, spans).materialize_turns()
+
+    @staticmethod
+    def merge_three_dialogs(first_dialog, second_dialog, third_dialog):
+        """Merging three dialogs that are compatible.
+
+        Args:
+            first_dialog, second_dialog, third_dialog: the sequence of dialogs
+        """
+        dialogs = (first_dialog, second_dialog, third_dialog)
+        spans = Dialog.plan_three_dialogs(*dialogs)
+        return StitchPlan(dialogs, spans).materialize_turns()
 
     @staticmethod
     def print_merged_dialog(merged_dialog):
@@ -267,5 +330,116 @@ class Dialog:
         return string
 
 
+class StitchPlan:
+    """Stitched dialog as spans of rounds from the source dialogs.
+
+    Source dialogs are never modified; turns are only built (as shallow copies
+    of the source turns) by materialize, e.g., when the stitched dialog is saved.
+    """
+
+    __slots__ = ("dialogs", "spans")
+
+    def __init__(self, dialogs, spans):
+        """Initializes the plan.
+
+        Args:
+            dialogs: Source Dialog objects, in the order of context indices
+            spans: List of (context_index, round_start, round_end), the caption
+                of a context precedes its first span (round_end=None: till the
+                end of the dialog)
+        """
+        self.dialogs = dialogs
+        self.spans = spans
+
+    @staticmethod
+    def from_recipe(recipe, dialogs):
+        """Plan of a stitched dialog saved as a recipe (see to_recipe).
+
+        Args:
+            recipe: Recipe of the stitched dialog
+            dialogs: Source Dialog objects of the recipe, in order
+        """
+        return StitchPlan(tuple(dialogs), [tuple(ii) for ii in recipe["spans"]])
+
+    def to_recipe(self):
+        """References to the source dialogs and the spans, to stitch again.
+
+        Returns:
+            recipe: Dictionary with the image and dialog index of each source
+                dialog, and the spans
+        """
+        return {
+            "image_index": [dd.image_index for dd in self.dialogs],
+            "dialog_index": [dd.dialog_index for dd in self.dialogs],
+            "spans": [list(ii) for ii in self.spans],
+        }
+
+    def materialize_turns(self):
+        """Builds the turns (captions and rounds) of the stitched dialog.
+        """
+        turns = []
+        seen_contexts = set()
+        for context_index, round_start, round_end in self.spans:
+            source = self.dialogs[context_index].data
+            if context_index not in seen_contexts:
+                seen_contexts.add(context_index)
+                turns.append(
+                    {"context_index": context_index, "caption": source["caption"]}
+                )
+            for turn in source["dialog"][round_start:round_end]:
+                turn = dict(turn)
+                turn["context_index"] = context_index
+                turns.append(turn)
+        return turns
+
+    def get_stats(self):
+        """Dependence and structure statistics of the stitched dialog.
+
+        A round depends on an earlier round of its context (see
+        Dialog.get_dependence); the distance between them is counted in turns
+        of the source dialog (original) and of the stitched dialog (stitched),
+        as evaluate_dependence does.
+
+        Returns:
+            stats: Dictionary with the position (in the stitched turns),
+                original and stitched distance of each dependent round, the
+                number of context switches, and the number of turns (caption
+                included) of each context
+        """
+        stats = {"positions": [], "original": [], "stitched": []}
+        # Positions of the caption and rounds of each context, in order.
+        context_positions = [[] for _ in self.dialogs]
+        position = 0
+        num_switches = 0
+        for span_id, (context_index, round_start, round_end) in enumerate(self.spans):
+            if span_id and context_index != self.spans[span_id - 1][0]:
+                num_switches += 1
+            source = self.dialogs[context_index]
+            dependence = source.get_dependence()
+            positions = context_positions[context_index]
+            if not positions:
+                positions.append(position)
+                position += 1
+            for round_id in range(len(source.data["dialog"]))[round_start:round_end]:
+                focus_id = dependence[round_id + 1]
+                if focus_id is not None:
+                    stats["positions"].append(position)
+                    stats["original"].append(round_id - focus_id)
+                    stats["stitched"].append(position - positions[focus_id + 1])
+                positions.append(position)
+                position += 1
+        stats["context_switches"] = num_switches
+        stats["turns_per_context"] = [len(ii) for ii in context_positions]
+        return stats
+
+    def materialize(self):
+        """Builds the stitched dialog.
+        """
+        merged_dialog = {"data": self.materialize_turns()}
+        for key in ("image_filename", "image_index", "split", "dialog_index"):
+            merged_dialog[key] = [getattr(dd, key) for dd in self.dialogs]
+        return merged_dialog
+
+
 if __name__ == "__main__":
     pass
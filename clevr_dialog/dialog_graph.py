@@ -14,13 +14,70 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import argparse
 import collections
-import copy
+
+
+# Object attributes that describe a CLEVR object.
+ATTRIBUTE_KEYS = ("shape", "size", "material", "color")
+
+
+def find_attribute_clash(obj, new_obj):
+    """Finds an attribute of a new graph item object that clashes with the
+    merged object (same id) so far.
+
+    Args:
+        obj: Object merged from the earlier graph items
+        new_obj: Object of the new graph item
+
+    Returns:
+        attr: First attribute with different values, None if none
+    """
+    for attr, value in new_obj.items():
+        if obj.get(attr, value) != value:
+            return attr
+    return None
+
+
+class TurnGraphs:
+    """Read-only sequence view over the per-turn scene graphs of a dialog.
+
+    Scene graphs are not stored per turn; each access replays the turn deltas
+    of the parent DialogGraph and returns a fresh snapshot.
+    """
+
+    def __init__(self, dialog_graph):
+        self.dialog_graph = dialog_graph
+
+    def __len__(self):
+        return len(self.dialog_graph.turn_deltas)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ii] for ii in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Turn graph index out of range!")
+        return self.dialog_graph.get_turn_graph(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 
 class DialogGraph:
     def __init__(self):
-        self.current_graph = self.get_empty_graph()
-        self.turn_graphs = [self.current_graph]
+        # Each turn records (new objects, new relation) instead of a full copy
+        # of the scene graph. Object dicts are shared with the graph history.
+        self.turn_deltas = [((), None)]
+        # Known attributes per turn, shared between turns when unchanged.
+        self.turn_known_attrs = [frozenset()]
+        self.turn_graphs = TurnGraphs(self)
+        # Live merged state of the objects, used to check for clashes.
+        self.objects = {}
+
+    @property
+    def current_graph(self):
+        return self.turn_graphs[-1]
 
     def get_empty_graph(self):
         """Generate an empty scene graph.
@@ -35,64 +92,99 @@ class DialogGraph:
         }
         return graph
 
+    def get_turn_graph(self, turn_id):
+        """Materialize the scene graph at a given turn by replaying deltas.
+
+        Args:
+            turn_id: Index of the turn (same indexing as turn_graphs)
+
+        Returns:
+            graph: Scene graph after the turn, not shared with any other turn
+        """
+        graph = self.get_empty_graph()
+        objects = graph["objects"]
+        for new_objects, relation in self.turn_deltas[: turn_id + 1]:
+            for new_obj in new_objects:
+                if new_obj["id"] in objects:
+                    objects[new_obj["id"]].update(new_obj)
+                else:
+                    objects[new_obj["id"]] = dict(new_obj)
+            if relation is not None:
+                rel, id1, id2 = relation
+                graph["relationships"][rel][id1].append(id2)
+        return graph
+
     # Adapted from:
     # https://github.com/satwikkottur/clevr-dialog/blob/master/clevr_utils.py
     def merge_update_scene_graph(self, graph_item):
-        """Merges two scene graphs into one.
+        """Merges a new graph item into the scene graph.
+
+        Only the delta for the turn is recorded; see get_turn_graph to obtain
+        the full scene graph at any turn.
 
         Args:
             graph_item: New graph item to add to the scene graph
-
-        Returns:
-            graph: Deep copy of the original scene graph after merging
         """
-        graph = copy.deepcopy(self.current_graph)
         # Local alias.
-        objects = graph["objects"]
-
-        # If not mergeable, return the same scene graph.
-        if not graph_item["mergeable"]:
-            self.turn_graphs.append(graph)
-            self.current_graph = graph
+        objects = self.objects
+        known_attrs = self.turn_known_attrs[-1]
+        new_attrs = set()
 
         # 1. Go through each new object
         # 2. Find its batch in objects
-        #   a. If found, assert for a clash of attributes, update
+        #   a. If found, check for a clash of attributes, update
         #   b. If novel, just add the object as is
         for new_obj in graph_item["objects"]:
-            match_found = False
             obj = objects.get(new_obj["id"], None)
 
             if obj:
-                # Assert for existing entries.
-                for attr in new_obj:
-                    try:
-                        assert new_obj[attr] == obj.get(
-                            attr, new_obj[attr]
-                        ), "Some of the attributes do not match!"
-                    except:
-                        pdb.set_trace()
+                # Check existing entries (see validate_source).
+                attr = find_attribute_clash(obj, new_obj)
+                if attr is not None:
+                    raise ValueError(
+                        "Attribute {} of object {} does not match!".format(
+                            attr, new_obj["id"]
+                        )
+                    )
 
                 # Add additional keys.
-                objects[new_obj["id"]].update(new_obj)
+                obj.update(new_obj)
             else:
                 # Add the new object.
-                objects[new_obj["id"]] = new_obj
+                objects[new_obj["id"]] = dict(new_obj)
+            for attr_key in ATTRIBUTE_KEYS:
+                if attr_key in new_obj and new_obj[attr_key] not in known_attrs:
+                    new_attrs.add(new_obj[attr_key])
+        new_attrs.discard("N/A")
+        if new_attrs:
+            known_attrs = known_attrs.union(new_attrs)
 
         # if a relation, update it
+        relation = None
         if "relation" in graph_item:
-            rel = graph_item["relation"]
             ## update it with object 2 id
             id1 = graph_item["objects"][0]["id"]
             id2 = graph_item["objects"][1]["id"]
-            rel_objs = graph["relationships"][rel][id1]
-            rel_objs.append(id2)
-            graph["relationships"][rel][id1] = rel_objs
+            relation = (graph_item["relation"], id1, id2)
+
+        self.turn_deltas.append((tuple(graph_item["objects"]), relation))
+        self.turn_known_attrs.append(known_attrs)
+        # Non-mergeable items appear twice in the turn graphs (kept for
+        # compatibility with the original turn indexing).
+        if not graph_item["mergeable"]:
+            self.turn_deltas.append(((), None))
+            self.turn_known_attrs.append(known_attrs)
+
+    def get_turn_known_attributes(self, turn_id):
+        """Known attributes at a turn, without materializing the scene graph.
 
-        # update objects in graph
-        graph["objects"] = objects
-        self.turn_graphs.append(graph)
-        self.current_graph = graph
+        Args:
+            turn_id: Index of the turn (same indexing as turn_graphs)
+
+        Returns:
+            known_attrs: Set of known attributes
+        """
+        return set(self.turn_known_attrs[turn_id])
 
     def get_known_attributes(self, graph):
         """Extract known attributes from a graph.
@@ -101,7 +193,7 @@ class DialogGraph:
         known_attrs = set()
         for obj_id, obj_attrs in known_objs.items():
             # NOTE: Fix this later.
-            for attr_key in ("shape", "size", "material", "color"):
+            for attr_key in ATTRIBUTE_KEYS:
                 known_attrs.add(obj_attrs.get(attr_key, "N/A"))
         # Remove N/A.
         if "N/A" in known_attrs:
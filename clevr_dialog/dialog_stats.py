@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Dependence and structure statistics of stitched dialogs, kept while stitching.
+
+The plan of a stitched dialog (see dialog.StitchPlan.get_stats) knows where
+each context is split and how the contexts interleave, so that dependence
+distances are known without reading the source and stitched files again (as
+evaluate_dependence does). Statistics of a split are kept as histograms, which
+take constant memory and merge across units of work.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import json
+import os
+
+import numpy as np
+
+
+PERCENTILES = (5, 25, 50, 75, 90, 95, 99)
+# Statistics of each stitched dialog kept as histograms.
+HISTOGRAMS = (
+    "original",
+    "stitched",
+    "increase",
+    "context_switches",
+    "turns_per_context",
+)
+
+
+def get_stats_path(save_root, split):
+    """Path to the statistics of a saved split.
+    """
+    return os.path.join(save_root, "deep_clevr_dialog_{}.stats.json".format(split))
+
+
+def summarize_histogram(histogram):
+    """Summary statistics of integer values, given their histogram.
+
+    Percentiles are interpolated linearly between the sorted values, as
+    numpy.percentile does.
+
+    Args:
+        histogram: Number of occurrences of each value 0, 1, ...
+
+    Returns:
+        summary: Count, mean, standard deviation, minimum, maximum, percentiles
+            and histogram of the values
+    """
+    histogram = np.asarray(histogram, dtype=np.int64)
+    count = int(histogram.sum())
+    if not count:
+        return {"count": 0}
+    values = np.arange(len(histogram))
+    mean = np.dot(values, histogram) / count
+    # Value of each (sorted) rank, around the rank of each percentile.
+    ends = np.cumsum(histogram)
+    ranks = np.asarray(PERCENTILES) / 100 * (count - 1)
+    lower = np.floor(ranks).astype(np.int64)
+    lower_values = np.searchsorted(ends, lower, side="right")
+    upper_values = np.searchsorted(ends, np.minimum(lower + 1, count - 1), side="right")
+    percentiles = lower_values + (ranks - lower) * (upper_values - lower_values)
+    nonzero = np.flatnonzero(histogram)
+    return {
+        "count": count,
+        "mean": float(mean),
+        "std": float(np.sqrt(np.dot((values - mean) ** 2, histogram) / count)),
+        "min": int(nonzero[0]),
+        "max": int(nonzero[-1]),
+        "percentiles": {
+            str(ii): float(vv) for ii, vv in zip(PERCENTILES, percentiles)
+        },
+        "histogram": histogram[: nonzero[-1] + 1].tolist(),
+    }
+
+
+def to_histogram(counter):
+    """Histogram (list) of a Counter over non-negative integers.
+    """
+    histogram = [0] * (max(counter, default=-1) + 1)
+    for value, count in counter.items():
+        histogram[value] = count
+    return histogram
+
+
+class DialogStats:
+    """Histograms of the statistics of the stitched dialogs of a split.
+    """
+
+    def __init__(self):
+        self.num_dialogs = 0
+        self.histograms = {key: collections.Counter() for key in HISTOGRAMS}
+        self.templates = collections.defaultdict(
+            lambda: {key: collections.Counter() for key in ("original", "stitched")}
+        )
+
+    def add(self, stats, turns):
+        """Adds a stitched dialog.
+
+        Args:
+            stats: Statistics of the stitched dialog (see StitchPlan.get_stats)
+            turns: Turns of the stitched dialog, for the templates of the rounds
+        """
+        self.num_dialogs += 1
+        for key in ("original", "stitched", "turns_per_context"):
+            self.histograms[key].update(stats[key])
+        self.histograms["increase"].update(
+            ii - jj for ii, jj in zip(stats["stitched"], stats["original"])
+        )
+        self.histograms["context_switches"][stats["context_switches"]] += 1
+        # Templates without dependent rounds are reported too.
+        for turn in turns:
+            if "caption" not in turn:
+                self.templates[str(turn.get("template", None))]
+        for position, original, stitched in zip(
+            stats["positions"], stats["original"], stats["stitched"]
+        ):
+            template = self.templates[str(turns[position].get("template", None))]
+            template["original"][original] += 1
+            template["stitched"][stitched] += 1
+
+    def to_dict(self):
+        """Histograms, to save or merge into other statistics (see update).
+        """
+        return {
+            "num_dialogs": self.num_dialogs,
+            "histograms": {
+                key: to_histogram(value) for key, value in self.histograms.items()
+            },
+            "templates": {
+                template: {key: to_histogram(value) for key, value in counts.items()}
+                for template, counts in sorted(self.templates.items())
+            },
+        }
+
+    def update(self, state):
+        """Merges statistics saved by to_dict (e.g., of a unit of work).
+        """
+        self.num_dialogs += state["num_dialogs"]
+        for key, histogram in state["histograms"].items():
+            self.histograms[key].update(dict(enumerate(histogram)))
+        for template, histograms in state["templates"].items():
+            for key, histogram in histograms.items():
+                self.templates[template][key].update(dict(enumerate(histogram)))
+
+    def summarize(self):
+        """Distributions of the statistics, as evaluate_dependence reports them
+        (along with the context switches and turns per context).
+        """
+        state = self.to_dict()
+        report = {"num_dialogs": state["num_dialogs"]}
+        for key, histogram in state["histograms"].items():
+            report[key] = summarize_histogram(histogram)
+        report["templates"] = {
+            template: {
+                key: summarize_histogram(histogram)
+                for key, histogram in histograms.items()
+            }
+            for template, histograms in state["templates"].items()
+        }
+        return report
+
+    def save(self, save_path, manifest=None):
+        """Saves the summary and histograms of the statistics (JSON).
+
+        Args:
+            save_path: Path to save the statistics to
+            manifest: Manifest of the files the statistics are of (see
+                DatasetWriter.close), whose names, sizes and checksums are
+                saved along, to check that the statistics are still theirs
+        """
+        files = []
+        if manifest is not None:
+            files = [
+                {key: shard[key] for key in ("file_name", "num_bytes", "sha256")}
+                for shard in manifest["shards"]
+            ]
+        with open(save_path, "w") as file_id:
+            json.dump(
+                {
+                    "summary": self.summarize(),
+                    "histograms": self.to_dict(),
+                    "files": files,
+                },
+                file_id,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    pass
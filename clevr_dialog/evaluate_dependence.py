@@ -15,73 +15,304 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import argparse
 import json
+import multiprocessing
+import os
 import numpy as np
 
+from dataset_writer import get_dataset_files, iter_dataset_file
+from dialog_stats import get_stats_path, summarize_histogram
+from json_stream import iter_json_array
+from segment_store import hash_file
+from triple_keys import get_dialog_key
 
-def main(args):
-    print("Saving: {}".format(args["input_clevr_path"]))
-    with open(args["input_clevr_path"]) as file_id:
-        data = json.load(file_id)
-    clevr = {}
-    for datum in data:
-        key = datum["image_filename"]
+
+# Source file of each split (see merge_dialogs.generate_dataset).
+SPLIT_SOURCES = {
+    "val": "clevr_train_json",
+    "test": "clevr_val_json",
+    "train": "clevr_train_json",
+}
+# Source dependence of each history item, set in the worker processes.
+SOURCE = None
+
+
+def load_source_dependence(json_path):
+    """Flattens the dependence of each history item of the source dialogs.
+
+    Args:
+        json_path: Path to the CLEVR-Dialog JSON file
+
+    Returns:
+        source: Dictionary with the sorted dialog keys (see
+            triple_keys.get_dialog_key), offsets of each dialog into the
+            flat dependence array, and the dependence (-1 for None)
+    """
+    dialog_keys = []
+    lengths = []
+    dependence = []
+    for datum in iter_json_array(json_path):
         for dialog_index, dialog_datum in enumerate(datum["dialogs"]):
-            key = "{}_{}".format(datum["image_filename"], dialog_index)
-            clevr[key] = dialog_datum
+            history = dialog_datum["graph"]["history"]
+            dialog_keys.append(get_dialog_key(datum["image_index"], dialog_index))
+            lengths.append(len(history))
+            for history_item in history:
+                focus_id = history_item.get("dependence", None)
+                dependence.append(-1 if focus_id is None else focus_id)
 
-    print("Saving: {}".format(args["input_deep_clevr_path"]))
-    with open(args["input_deep_clevr_path"]) as file_id:
-        deep_data = json.load(file_id)
-
-    NUM_CONTEXTS = 3
-    clevr_lens = []
-    deep_clevr_lens = []
-    for dialog_datum in deep_data:
-        # Deep index to original index map.
-        index_map = {}
-        index_counts = [0] * NUM_CONTEXTS
-        # CLEVR-Dialog data for each contexts.
-        context_data = {
-            ii: clevr[
-                "{}_{}".format(
-                    dialog_datum["image_filename"][ii], dialog_datum["dialog_index"][ii]
+    dialog_keys = np.asarray(dialog_keys, dtype=np.int64)
+    offsets = np.cumsum([0] + lengths)[:-1]
+    order = np.argsort(dialog_keys, kind="stable")
+    return {
+        "dialog_keys": dialog_keys[order],
+        "offsets": offsets[order],
+        "lengths": np.asarray(lengths, dtype=np.int64)[order],
+        "dependence": np.asarray(dependence, dtype=np.int64),
+    }
+
+
+def flatten_stitched(stitched_dialogs):
+    """Flattens stitched dialogs into integer arrays, one entry per turn.
+
+    Args:
+        stitched_dialogs: Iterable of stitched dialogs
+
+    Returns:
+        turns: Dictionary with the record, position, context index, template
+            id (-1 for captions) of each turn, the dialog keys of the contexts
+            of each record, and the list of templates
+    """
+    turns = {key: [] for key in ("record", "position", "context_index", "template")}
+    sources = []
+    template_ids = {}
+    for record, dialog_datum in enumerate(stitched_dialogs):
+        sources.append((dialog_datum["image_index"], dialog_datum["dialog_index"]))
+        for position, datum in enumerate(dialog_datum["data"]):
+            turns["record"].append(record)
+            turns["position"].append(position)
+            turns["context_index"].append(datum["context_index"])
+            if "caption" in datum:
+                turns["template"].append(-1)
+            else:
+                template = datum.get("template", None)
+                turns["template"].append(
+                    template_ids.setdefault(template, len(template_ids))
                 )
-            ]
-            for ii in range(NUM_CONTEXTS)
-        }
 
-        # Construct mapping between CLEVR-Dialog and CLEVR-Dialog+.
-        for index, datum in enumerate(dialog_datum["data"]):
-            context_index = datum["context_index"]
-            index_map[index] = (context_index, index_counts[context_index])
-            index_counts[context_index] += 1
-        reverse_index_map = {
-            context_index: [
-                (deep_index, mm[1])
-                for deep_index, mm in index_map.items()
-                if mm[0] == context_index
-            ]
-            for context_index in range(NUM_CONTEXTS)
+    turns = {key: np.asarray(value, dtype=np.int64) for key, value in turns.items()}
+    num_contexts = max([len(ii[0]) for ii in sources], default=0)
+    image_index = np.zeros((len(sources), num_contexts), dtype=np.int64)
+    dialog_index = np.zeros((len(sources), num_contexts), dtype=np.int64)
+    for record, (image_ids, dialog_ids) in enumerate(sources):
+        image_index[record, : len(image_ids)] = image_ids
+        dialog_index[record, : len(dialog_ids)] = dialog_ids
+    turns["sources"] = get_dialog_key(image_index, dialog_index)
+    turns["templates"] = sorted(template_ids, key=template_ids.get)
+    return turns
+
+
+def compute_distances(turns, source):
+    """Original and stitched dependence distances of the turns, in one pass.
+
+    A turn at position p of its context (0 being the caption) depends on the
+    round given by the history item p of its source dialog; the distance is
+    measured in the source dialog and in the stitched dialog.
+
+    Args:
+        turns: Flattened stitched dialogs (see flatten_stitched)
+        source: Flattened source dependence (see load_source_dependence)
+
+    Returns:
+        distances: Dictionary with the original and stitched distance, and
+            the template id of each dependent turn
+    """
+    num_contexts = max(turns["sources"].shape[1], 1)
+    groups = turns["record"] * num_contexts + turns["context_index"]
+    # Rank of each turn within its context (group), and start of the group.
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    group_starts = np.searchsorted(sorted_groups, sorted_groups, side="left")
+    starts = np.empty_like(group_starts)
+    starts[order] = group_starts
+    ranks = np.empty_like(group_starts)
+    ranks[order] = np.arange(len(groups)) - group_starts
+
+    # Dependence of the history item of each turn, in its source dialog.
+    dialog_keys = turns["sources"][turns["record"], turns["context_index"]]
+    source_ids = np.searchsorted(source["dialog_keys"], dialog_keys)
+    source_ids = np.minimum(source_ids, max(len(source["dialog_keys"]) - 1, 0))
+    if len(dialog_keys) and np.any(source["dialog_keys"][source_ids] != dialog_keys):
+        raise ValueError("Stitched dialogs not from the source dialogs!")
+    if np.any(ranks >= source["lengths"][source_ids]):
+        raise ValueError("Stitched dialogs longer than the source dialogs!")
+    dependence = source["dependence"][source["offsets"][source_ids] + ranks]
+
+    dependent = (turns["template"] >= 0) & (dependence >= 0)
+    focus_ids = dependence[dependent]
+    original = ranks[dependent] - 1 - focus_ids
+    deep_focus_ids = turns["position"][order[starts[dependent] + focus_ids + 1]]
+    stitched = turns["position"][dependent] - deep_focus_ids
+    assert np.all(original <= stitched), "Something wrong!"
+    return {
+        "original": original,
+        "stitched": stitched,
+        "template": turns["template"][dependent],
+    }
+
+
+def init_worker(source):
+    global SOURCE
+    SOURCE = source
+
+
+def evaluate_file(file_path):
+    """Dependence distances of the stitched dialogs in a file (or shard).
+    """
+    turns = flatten_stitched(iter_dataset_file(file_path))
+    distances = compute_distances(turns, SOURCE)
+    distances["templates"] = turns["templates"]
+    return distances
+
+
+def summarize(distances):
+    """Summary statistics and histogram of dependence distances.
+    """
+    return summarize_histogram(np.bincount(distances))
+
+
+def evaluate_split(file_paths, source, num_workers=1):
+    """Dependence distances of a split, with their distributions.
+
+    Args:
+        file_paths: Files (or shards) of the stitched dialogs of the split
+        source: Flattened source dependence (see load_source_dependence)
+        num_workers: Number of processes, each handling a file at a time
+
+    Returns:
+        report: Distributions of the original and stitched distances, overall
+            and per template
+    """
+    if num_workers > 1 and len(file_paths) > 1:
+        num_workers = min(num_workers, len(file_paths))
+        with multiprocessing.Pool(num_workers, init_worker, (source,)) as pool:
+            results = pool.map(evaluate_file, file_paths)
+    else:
+        init_worker(source)
+        results = [evaluate_file(ii) for ii in file_paths]
+
+    # Map the template ids of each file to a common list.
+    templates = {ii for result in results for ii in result["templates"]}
+    templates = sorted(templates, key=str)
+    template_ids = {template: index for index, template in enumerate(templates)}
+    for result in results:
+        remap = np.array(
+            [template_ids[ii] for ii in result["templates"]], dtype=np.int64
+        )
+        result["template"] = remap[result["template"]]
+    original, stitched, template = [
+        np.concatenate([result[key] for result in results] + [np.zeros(0, np.int64)])
+        for key in ("original", "stitched", "template")
+    ]
+
+    report = {
+        "original": summarize(original),
+        "stitched": summarize(stitched),
+        "increase": summarize(stitched - original),
+        "templates": {},
+    }
+    for template_id, template_name in enumerate(templates):
+        selected = template == template_id
+        report["templates"][str(template_name)] = {
+            "original": summarize(original[selected]),
+            "stitched": summarize(stitched[selected]),
         }
+    return report
 
-        # Go through each datum and map dependence lengths.
-        for index, datum in enumerate(dialog_datum["data"]):
-            context_index = datum["context_index"]
-            clevr_datum = context_data[context_index]
-            if "caption" in datum:
-                continue
 
-            history_item = clevr_datum["graph"]["history"][index_map[index][1]]
-            focus_id = history_item.get("dependence", None)
-            if focus_id is None:
-                continue
-            deep_focus_id = reverse_index_map[context_index][focus_id + 1][0]
+def print_report(report):
+    for key in ("original", "stitched"):
+        summary = report[key]
+        if not summary["count"]:
+            print("{}: no dependent turns".format(key))
+            continue
+        print(
+            "{}: mean {:.4f}, median {}, 95th percentile {}, max {}".format(
+                key,
+                summary["mean"],
+                summary["percentiles"]["50"],
+                summary["percentiles"]["95"],
+                summary["max"],
+            )
+        )
+
+
+def main(args):
+    # Only keep the dependence of each history item from the source dialogs.
+    print("Saving: {}".format(args["input_clevr_path"]))
+    source = load_source_dependence(args["input_clevr_path"])
+
+    print("Saving: {}".format(args["input_deep_clevr_path"]))
+    report = evaluate_split(
+        [args["input_deep_clevr_path"]], source, args["num_workers"]
+    )
+    print(report["original"].get("mean", np.nan))
+    print(report["stitched"].get("mean", np.nan))
+    return report
+
+
+def load_saved_summary(save_root, split):
+    """Summary of the statistics saved with a split (merge_dialogs
+    --dialog_stats), if they are of the files saved now.
+
+    Returns:
+        summary: Summary of the statistics, or None if not saved, or if the
+            files they were computed on are missing or changed since
+    """
+    stats_path = get_stats_path(save_root, split)
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path, "r") as file_id:
+        saved = json.load(file_id)
+    if not saved.get("files", None):
+        print("Statistics without their files: {}".format(stats_path))
+        return None
+    for saved_file in saved["files"]:
+        file_path = os.path.join(save_root, saved_file["file_name"])
+        if (
+            not os.path.exists(file_path)
+            or os.path.getsize(file_path) != saved_file["num_bytes"]
+            or hash_file(file_path) != saved_file["sha256"]
+        ):
+            print("Statistics out of date: {}".format(stats_path))
+            return None
+    print("Loading statistics: {}".format(stats_path))
+    return saved["summary"]
 
-            clevr_lens.append(index_map[index][1] - 1 - focus_id)
-            deep_clevr_lens.append(index - deep_focus_id)
-            assert clevr_lens[-1] <= deep_clevr_lens[-1], "Something wrong!"
-    print(np.mean(clevr_lens))
-    print(np.mean(deep_clevr_lens))
+
+def evaluate_dataset(args):
+    """Evaluates all the splits saved by merge_dialogs.generate_dataset.
+
+    Splits saved with their statistics (merge_dialogs --dialog_stats) are not
+    read again, unless recompute is set or the files changed since.
+    """
+    sources = {}
+    reports = {}
+    for split, source_key in SPLIT_SOURCES.items():
+        if not args.get("recompute", False):
+            reports[split] = load_saved_summary(args["save_root"], split)
+            if reports[split] is not None:
+                print_report(reports[split])
+                continue
+        source_path = args[source_key]
+        if source_path not in sources:
+            print("Reading: {}".format(source_path))
+            sources[source_path] = load_source_dependence(source_path)
+        file_paths = get_dataset_files(args["save_root"], split)
+        print("Evaluating: {}".format(", ".join(file_paths)))
+        reports[split] = evaluate_split(
+            file_paths, sources[source_path], args["num_workers"]
+        )
+        print_report(reports[split])
+    return reports
 
 
 if __name__ == "__main__":
@@ -92,8 +323,36 @@ if __name__ == "__main__":
     parser.add_argument(
         "--input_deep_clevr_path", default=None, help="JSON Deep CLEVR-Dialog file"
     )
+    parser.add_argument(
+        "--clevr_train_json", default=None, help="Path to CLEVR-Dialog train"
+    )
+    parser.add_argument(
+        "--clevr_val_json", default=None, help="Path to CLEVR-Dialog val"
+    )
+    parser.add_argument(
+        "--save_root",
+        default=None,
+        help="Path to the stitched dataset, to evaluate all the splits",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="Number of processes (per shard)"
+    )
+    parser.add_argument(
+        "--save_json_path", default=None, help="Path to save the report (JSON)"
+    )
+    parser.add_argument(
+        "--recompute",
+        action="store_true",
+        help="Evaluate splits again, even if saved with their statistics",
+    )
     try:
         parsed_args = vars(parser.parse_args())
     except (IOError) as msg:
         parser.error(str(msg))
-    main(parsed_args)
+    if parsed_args["save_root"] is not None:
+        evaluation = evaluate_dataset(parsed_args)
+    else:
+        evaluation = main(parsed_args)
+    if parsed_args["save_json_path"] is not None:
+        with open(parsed_args["save_json_path"], "w") as file_id:
+            json.dump(evaluation, file_id, indent=2)
@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Append-only generation of stitched dialogs, as the source dialogs grow.
+
+With merge_dialogs --incremental, the state of each saved split is kept next
+to its files, in deep_clevr_dialog_<split>.state/: the segmented source
+dialogs (see segment_store), the keys of the stitched triples, the manifest of
+the files, and how much of the source was read (number of images, and the
+size and checksum of the bytes they span). Once images are appended to the
+CLEVR-Dialog file, the next run checks that the images read before did not
+change, segments only the new ones (reading from where the others end), and
+stitches as many dialogs as the new dialogs allow, from triples with at least
+one new dialog (see triple_sampler.NewDialogSampler), appending them to the
+files of the split. Such triples were never stitched before.
+
+The next state is staged in deep_clevr_dialog_<split>.state.next/, and only
+replaces the state once the files are saved. A run interrupted before then is
+redone, dropping what it appended to the files (see
+dataset_writer.DatasetWriter).
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import itertools
+import json
+import os
+import shutil
+
+import numpy as np
+
+from dataset_writer import DATASET_PREFIX
+from json_stream import iter_json_array
+from pipeline import NULL_MONITOR
+from run_stats import NULL_STATS
+from segment_store import SegmentStore, build_segment_store, concat_segment_stores
+
+
+# Version of the state format.
+STATE_VERSION = 1
+
+
+def get_state_path(save_root, split, prefix=DATASET_PREFIX):
+    """Path to the state of a split generated incrementally.
+    """
+    return os.path.join(save_root, "{}_{}.state".format(prefix, split))
+
+
+def hash_bytes(checksum, file_path, start, end, chunk_size=1 << 22):
+    """Updates a checksum with the bytes [start, end) of a file.
+    """
+    with open(file_path, "rb") as file_id:
+        file_id.seek(start)
+        while start < end:
+            chunk = file_id.read(min(chunk_size, end - start))
+            if not chunk:
+                raise ValueError("File shorter than expected: {}!".format(file_path))
+            checksum.update(chunk)
+            start += len(chunk)
+
+
+class IncrementalSplit:
+    """State of a split generated incrementally, and its next increment.
+    """
+
+    def __init__(self, save_root, split, prefix=DATASET_PREFIX):
+        """Loads the state of a split, if it was generated before.
+
+        Args:
+            save_root: Folder the split is saved to
+            split: Name of the split
+            prefix: Prefix of the files of the split (see DatasetWriter)
+        """
+        self.state_path = get_state_path(save_root, split, prefix)
+        self.next_path = self.state_path + ".next"
+        self.old_path = self.state_path + ".old"
+        # Complete the swap of states, if interrupted (see commit).
+        next_state_path = os.path.join(self.next_path, "state.json")
+        if not os.path.exists(self.state_path) and os.path.exists(next_state_path):
+            os.rename(self.next_path, self.state_path)
+        if os.path.exists(self.old_path):
+            shutil.rmtree(self.old_path)
+
+        self.state = None
+        state_path = os.path.join(self.state_path, "state.json")
+        if os.path.exists(state_path):
+            with open(state_path, "r") as file_id:
+                self.state = json.load(file_id)
+            if self.state["version"] != STATE_VERSION:
+                raise ValueError("State version mismatch: {}!".format(self.state_path))
+        self.generation = 0 if self.state is None else self.state["generation"] + 1
+        self.config = None
+        self.source = None
+        # Number of source dialogs stitched before, first in the store.
+        self.num_old_dialogs = 0
+
+    def check_config(self, config):
+        """Checks the split was generated with the same arguments.
+
+        Args:
+            config: Arguments the split is stitched with (see
+                merge_dialogs.get_checkpoint_config), but for its source
+        """
+        self.config = {key: value for key, value in config.items() if key != "source"}
+        if self.state is not None and self.state["config"] != self.config:
+            raise ValueError(
+                "Split saved with other arguments: {}!".format(self.state_path)
+            )
+
+    def get_manifest(self):
+        """Manifest of the saved files (see DatasetWriter.close), None if none.
+        """
+        return None if self.state is None else self.state["manifest"]
+
+    def get_num_records(self):
+        """Number of stitched dialogs saved.
+        """
+        return 0 if self.state is None else self.state["manifest"]["num_records"]
+
+    def get_dialog_stats(self):
+        """Statistics of the stitched dialogs saved (see DialogStats.to_dict).
+        """
+        return None if self.state is None else self.state["dialog_stats"]
+
+    def segment(
+        self,
+        json_path,
+        start=0,
+        stop=None,
+        num_workers=1,
+        stats=NULL_STATS,
+        pool=None,
+        monitor=NULL_MONITOR,
+        exclude=None,
+    ):
+        """Segments the images appended to the source since the last increment.
+
+        Args:
+            json_path: Path to the (uncompressed) CLEVR-Dialog JSON file
+            start, stop: Range of images of the split (stop=None for all)
+            num_workers: Number of processes to segment with
+            stats: RunStats to record the time spent reading and segmenting in
+            pool: Pool of (num_workers) processes to segment with, if any
+            monitor: PipelineMonitor to record the stages of segmentation in
+            exclude: Set of keys of dialogs to skip, if any (see
+                validate_source)
+
+        Returns:
+            store_path: Path to the store of the old and then new dialogs,
+                None if no images were appended
+        """
+        if json_path.endswith(".gz"):
+            raise ValueError("Compressed sources cannot be appended to!")
+        if os.path.exists(self.next_path):
+            shutil.rmtree(self.next_path)
+        checksum = hashlib.sha256()
+        if self.state is None:
+            source = {"start": start, "num_images": 0, "num_bytes": 0}
+        else:
+            source = dict(self.state["source"])
+            hash_bytes(checksum, json_path, 0, source["num_bytes"])
+            if source["start"] != start or checksum.hexdigest() != source["sha256"]:
+                raise ValueError(
+                    "Source changed, not only appended to: {}!".format(json_path)
+                )
+        num_images, num_bytes = source["num_images"], source["num_bytes"]
+
+        def iter_new_images():
+            # Read from the end of the last image read.
+            images = iter_json_array(json_path, with_offsets=True, offset=num_bytes)
+            if not num_bytes:
+                images = itertools.islice(images, start, None)
+            if stop is not None:
+                images = itertools.islice(images, max(stop - start - num_images, 0))
+            for image, _, end in images:
+                source["num_images"] += 1
+                source["num_bytes"] = end
+                yield image
+
+        new_path = os.path.join(self.next_path, "new_segments")
+        build_segment_store(
+            iter_new_images(), new_path, num_workers, stats, pool, monitor, exclude
+        )
+        if source["num_images"] == num_images:
+            shutil.rmtree(self.next_path)
+            return None
+        hash_bytes(checksum, json_path, num_bytes, source["num_bytes"])
+        source["file_name"] = os.path.basename(json_path)
+        source["sha256"] = checksum.hexdigest()
+        self.source = source
+
+        store_path = os.path.join(self.next_path, "segments")
+        if self.state is None:
+            os.rename(new_path, store_path)
+        else:
+            old_path = os.path.join(self.state_path, "segments")
+            self.num_old_dialogs = len(SegmentStore(old_path))
+            concat_segment_stores([old_path, new_path], store_path)
+            shutil.rmtree(new_path)
+        return store_path
+
+    def commit(self, manifest, triple_keys, dialog_stats=None):
+        """Saves the state of the split, once its files are saved.
+
+        Args:
+            manifest: Manifest of the files (see DatasetWriter.close)
+            triple_keys: Keys of the triples stitched in this increment (see
+                triple_keys.get_triple_key)
+            dialog_stats: DialogStats of all the stitched dialogs, if any
+        """
+        triple_keys = np.asarray(triple_keys, dtype=np.int64)
+        if self.state is not None:
+            old_keys = np.load(os.path.join(self.state_path, "triple_keys.npy"))
+            triple_keys = np.concatenate([old_keys, triple_keys])
+        np.save(os.path.join(self.next_path, "triple_keys.npy"), np.sort(triple_keys))
+        state = {
+            "version": STATE_VERSION,
+            "generation": self.generation,
+            "config": self.config,
+            "source": self.source,
+            "manifest": manifest,
+            "dialog_stats": None if dialog_stats is None else dialog_stats.to_dict(),
+        }
+        # Written last, marking the next state as complete.
+        with open(os.path.join(self.next_path, "state.json"), "w") as file_id:
+            json.dump(state, file_id, indent=2)
+        if os.path.exists(self.state_path):
+            os.rename(self.state_path, self.old_path)
+        os.rename(self.next_path, self.state_path)
+        if os.path.exists(self.old_path):
+            shutil.rmtree(self.old_path)
+        self.state = state
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Incremental reader for JSON files with a top-level array.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import functools
+import gzip
+import json
+
+
+# Characters read from the file at a time.
+CHUNK_SIZE = 1 << 22
+WHITESPACE = " \t\n\r"
+NUMBER_CHARACTERS = "0123456789+-.eE"
+
+
+def iter_json_array(json_path, chunk_size=CHUNK_SIZE, with_offsets=False, offset=0):
+    """Yields the elements of a top-level JSON array one at a time.
+
+    Only the element being decoded (and the current chunk) is held in memory,
+    e.g., one image with its 5 dialogs for CLEVR-Dialog.
+
+    Args:
+        json_path: Path to the JSON file (gzip compressed if it ends in .gz)
+        chunk_size: Number of characters read from the file at a time
+        with_offsets: Also yield the byte range of each element in the file
+            (not for compressed files)
+        offset: Byte offset to start reading from, the end of an element
+            yielded before (with_offsets)
+
+    Yields:
+        element: Decoded element of the array, or a tuple (element, start,
+            end) with_offsets
+    """
+    decoder = json.JSONDecoder()
+    if offset and not with_offsets:
+        raise ValueError("Offsets are only known with_offsets!")
+    if with_offsets:
+        if json_path.endswith(".gz"):
+            raise ValueError("No byte offsets in compressed files!")
+        # Bytes are read as latin-1 characters, so that character offsets
+        # are byte offsets; elements are decoded from their (UTF-8) bytes.
+        open_file = functools.partial(open, encoding="latin-1", newline="")
+    else:
+        open_file = gzip.open if json_path.endswith(".gz") else open
+    with open_file(json_path, "rt") as file_id:
+        file_id.seek(offset)
+        buffer = ""
+        # Offset of the buffer in the file.
+        buffer_offset = offset
+        position = 0
+        end_of_file = False
+
+        def next_token(position):
+            # Skips whitespace, reading more of the file as needed.
+            nonlocal buffer, buffer_offset, end_of_file
+            while True:
+                while position < len(buffer) and buffer[position] in WHITESPACE:
+                    position += 1
+                if position < len(buffer) or end_of_file:
+                    return position
+                buffer_offset += len(buffer)
+                buffer = file_id.read(chunk_size)
+                end_of_file = not buffer
+                position = 0
+
+        position = next_token(position)
+        token = buffer[position : position + 1]
+        if offset:
+            # Resume after an element.
+            if token == "]":
+                return
+            if token != ",":
+                raise ValueError("Malformed JSON array: {}".format(json_path))
+        elif token != "[":
+            raise ValueError("Expected a JSON array: {}".format(json_path))
+        position = next_token(position + 1)
+        if not offset and buffer[position : position + 1] == "]":
+            return
+
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+                # Numbers may continue in the next chunk.
+                complete = end_of_file or (
+                    end < len(buffer) and buffer[end] not in NUMBER_CHARACTERS
+                )
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+                complete = False
+            if not complete:
+                # Element continues in the next chunk.
+                chunk = file_id.read(chunk_size)
+                end_of_file = not chunk
+                buffer_offset += position
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            if with_offsets:
+                element = json.loads(buffer[position:end].encode("latin-1"))
+                yield element, buffer_offset + position, buffer_offset + end
+            else:
+                yield element
+
+            position = next_token(end)
+            token = buffer[position : position + 1]
+            if token == "]":
+                return
+            if token != ",":
+                raise ValueError("Malformed JSON array: {}".format(json_path))
+            position = next_token(position + 1)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Batched stitching of k compatible dialogs (contexts) at a time, e.g., 4 to 8.
+
+Given a batch of k-tuples of dialogs, the split points (a context recaller of
+each dialog) and the interleaving orders of all the stitched dialogs are
+drawn at once, with vectorized draws. As in Dialog.plan_dialogs, each context
+appears twice, its head (caption and rounds before its split) and then its
+tail, and each turn goes to a context drawn uniformly among the other ones
+not done yet; a context only follows itself when no other one is left. Two
+contexts are stitched A-B-A-B (or A-B-A), as in Dialog.plan_two_dialogs. The
+stitched dialogs of 2 and 3 contexts thus follow the same distribution as
+those of Dialog.plan_dialogs (though not the same random draws).
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import random
+
+import numpy as np
+
+from dialog import StitchPlan
+
+
+# Merge types of two contexts (see Dialog.plan_two_dialogs).
+MERGE_TYPES = ("ABAB", "ABA")
+
+
+def draw_choices(num_choices, rng):
+    """Draws an index uniformly below each number of choices (> 0).
+    """
+    draws = (rng.random(num_choices.shape) * num_choices).astype(np.int64)
+    # Guard against rounding up to num_choices.
+    return np.minimum(draws, num_choices - 1)
+
+
+def draw_splits(dialog_tuples, rng):
+    """Draws a context recaller of each dialog to split it at.
+
+    Args:
+        dialog_tuples: List of k-tuples of Dialog objects after segment_dialog
+        rng: numpy random Generator
+
+    Returns:
+        splits: (N, k) array of the round of each dialog to split at
+    """
+    num_recallers = np.array(
+        [[len(dd.context_recaller) for dd in dialogs] for dialogs in dialog_tuples],
+        dtype=np.int64,
+    )
+    if not num_recallers.all():
+        raise ValueError("Dialogs without context recallers cannot be stitched!")
+    choices = draw_choices(num_recallers, rng).tolist()
+    return np.array(
+        [
+            [dd.context_recaller[ii]["round_id"] for dd, ii in zip(dialogs, row)]
+            for dialogs, row in zip(dialog_tuples, choices)
+        ],
+        dtype=np.int64,
+    )
+
+
+def draw_orders(batch_size, num_contexts, rng):
+    """Draws the interleaving orders of the contexts of a batch.
+
+    Each context appears twice (head, then tail). Each step draws uniformly
+    among the contexts other than the last one that appeared less than twice,
+    and repeats the last one if there are none. Two contexts are A-B-A-B.
+
+    Args:
+        batch_size: Number of stitched dialogs
+        num_contexts: Number of contexts (k) of each stitched dialog
+        rng: numpy random Generator
+
+    Returns:
+        orders: (batch_size, 2 * k) array of context indices
+    """
+    num_steps = 2 * num_contexts
+    if num_contexts == 2:
+        return np.tile(np.array([0, 1, 0, 1], dtype=np.int64), (batch_size, 1))
+    orders = np.empty((batch_size, num_steps), dtype=np.int64)
+    counts = np.zeros((batch_size, num_contexts), dtype=np.int64)
+    current = np.full(batch_size, -1, dtype=np.int64)
+    contexts = np.arange(num_contexts)
+    rows = np.arange(batch_size)
+    for step in range(num_steps):
+        candidates = (counts < 2) & (contexts[None, :] != current[:, None])
+        num_candidates = candidates.sum(axis=1)
+        draws = draw_choices(np.maximum(num_candidates, 1), rng)
+        # Context of the drawn candidate: first with that many candidates.
+        chosen = np.argmax(np.cumsum(candidates, axis=1) > draws[:, None], axis=1)
+        current = np.where(num_candidates > 0, chosen, current)
+        counts[rows, current] += 1
+        orders[:, step] = current
+    return orders
+
+
+def plan_batch(dialog_tuples, rng=None, merge_type="ABAB"):
+    """Plans the stitching of a batch of compatible k-tuples of dialogs.
+
+    Args:
+        dialog_tuples: List of k-tuples of Dialog objects after segment_dialog
+            (same k >= 2 for all), e.g., compatible triples from a sampler
+        rng: numpy random Generator, seeded from the random module if None
+        merge_type: One of the ABA or ABAB merge types, for two contexts
+
+    Returns:
+        plans: List of StitchPlan objects, one per tuple
+    """
+    dialog_tuples = [tuple(ii) for ii in dialog_tuples]
+    if not dialog_tuples:
+        return []
+    num_contexts = len(dialog_tuples[0])
+    if num_contexts < 2 or any(len(ii) != num_contexts for ii in dialog_tuples):
+        raise ValueError("Dialogs need to be k-tuples, for the same k >= 2!")
+    if merge_type not in MERGE_TYPES:
+        raise ValueError("Mergetype invalid!")
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+
+    splits = draw_splits(dialog_tuples, rng).tolist()
+    if num_contexts == 2 and merge_type == "ABA":
+        orders = [[0, 1, 0]] * len(dialog_tuples)
+        for row in splits:
+            # The second dialog is not split.
+            row[1] = None
+    else:
+        orders = draw_orders(len(dialog_tuples), num_contexts, rng).tolist()
+
+    plans = []
+    for dialogs, order, row in zip(dialog_tuples, orders, splits):
+        started = [False] * num_contexts
+        spans = []
+        for context_index in order:
+            if started[context_index]:
+                spans.append((context_index, row[context_index], None))
+            else:
+                spans.append((context_index, 0, row[context_index]))
+                started[context_index] = True
+        plans.append(StitchPlan(dialogs, spans))
+    return plans
+
+
+if __name__ == "__main__":
+    pass
@@ -13,168 +13,980 @@ Author(s): Satwik Kottur
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 import argparse
+import collections
+import contextlib
+import fnmatch
 import json
 import multiprocessing
+import functools
 import os
+import queue
 import random
 from tqdm import tqdm as progressbar
-import sys
+import threading
+import time
+
+import numpy as np
 
 import dialog
+from compatible_triples import CompatibleTriples
+from dataset_writer import (
+    DATASET_PREFIX,
+    OUTPUT_FORMATS,
+    DatasetWriter,
+    truncate_files,
+)
+from dialog_stats import DialogStats, get_stats_path
+from incremental import IncrementalSplit
+from pipeline import PipelineMonitor, ThreadedConsumer
+from record_index import (
+    RecordIndexBuilder,
+    get_index_path,
+    load_index_builder,
+    remove_index,
+)
+from quota_sampler import (
+    QuotaStitcher,
+    get_quota_report_path,
+    load_quotas,
+    merge_quota_reports,
+)
+from run_stats import NULL_STATS, RunStats
+from segment_store import SegmentStore, get_cache_key, hash_file, segmented_split
+from stitch_recipes import RECIPE_PREFIX, RECORD_FORMATS, save_source
+from triple_keys import derive_seed, get_dialog_key, get_partitions, get_triple_key
+from triple_sampler import MAX_DUPLICATES, SAMPLERS, NewDialogSampler
+from validate_source import load_exclusions
 
 
 NUM_VAL_IMGS = 500
+# Stitched dialogs per unit of work; units are seeded and checkpointed on
+# their own, so that the output does not depend on the number of workers.
+UNIT_SIZE = 5000
+# Version of the checkpoint format, to check when resuming.
+CHECKPOINT_VERSION = 1
+# Folder of the checkpoints, created in --checkpoint_root (or --save_root).
+CHECKPOINT_FOLDER = "deep_clevr_dialog_checkpoint"
+# Files of a checkpoint, the only ones ever deleted from its folder.
+CHECKPOINT_FILES = (
+    "config.json",
+    "unit-*.jsonl",
+    "unit-*.jsonl.tmp",
+    "unit-*.summary.json",
+    "*.done.json",
+)
+# Completed units queued to the writer of each split.
+MAX_PENDING_WRITES = 4
+# Triple sampler of the process, of the last segment store (see
+# get_store_sampler).
+STORE_SAMPLERS = {}
 
 
 def main(args):
     print("Reading: {}".format(args["input_json_path"]))
-    with open(args["input_json_path"], "r") as file_id:
-        raw_data = json.load(file_id)
-
-    dialogs = [dialog.Dialog(ii, jj) for ii in raw_data for jj in range(5)]
-    for ii in dialogs:
-        ii.segment_dialog()
+    with segmented_split(args["input_json_path"]) as store_path:
+        dialogs = SegmentStore(store_path)
+        triplets = stitch_dialogs(
+            dialogs, args["num_dialogs"], sampler=args["sampler"]
+        )
 
-    # Get triplets randomly sampled.
-    triplets = {}
-    while len(triplets) < args["num_dialogs"]:
-        dialog_triple = random.sample(dialogs, 3)
-        merged_id = str([(ii.image_index, ii.dialog_index) for ii in dialog_triple])
-        if (
-            dialog.Dialog.check_mergeability(*dialog_triple)
-            and merged_id not in triplets
-        ):
-            triplets[merged_id] = dialog.Dialog.merge_dialogs(*dialog_triple)
-
-            if len(triplets) % 100 == 0:
-                print("Progress: {} / {}".format(len(triplets), args["num_dialogs"]))
-
-    num_dialog = len(dialogs)
-    print("# instances: {}".format(num_dialog))
-    print("# triples: {}".format(
-        num_dialog * (num_dialog - 1) * (num_dialog - 2) // 6)
-    )
-    print("# triples matches: {}".format(len(triplets)))
+        num_dialog = len(dialogs)
+        print("# triples: {}".format(
+            num_dialog * (num_dialog - 1) * (num_dialog - 2) // 6)
+        )
+        if args.get("count_triples", False):
+            count_compatible_triples(
+                dialogs, args["num_dialogs"], dialogs.get_compatibility_index()
+            )
 
     # Save JSON files.
     print("Saving triplets: {}".format(args["save_json_path"]))
     with open(args["save_json_path"], "w") as file_id:
-        json.dump(list(triplets.values()), file_id)
+        json.dump(triplets, file_id)
+
+
+def count_compatible_triples(dialogs, num_dialogs, index=None, stats=NULL_STATS):
+    """Counts the compatible (ordered) triples, checking num_dialogs is feasible.
 
+    Args:
+        dialogs: Sequence of Dialog objects after segment_dialog
+        num_dialogs: Number of stitched dialogs to generate
+        index: CompatibilityIndex over the dialogs, built if not given
+        stats: RunStats to record the time spent counting
 
-def merge_dialogs(dialogs, num_dialogs, random_seed=None):
+    Returns:
+        num_compatible: Number of compatible ordered triples
+    """
+    with stats.stage("counting"):
+        num_compatible = len(CompatibleTriples(dialogs, index, stats=stats))
+    print(
+        "# compatible triples: {} ({:.4%} to stitch)".format(
+            num_compatible, num_dialogs / max(num_compatible, 1)
+        )
+    )
+    if num_dialogs > num_compatible:
+        raise ValueError(
+            "Only {} compatible triples, cannot stitch {} dialogs!".format(
+                num_compatible, num_dialogs
+            )
+        )
+    return num_compatible
+
+
+def merge_dialogs(dialogs, num_dialogs, random_seed=None, sampler="signature"):
     """Given a list of dialogs, randomly sample and merge.
+
+    Args:
+        dialogs: Raw CLEVR-Dialog data (list of images with 5 dialogs each)
+        num_dialogs: Number of stitched dialogs to generate
+        random_seed: Seed for the random number generator
+        sampler: Name of the triple sampler (see triple_sampler.SAMPLERS)
     """
     dialogs = [dialog.Dialog(ii, jj) for ii in dialogs for jj in range(5)]
     for ii in dialogs:
-        ii.segment_dialog()
-    if random_seed:
+        ii.segment_dialog(keep_graphs=False)
+    return stitch_dialogs(dialogs, num_dialogs, random_seed, sampler)
+
+
+def stitch_dialogs(dialogs, num_dialogs, random_seed=None, sampler="signature"):
+    """Given segmented dialogs, randomly sample and merge.
+
+    Args:
+        dialogs: Sequence of Dialog objects after segment_dialog
+        num_dialogs: Number of stitched dialogs to generate
+        random_seed: Seed for the random number generator
+        sampler: Name of the triple sampler (see triple_sampler.SAMPLERS)
+    """
+    stitched = iter_stitched_dialogs(dialogs, num_dialogs, random_seed, sampler)
+    return [plan.materialize() for plan in stitched]
+
+
+def iter_stitched_dialogs(
+    dialogs,
+    num_dialogs,
+    random_seed=None,
+    sampler="signature",
+    index=None,
+    partition=None,
+    stats=NULL_STATS,
+):
+    """Given segmented dialogs, randomly sample and merge.
+
+    Stitched dialogs are yielded as they are produced, as StitchPlan objects
+    to materialize when saving; only the keys of the triples are kept, to
+    avoid duplicates.
+
+    Args:
+        dialogs: Sequence of Dialog objects after segment_dialog
+        num_dialogs: Number of stitched dialogs to generate
+        random_seed: Seed for the random number generator
+        sampler: Name of the triple sampler (see triple_sampler.SAMPLERS)
+        index: CompatibilityIndex over the dialogs, built if not given
+        partition: Tuple (partition_id, num_partitions) to only generate the
+            triples owned by one partition (see triple_keys.get_partitions)
+        stats: RunStats to record the time spent sampling and merging, and
+            the number of sampled, accepted and duplicate triples
+    """
+    if random_seed is not None:
         random.seed(random_seed)
 
+    owned = None
+    if partition is not None:
+        partition_id, num_partitions = partition
+        owned = get_partitions(get_dialog_keys(dialogs), num_partitions) == partition_id
+
     # Get triplets randomly sampled.
-    triplets = {}
+    with stats.stage("sampler_setup"):
+        triple_sampler = SAMPLERS[sampler](dialogs, index, owned, stats=stats)
     with progressbar(total=num_dialogs) as pbar:
-        while len(triplets) < num_dialogs:
-            dialog_triple = random.sample(dialogs, 3)
-            merged_id = str([(ii.image_index, ii.dialog_index) for ii in dialog_triple])
-            # merged_id not in triplets
-            if dialog.Dialog.check_mergeability(*dialog_triple):
-                triplets[merged_id] = dialog.Dialog.merge_dialogs(*dialog_triple)
-                pbar.update(1)
+        for plan in iter_stitch_plans(triple_sampler, num_dialogs, stats):
+            yield plan
+            pbar.update(1)
     print("# instances: {}".format(len(dialogs)))
-    print("# triples matches: {}".format(len(triplets)))
-    return list(triplets.values())
+    print("# triples matches: {}".format(num_dialogs))
+    print(
+        "Rejection sampling acceptance rate: {:.4f}".format(
+            triple_sampler.get_acceptance_rate()
+        )
+    )
 
 
-def worker(dialogs, num_dialogs, worker_seed, worker_id, out_queue):
-    out_queue.put({worker_id: merge_dialogs(dialogs, num_dialogs, worker_seed)})
+def iter_stitch_plans(triple_sampler, num_dialogs, stats=NULL_STATS):
+    """Yields the plans of num_dialogs distinct triples drawn from a sampler.
 
+    Raises a ValueError if the sampler has fewer distinct triples: while one
+    in (k + 1) triples at least is left after finding k of them, drawing
+    MAX_DUPLICATES * (k + 1) duplicates in a row is below e^-MAX_DUPLICATES
+    likely.
+    """
+    num_sampled = triple_sampler.num_sampled
+    num_accepted = triple_sampler.num_accepted
+    triplets = set()
+    num_duplicates = 0
+    num_repeated = 0
+    while len(triplets) < num_dialogs:
+        with stats.stage("sampling"):
+            dialog_triple = triple_sampler.sample()
+        merged_id = get_triple_key(dialog_triple)
+        if merged_id in triplets:
+            num_duplicates += 1
+            num_repeated += 1
+            if num_repeated > MAX_DUPLICATES * (len(triplets) + 1):
+                raise ValueError(
+                    "Only {} distinct triples to stitch {} dialogs from!".format(
+                        len(triplets), num_dialogs
+                    )
+                )
+            continue
+        num_repeated = 0
+        triplets.add(merged_id)
+        with stats.stage("merging"):
+            plan = dialog.Dialog.plan_dialogs(*dialog_triple)
+        yield plan
+    stats.count("sampled", triple_sampler.num_sampled - num_sampled)
+    stats.count("accepted", triple_sampler.num_accepted - num_accepted)
+    stats.count("duplicate", num_duplicates)
+    stats.count("generated", len(triplets))
 
-def merge_dialog_wrapper(source_data, num_dialogs, args):
-    """Wrapper around merging dialogs.
+
+def get_dialog_keys(dialogs):
+    """Dialog keys (see triple_keys.get_dialog_key) for a sequence of dialogs.
     """
+    if isinstance(dialogs, SegmentStore):
+        return dialogs.get_dialog_keys()
+    return np.array(
+        [get_dialog_key(ii.image_index, ii.dialog_index) for ii in dialogs],
+        dtype=np.int64,
+    )
 
-    def get_label(dialog):
-        return "_".join(
-            [str(ii) for ii in dialog["image_index"]]
-            + [str(ii) for ii in dialog["dialog_index"]]
-        )
 
-    print("Starting the threads:")
-    # Multithread version.
-    output_q = multiprocessing.Queue()
-    jobs = []
-    for worker_id in range(args["num_workers"]):
-        num_dialogs_worker = num_dialogs // args["num_workers"]
-        inputs = (
-            source_data,
-            num_dialogs_worker,
-            random.randrange(sys.maxsize),
-            worker_id,
-            output_q,
+def get_store_sampler(store_path, sampler, num_old_dialogs=0, stats=NULL_STATS):
+    """Triple sampler over a segment store, built once per process.
+
+    Only the sampler of the last store is kept: units of a split are stitched
+    in a row, and the samplers (and mapped stores) of the splits before are
+    released, rather than kept for the lifetime of the process as their
+    stores are deleted.
+
+    Args:
+        store_path: Path to the segmented dialogs (see segment_store)
+        sampler: Name of the sampler (see SAMPLERS)
+        num_old_dialogs: Number of dialogs stitched before (see incremental),
+            first in the store and never drawn first
+        stats: RunStats to record the time spent building the sampler
+
+    Returns:
+        triple_sampler: Sampler over all the dialogs of the store
+        dialog_keys: Keys of the dialogs, to partition them
+    """
+    key = (store_path, sampler, num_old_dialogs)
+    if key not in STORE_SAMPLERS:
+        STORE_SAMPLERS.clear()
+        store = SegmentStore(store_path)
+        owned = None
+        if num_old_dialogs:
+            owned = np.arange(len(store)) >= num_old_dialogs
+        triple_sampler = SAMPLERS[sampler](
+            store, store.get_compatibility_index(), owned, stats=stats
         )
-        process = multiprocessing.Process(target=worker, args=inputs)
-        jobs.append(process)
-        process.start()
-    # Wait for all the jobs to finish and collect the output.
-    final_results = {}
-    for _ in jobs:
-        final_results.update(output_q.get())
-    for job in jobs:
-        job.join()
+        STORE_SAMPLERS[key] = (triple_sampler, store.get_dialog_keys())
+    return STORE_SAMPLERS[key]
 
-    concat_dialogs = [jj for ii in final_results.values() for jj in ii]
-    total_dials = len(concat_dialogs)
-    unique_dials = len(set(get_label(ii) for ii in concat_dialogs))
-    overlap_percent = (total_dials - unique_dials) / total_dials * 100
-    print("Generated: {}".format(total_dials))
-    print("Overlap: {} \%".format(overlap_percent))
-    return concat_dialogs
 
+def get_work_units(
+    split, store_path, num_dialogs, args, checkpoint_path, increment=None
+):
+    """Splits the stitching of a split into units of work.
 
-def generate_dataset(args):
-    print("Reading: {}".format(args["clevr_train_json"]))
-    with open(args["clevr_train_json"], "r") as file_id:
-        train_data = json.load(file_id)
+    Units have a fixed size, each owns a partition of the triples (by first
+    dialog, see triple_keys.get_partitions) and has its own seed, so that the
+    stitched dialogs only depend on the seed and unit size, not on which
+    worker stitches which unit. Units of later increments (see incremental)
+    are seeded by increment, and only stitch triples with a new dialog.
 
-    print("Reading: {}".format(args["clevr_val_json"]))
-    with open(args["clevr_val_json"], "r") as file_id:
-        val_data = json.load(file_id)
+    Args:
+        split: Name of the split
+        store_path: Path to the segmented dialogs (see segment_store)
+        num_dialogs: Number of stitched dialogs to generate
+        args: Command line arguments
+        checkpoint_path: Folder to save the stitched dialogs of each unit to
+        increment: IncrementalSplit of the split, if generated incrementally
 
-    # Each image contains 5 dialogs, 3 dialogs are merged together.
-    collection = [
-        {
-            "split": "val",
-            "source": train_data[:NUM_VAL_IMGS],
-            "num_dialogs": NUM_VAL_IMGS * 5 // 3,
-        },
-        {
-            "split": "test",
-            "source": val_data,
-            "num_dialogs": len(val_data) * 5 // 3,
-        },
+    Returns:
+        units: List of units (dictionaries), see stitch_unit
+    """
+    unit_size = args.get("unit_size", UNIT_SIZE)
+    num_units = -(-num_dialogs // unit_size)
+    seed_parts = (args.get("random_seed", 0), split)
+    if increment is not None and increment.generation:
+        seed_parts += (increment.generation,)
+    return [
         {
-            "split": "train",
-            "source": train_data[NUM_VAL_IMGS:],
-            "num_dialogs": (len(train_data) - NUM_VAL_IMGS) * 5 // 3,
-        },
+            "split": split,
+            "store_path": store_path,
+            "sampler": args["sampler"],
+            "unit_id": unit_id,
+            "num_units": num_units,
+            "num_dialogs": min(unit_size, num_dialogs - unit_id * unit_size),
+            "seed": derive_seed(*seed_parts, unit_id),
+            "save_path": os.path.join(
+                checkpoint_path, "unit-{:05d}.jsonl".format(unit_id)
+            ),
+            "run_report": args.get("run_report", False),
+            "dialog_stats": args.get("dialog_stats", False),
+            "record_format": args.get("record_format", "dialog"),
+            "quotas": args.get("quotas", None),
+            "index": args.get("index", False),
+            "incremental": increment is not None,
+            "num_old_dialogs": 0 if increment is None else increment.num_old_dialogs,
+        }
+        for unit_id in range(num_units)
     ]
-    for split_info in collection:
-        if args["num_workers"] > 1:
-            data_triplets = merge_dialog_wrapper(
-                split_info["source"], split_info["num_dialogs"], args
+
+
+def check_work_units(units, store_path, num_old_dialogs=0):
+    """Checks that the partition of each unit of work has enough triples.
+
+    A unit with num_dialogs to stitch needs as many distinct triples in its
+    partition (one with quotas), which too small a unit size leaves short,
+    as the dialogs are partitioned into as many partitions as units. Bounds
+    the triples of each partition by those of an owned first dialog and two
+    others compatible with it, from the counts saved with the store (see
+    segment_store.save_num_compatible), before stitching any unit.
+
+    Args:
+        units: Units of work of a split (see get_work_units)
+        store_path: Path to the segmented dialogs (see segment_store)
+        num_old_dialogs: Number of dialogs stitched before (see incremental)
+    """
+    if not units:
+        return
+    store = SegmentStore(store_path)
+    index = store.get_compatibility_index()
+    num_compatible = index.num_compatible
+    if num_compatible is None:
+        num_compatible = index.count_compatible()
+    # Dialogs drawn first: the new ones, with a context recaller.
+    first = index.valid & (np.arange(len(store)) >= num_old_dialogs)
+    num_compatible = np.asarray(num_compatible, dtype=np.float64)[first]
+    num_units = len(units)
+    partitions = get_partitions(store.get_dialog_keys()[first], num_units)
+    num_triples = np.bincount(
+        partitions, num_compatible * (num_compatible - 1), minlength=num_units
+    )
+    for unit in units:
+        num_needed = 1 if unit["quotas"] is not None else unit["num_dialogs"]
+        if num_triples[unit["unit_id"]] < num_needed:
+            raise ValueError(
+                "Unit {} of {} of {} has {:.0f} triples to stitch {} dialogs "
+                "from, use a larger --unit_size!".format(
+                    unit["unit_id"],
+                    num_units,
+                    unit["split"],
+                    num_triples[unit["unit_id"]],
+                    unit["num_dialogs"],
+                )
             )
+
+
+def stitch_unit(unit):
+    """Stitches the dialogs of a unit of work, saving them as JSON Lines.
+
+    The file is only renamed into place when complete, so that existing
+    files are completed units. Stitched dialogs are saved in full, or as
+    recipes (see stitch_recipes). With dialog_stats, the statistics of each
+    stitched dialog are saved with it, and their histograms (see
+    dialog_stats.DialogStats) in a summary next to the file. With quotas,
+    stitching stops once the quotas of the unit are met (see quota_sampler),
+    and the summary reports how much of each was filled. With index, the
+    summary lists the source dialogs of each stitched dialog, to index them
+    (see record_index). Incrementally, it lists the keys of the triples, and
+    only triples with a dialog after the num_old_dialogs first are stitched.
+
+    Args:
+        unit: Unit of work (see get_work_units)
+
+    Returns:
+        report: Split and id of the unit, its wall time, and its RunStats
+            report (if any)
+    """
+    start_time = time.perf_counter()
+    stats = RunStats() if unit["run_report"] else NULL_STATS
+    with stats.stage("sampler_setup"):
+        triple_sampler, dialog_keys = get_store_sampler(
+            unit["store_path"], unit["sampler"], unit["num_old_dialogs"], stats
+        )
+        triple_sampler.stats = stats
+        owned = get_partitions(dialog_keys, unit["num_units"]) == unit["unit_id"]
+        if unit["num_old_dialogs"]:
+            new = np.arange(len(dialog_keys)) >= unit["num_old_dialogs"]
+            triple_sampler = NewDialogSampler(triple_sampler, dialog_keys, new, owned)
+        else:
+            triple_sampler.set_owned(owned)
+
+    random.seed(unit["seed"])
+    dialog_stats = DialogStats() if unit["dialog_stats"] else None
+    source_keys = []
+    triple_keys = []
+    if unit["quotas"] is not None:
+        quota_stitcher = QuotaStitcher(
+            triple_sampler, unit["quotas"], unit["num_dialogs"], stats=stats
+        )
+        plans = quota_stitcher.iter_plans()
+    else:
+        plans = (
+            (plan, None)
+            for plan in iter_stitch_plans(triple_sampler, unit["num_dialogs"], stats)
+        )
+    temp_path = unit["save_path"] + ".tmp"
+    with open(temp_path, "w") as file_id:
+        for plan, stratum in plans:
+            with stats.stage("materialize"):
+                if unit["record_format"] == "recipe":
+                    record = plan.to_recipe()
+                else:
+                    record = plan.materialize()
+            if stratum is not None:
+                record["stratum"] = stratum
+            if unit["index"]:
+                source_keys.append(get_dialog_keys(plan.dialogs).tolist())
+            if unit["incremental"]:
+                triple_keys.append(get_triple_key(plan.dialogs))
+            if dialog_stats is not None:
+                with stats.stage("dialog_stats"):
+                    record["stats"] = plan.get_stats()
+                    turns = record.get("data", None) or plan.materialize_turns()
+                    dialog_stats.add(record["stats"], turns)
+            with stats.stage("checkpoint"):
+                file_id.write(json.dumps(record) + "\n")
+    summary = {}
+    if dialog_stats is not None:
+        summary["dialog_stats"] = dialog_stats.to_dict()
+    if unit["quotas"] is not None:
+        summary["quotas"] = quota_stitcher.get_report()
+    if unit["index"]:
+        summary["source_keys"] = source_keys
+    if unit["incremental"]:
+        summary["triple_keys"] = triple_keys
+    with open(get_unit_summary_path(unit["save_path"]), "w") as file_id:
+        json.dump(summary, file_id)
+    os.replace(temp_path, unit["save_path"])
+    return {
+        "split": unit["split"],
+        "unit_id": unit["unit_id"],
+        "wall_seconds": time.perf_counter() - start_time,
+        "stats": stats.to_dict(),
+    }
+
+
+def get_unit_summary_path(unit_path):
+    """Path to the summary (statistics, quotas) of the stitched dialogs of a unit.
+    """
+    return os.path.splitext(unit_path)[0] + ".summary.json"
+
+
+def save_completed_units(split_state):
+    """Queues the completed units of a split that are next in order.
+
+    Units complete in any order; they are written in order (by the writer
+    thread of the split, see write_split), as soon as all the previous ones
+    are. Once all are, the split is queued to be closed.
+
+    Args:
+        split_state: Dictionary with the units of the split, the number of
+            units already queued, and the writer thread
+    """
+    units = split_state["units"]
+    while split_state["num_saved"] < len(units):
+        unit = units[split_state["num_saved"]]
+        if not os.path.exists(unit["save_path"]):
+            return
+        split_state["writer"].put(unit["save_path"])
+        split_state["num_saved"] += 1
+    if not split_state["saved"]:
+        split_state["writer"].put(None)
+        split_state["saved"] = True
+
+
+def write_split(split_state, args, unit_path):
+    """Writes the stitched dialogs of a unit to the files of its split.
+
+    The files are opened on first use (to append to, incrementally);
+    unit_path=None closes them, saves the statistics, quotas, index and state
+    of the split (if any), and marks the split as saved (removing its
+    checkpoint).
+    """
+    record_format = args.get("record_format", "dialog")
+    prefix = RECIPE_PREFIX if record_format == "recipe" else DATASET_PREFIX
+    increment = split_state["increment"]
+    if split_state["dataset_writer"] is None:
+        manifest = None if increment is None else increment.get_manifest()
+        if split_state["record_index"] is not None and manifest is not None:
+            # Index the saved records, as of the manifest.
+            truncate_files(args["save_root"], manifest)
+            split_state["record_index"] = load_index_builder(
+                args["save_root"], split_state["split"], prefix
+            )
+        split_state["dataset_writer"] = DatasetWriter(
+            args["save_root"],
+            split_state["split"],
+            args["output_format"],
+            args["num_shards"],
+            args["compress"],
+            prefix,
+            manifest,
+        )
+    writer = split_state["dataset_writer"]
+    record_index = split_state["record_index"]
+    if unit_path is not None:
+        with open(get_unit_summary_path(unit_path), "r") as file_id:
+            summary = json.load(file_id)
+        with split_state["stats"].stage("serialization"):
+            with open(unit_path, "r") as file_id:
+                for record_id, line in enumerate(file_id):
+                    location = writer.write_json(line.rstrip("\n"))
+                    if record_index is not None:
+                        record_index.add(location, summary["source_keys"][record_id])
+        if split_state["dialog_stats"] is not None:
+            split_state["dialog_stats"].update(summary["dialog_stats"])
+        if "quotas" in summary:
+            split_state["quota_reports"].append(summary["quotas"])
+        if "triple_keys" in summary:
+            split_state["triple_keys"].extend(summary["triple_keys"])
+        return
+
+    manifest = writer.close()
+    print(
+        "Saved {} triplets: {}".format(
+            writer.num_records, ", ".join(writer.file_paths)
+        )
+    )
+    # Summaries of files saved before, which are not saved again, are removed
+    # rather than left to describe the files just saved.
+    index_path = get_index_path(args["save_root"], split_state["split"], prefix)
+    if record_index is not None:
+        print("Saving index: {}".format(index_path))
+        record_index.save(index_path, writer.file_paths)
+    elif os.path.exists(index_path):
+        print("Removing stale index: {}".format(index_path))
+        remove_index(index_path)
+    if record_format == "recipe":
+        split_info = split_state["split_info"]
+        save_source(
+            args["save_root"],
+            split_state["split"],
+            split_info["source"],
+            split_info.get("start", 0),
+            split_info.get("stop", None),
+            split_info.get("exclude", None),
+        )
+    stats_path = get_stats_path(args["save_root"], split_state["split"])
+    if split_state["dialog_stats"] is not None:
+        print("Saving statistics: {}".format(stats_path))
+        split_state["dialog_stats"].save(stats_path, manifest)
+    elif os.path.exists(stats_path):
+        print("Removing stale statistics: {}".format(stats_path))
+        os.remove(stats_path)
+    report_path = get_quota_report_path(args["save_root"], split_state["split"])
+    if args.get("quotas", None) is not None:
+        quota_report = merge_quota_reports(split_state["quota_reports"])
+        for name, stratum in quota_report["strata"].items():
+            if stratum["unfillable"]:
+                print(
+                    "Stratum {} of {} unfillable: {} of {} stitched".format(
+                        name, split_state["split"], stratum["filled"], stratum["quota"]
+                    )
+                )
+        print("Saving quotas: {}".format(report_path))
+        with open(report_path, "w") as file_id:
+            json.dump(quota_report, file_id, indent=2)
+    elif os.path.exists(report_path):
+        print("Removing stale quotas: {}".format(report_path))
+        os.remove(report_path)
+    if increment is not None:
+        print("Saving state: {}".format(increment.state_path))
+        increment.commit(
+            manifest, split_state["triple_keys"], split_state["dialog_stats"]
+        )
+    with open(split_state["done_path"], "w") as file_id:
+        json.dump(split_state["config"], file_id, indent=2)
+    clear_checkpoint(split_state["checkpoint_path"], remove=True)
+
+
+def get_checkpoint_config(split_info, args):
+    """Arguments a checkpoint of a split depends on, to check when resuming.
+    """
+    return {
+        "version": CHECKPOINT_VERSION,
+        "source": get_cache_key(
+            split_info["source"],
+            split_info.get("start", 0),
+            split_info.get("stop", None),
+            split_info.get("exclude", None),
+        ),
+        "sampler": args["sampler"],
+        "random_seed": args.get("random_seed", 0),
+        "unit_size": args.get("unit_size", UNIT_SIZE),
+        "output_format": args["output_format"],
+        "num_shards": args["num_shards"],
+        "compress": args["compress"],
+        "dialog_stats": args.get("dialog_stats", False),
+        "record_format": args.get("record_format", "dialog"),
+        "quotas": args.get("quotas", None),
+        "index": args.get("index", False),
+    }
+
+
+def clear_checkpoint(checkpoint_path, remove=False):
+    """Deletes the checkpoint files in a folder (see CHECKPOINT_FILES).
+
+    Other files are never deleted: a folder with any refuses to be cleared.
+    Subfolders (checkpoints of the splits, in the root) are cleared in turn.
+
+    Args:
+        checkpoint_path: Folder of the checkpoint (of a split, or the root)
+        remove: Also remove the folder, once empty
+    """
+    if not os.path.isdir(checkpoint_path):
+        return
+    file_names = []
+    others = []
+    for file_name in os.listdir(checkpoint_path):
+        if os.path.isdir(os.path.join(checkpoint_path, file_name)):
+            clear_checkpoint(os.path.join(checkpoint_path, file_name), remove=True)
+        elif any(fnmatch.fnmatch(file_name, ii) for ii in CHECKPOINT_FILES):
+            file_names.append(file_name)
         else:
-            data_triplets = merge_dialogs(
-                split_info["source"], split_info["num_dialogs"]
+            others.append(file_name)
+    if others:
+        raise ValueError(
+            "Not a checkpoint, refusing to clear: {} (has {})!".format(
+                checkpoint_path, ", ".join(sorted(others)[:3])
             )
-        # Save JSON files.
-        save_path = os.path.join(
-            args["save_root"], "deep_clevr_dialog_{}.json".format(split_info["split"])
         )
-        print("Saving triplets: {}".format(save_path))
-        with open(save_path, "w") as file_id:
-            json.dump(data_triplets, file_id)
+    for file_name in file_names:
+        os.remove(os.path.join(checkpoint_path, file_name))
+    if remove:
+        os.rmdir(checkpoint_path)
+
+
+def open_checkpoint(checkpoint_path, config, resume=False):
+    """Prepares the checkpoint folder of a split.
+
+    When resuming, the folder is kept (completed units are skipped) after
+    checking it was saved with the same arguments; otherwise it is cleared.
+    """
+    config_path = os.path.join(checkpoint_path, "config.json")
+    if resume and os.path.exists(config_path):
+        with open(config_path, "r") as file_id:
+            if json.load(file_id) != config:
+                raise ValueError(
+                    "Checkpoint from other arguments: {}!".format(checkpoint_path)
+                )
+        return
+    clear_checkpoint(checkpoint_path)
+    os.makedirs(checkpoint_path, exist_ok=True)
+    with open(config_path, "w") as file_id:
+        json.dump(config, file_id, indent=2)
+
+
+def prepare_split(split_info, args, pool, monitor, stack):
+    """Segments a split, and splits its stitching into units of work.
+
+    Args:
+        split_info: Dictionary with the split, its source and range of images
+        args: Command line arguments
+        pool: Pool of processes to segment with, if any
+        monitor: PipelineMonitor to record the stages of segmentation in
+        stack: ExitStack to keep the segmented dialogs in until done
+
+    Returns:
+        split_state: Dictionary with the units of the split and the state of
+            its saving, None for a split already saved (when resuming) or
+            without new images (incrementally)
+    """
+    split = split_info["split"]
+    stats = RunStats() if args.get("run_report", False) else NULL_STATS
+    checkpoint_root = get_checkpoint_root(args)
+    config = get_checkpoint_config(split_info, args)
+    increment = None
+    if args.get("incremental", False):
+        record_format = args.get("record_format", "dialog")
+        increment = IncrementalSplit(
+            args["save_root"],
+            split,
+            RECIPE_PREFIX if record_format == "recipe" else DATASET_PREFIX,
+        )
+        increment.check_config(config)
+        config["generation"] = increment.generation
+    # Splits already saved are skipped when resuming.
+    done_path = os.path.join(checkpoint_root, "{}.done.json".format(split))
+    if args.get("resume", False) and os.path.exists(done_path):
+        with open(done_path, "r") as file_id:
+            if json.load(file_id) == config:
+                print("Skipping saved split: {}".format(split))
+                return None
+    # Segment once, shared by all the workers through a memory-mapped store.
+    # Source images are streamed and segmented as they are read.
+    print("Reading: {}".format(split_info["source"]))
+    if increment is None:
+        print("Segmenting dialogs: {}".format(split))
+        store_path = stack.enter_context(
+            segmented_split(
+                split_info["source"],
+                split_info.get("start", 0),
+                split_info.get("stop", None),
+                args["num_workers"],
+                args["cache_root"],
+                args["save_root"],
+                stats,
+                pool,
+                monitor,
+                split_info.get("exclude", None),
+            )
+        )
+        num_dialogs = len(SegmentStore(store_path)) // 3
+    else:
+        # Only the new images are segmented, after the saved ones.
+        print("Segmenting new dialogs: {}".format(split))
+        store_path = increment.segment(
+            split_info["source"],
+            split_info.get("start", 0),
+            split_info.get("stop", None),
+            args["num_workers"],
+            stats,
+            pool,
+            monitor,
+            split_info.get("exclude", None),
+        )
+        if store_path is None:
+            print("No new images for split: {}".format(split))
+            return None
+        num_dialogs = max(
+            len(SegmentStore(store_path)) // 3 - increment.get_num_records(), 0
+        )
+    if args.get("count_triples", False):
+        store = SegmentStore(store_path)
+        count_compatible_triples(
+            store, num_dialogs, store.get_compatibility_index(), stats
+        )
+
+    checkpoint_path = os.path.join(checkpoint_root, split)
+    units = get_work_units(
+        split, store_path, num_dialogs, args, checkpoint_path, increment
+    )
+    check_work_units(
+        units, store_path, 0 if increment is None else increment.num_old_dialogs
+    )
+    open_checkpoint(checkpoint_path, dict(config, split=split), args.get("resume"))
+    dialog_stats = DialogStats() if args.get("dialog_stats", False) else None
+    if dialog_stats is not None and increment is not None:
+        if increment.get_dialog_stats() is not None:
+            dialog_stats.update(increment.get_dialog_stats())
+    return {
+        "split": split,
+        "split_info": split_info,
+        "config": config,
+        "done_path": done_path,
+        "checkpoint_path": checkpoint_path,
+        "units": units,
+        "num_dialogs": num_dialogs,
+        "stats": stats,
+        "unit_reports": [],
+        "num_saved": 0,
+        "saved": False,
+        "writer": None,
+        "dataset_writer": None,
+        "dialog_stats": dialog_stats,
+        "quota_reports": [],
+        "record_index": RecordIndexBuilder() if args.get("index", False) else None,
+        "increment": increment,
+        "triple_keys": [],
+    }
+
+
+def segment_splits(collection, args, pool, monitor, events, finished):
+    """Segments the splits in turn, posting each to events once ready.
+
+    Runs in a background thread, so that the units of a split are stitched
+    while the next splits are read and segmented. The segmented dialogs are
+    kept until finished is set.
+    """
+    try:
+        with contextlib.ExitStack() as stack:
+            for split_info in collection:
+                if finished.is_set():
+                    break
+                split_state = prepare_split(split_info, args, pool, monitor, stack)
+                if split_state is not None:
+                    events.put(("split", split_state))
+            events.put(("segmented", None))
+            finished.wait()
+    except BaseException as error:
+        events.put(("error", error))
+
+
+def get_checkpoint_root(args):
+    """Folder of the checkpoints of a run, only ever holding checkpoints.
+    """
+    root = args.get("checkpoint_root", None) or args["save_root"]
+    return os.path.join(root, CHECKPOINT_FOLDER)
+
+
+def generate_dataset(args):
+    """Stitches the val, test and train splits, as a pipeline of stages.
+
+    Stages run concurrently: reading the source (in a thread), segmenting
+    (in the pool), writing the segmented dialogs (in a thread), stitching
+    units of work (in the pool) and writing each split (in a thread per
+    split), connected by bounded queues.
+    """
+    # Each image contains 5 dialogs, 3 dialogs are merged together.
+    collection = [
+        {"split": "val", "source": args["clevr_train_json"], "stop": NUM_VAL_IMGS},
+        {"split": "test", "source": args["clevr_val_json"]},
+        {"split": "train", "source": args["clevr_train_json"], "start": NUM_VAL_IMGS},
+    ]
+    # Dialogs found invalid (see validate_source), matched by source content.
+    exclusions = load_exclusions(args.get("exclusions", None) or [])
+    if exclusions:
+        for split_info in collection:
+            split_info["exclude"] = exclusions.get(hash_file(split_info["source"]))
+            if split_info["exclude"] is None:
+                print("No exclusions for: {}".format(split_info["source"]))
+    num_workers = args["num_workers"]
+    start_time = time.perf_counter()
+    split_states = collections.OrderedDict()
+    monitor = PipelineMonitor()
+    monitor.add_stage("read")
+    monitor.add_stage("segment", num_workers)
+    monitor.add_stage("store")
+    monitor.add_stage("stitch", num_workers)
+    # Units submitted to the pool and not completed yet.
+    running = collections.Counter()
+    monitor.add_queue("stitch", lambda: running["units"])
+    events = queue.Queue()
+    finished = threading.Event()
+    with monitor, contextlib.ExitStack() as stack:
+        # A single pool for the whole run, to segment and stitch all splits.
+        pool = None
+        if num_workers > 1:
+            pool = stack.enter_context(multiprocessing.Pool(num_workers))
+        segmenter = threading.Thread(
+            target=segment_splits,
+            args=(collection, args, pool, monitor, events, finished),
+            daemon=True,
+        )
+        segmenter.start()
+
+        def submit(unit):
+            running["units"] += 1
+            if pool is None:
+                events.put(("unit", stitch_unit(unit)))
+                return
+            pool.apply_async(
+                stitch_unit,
+                (unit,),
+                callback=lambda report: events.put(("unit", report)),
+                error_callback=lambda error: events.put(("error", error)),
+            )
+
+        try:
+            segmenting = True
+            with progressbar(total=0) as pbar:
+                while segmenting or running["units"]:
+                    event, value = events.get()
+                    if event == "error":
+                        raise value
+                    if event == "segmented":
+                        segmenting = False
+                    elif event == "split":
+                        # Stitch the units of the split not checkpointed yet,
+                        # largest first, as the next splits are segmented.
+                        split_state = split_states[value["split"]] = value
+                        split_state["writer"] = ThreadedConsumer(
+                            functools.partial(write_split, split_state, args),
+                            MAX_PENDING_WRITES,
+                            "write_{}".format(value["split"]),
+                            monitor,
+                        )
+                        units = split_state["units"]
+                        pending = [
+                            ii for ii in units if not os.path.exists(ii["save_path"])
+                        ]
+                        pending.sort(key=lambda unit: unit["num_dialogs"], reverse=True)
+                        pbar.write(
+                            "Stitching {} units of work of {} ({} checkpointed)".format(
+                                len(units), value["split"], len(units) - len(pending)
+                            )
+                        )
+                        pbar.total += len(units)
+                        pbar.update(len(units) - len(pending))
+                        save_completed_units(split_state)
+                        for unit in pending:
+                            submit(unit)
+                    else:
+                        running["units"] -= 1
+                        split_state = split_states[value["split"]]
+                        split_state["unit_reports"].append(value)
+                        monitor.add_busy("stitch", value["wall_seconds"])
+                        save_completed_units(split_state)
+                        pbar.update(1)
+            for split_state in split_states.values():
+                split_state["writer"].close()
+        finally:
+            finished.set()
+            # Sampler of the units stitched without a pool, whose store is
+            # deleted with the segmented dialogs.
+            STORE_SAMPLERS.clear()
+        segmenter.join()
+
+    # Only kept to resume an incomplete run.
+    clear_checkpoint(get_checkpoint_root(args), remove=True)
+    monitor.print_summary()
+    if args.get("run_report", False):
+        split_reports = {
+            split: get_split_report(state["stats"].to_dict(), state["unit_reports"])
+            for split, state in split_states.items()
+        }
+        report = {
+            "config": args,
+            "wall_seconds": time.perf_counter() - start_time,
+            "splits": split_reports,
+            "total": RunStats.merge(
+                [ii["total"] for ii in split_reports.values()]
+            ),
+            "pipeline": monitor.to_dict(),
+        }
+        report_path = os.path.join(
+            args["save_root"], "deep_clevr_dialog_run_report.json"
+        )
+        print("Saving run report: {}".format(report_path))
+        with open(report_path, "w") as file_id:
+            json.dump(report, file_id, indent=2)
+
+
+def get_split_report(main_report, unit_reports=None):
+    """Run report of a split, aggregated over the main process and units.
+
+    Args:
+        main_report: Report of the main process (see RunStats.to_dict)
+        unit_reports: Reports of the units of work (see stitch_unit), if any
+
+    Returns:
+        report: Reports of the main process and each unit, and their
+            aggregate ("total")
+    """
+    unit_reports = sorted(unit_reports or [], key=lambda report: report["unit_id"])
+    for report in unit_reports:
+        report["dialogs_per_second"] = report["stats"]["counters"].get(
+            "generated", 0
+        ) / max(report["stats"]["wall_seconds"], 1e-9)
+    total = RunStats.merge([main_report] + [ii["stats"] for ii in unit_reports])
+    total["wall_seconds"] = main_report["wall_seconds"]
+    generated = total["counters"].get("generated", 0)
+    total["dialogs_per_second"] = generated / max(total["wall_seconds"], 1e-9)
+    return {"main": main_report, "units": unit_reports, "total": total}
 
 
 if __name__ == "__main__":
@@ -189,9 +1001,102 @@ if __name__ == "__main__":
     parser.add_argument(
         "--num_workers", type=int, default=4, help="Number of workers to merge"
     )
+    parser.add_argument(
+        "--sampler",
+        default="signature",
+        choices=sorted(SAMPLERS),
+        help="Sampler for compatible triples (rejection is the original loop)",
+    )
+    parser.add_argument(
+        "--cache_root",
+        default=None,
+        help="Path to cache segmented dialogs, reused across runs",
+    )
+    parser.add_argument(
+        "--output_format",
+        default="json",
+        choices=OUTPUT_FORMATS,
+        help="Save a JSON list per split, or (sharded) JSON Lines",
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=1, help="Number of JSON Lines shards"
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Index the records of each split, for random access",
+    )
+    parser.add_argument(
+        "--record_format",
+        default="dialog",
+        choices=RECORD_FORMATS,
+        help="Save stitched dialogs in full, or as recipes (see stitch_recipes)",
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="Compress the output with gzip"
+    )
+    parser.add_argument(
+        "--run_report",
+        action="store_true",
+        help="Time each stage and save a run report next to the output",
+    )
+    parser.add_argument(
+        "--count_triples",
+        action="store_true",
+        help="Count the compatible triples of each split (must be enough)",
+    )
+    parser.add_argument(
+        "--dialog_stats",
+        action="store_true",
+        help="Save dependence and structure statistics of each stitched dialog",
+    )
+    parser.add_argument(
+        "--quotas",
+        default=None,
+        help="Path to the JSON strata to stitch towards (see quota_sampler)",
+    )
+    parser.add_argument(
+        "--random_seed", type=int, default=0, help="Seed of the stitched dialogs"
+    )
+    parser.add_argument(
+        "--unit_size",
+        type=int,
+        default=UNIT_SIZE,
+        help="Stitched dialogs per unit of work (seeded and checkpointed)",
+    )
+    parser.add_argument(
+        "--checkpoint_root",
+        default=None,
+        help="Path to checkpoint units of work in (<save_root> by default)",
+    )
+    parser.add_argument(
+        "--exclusions",
+        nargs="+",
+        default=None,
+        help="Paths to the dialogs to skip, per source (see validate_source)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Append dialogs stitched from new source images (see incremental)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted run, skipping checkpointed units",
+    )
 
     try:
         parsed_args = vars(parser.parse_args())
     except (IOError) as msg:
         parser.error(str(msg))
+    if parsed_args["index"] and parsed_args["compress"]:
+        parser.error("Compressed files cannot be indexed!")
+    if parsed_args["incremental"]:
+        if parsed_args["quotas"] is not None:
+            parser.error("Quotas cannot be met incrementally!")
+        if parsed_args["compress"] and parsed_args["output_format"] == "json":
+            parser.error("Compressed JSON cannot be appended to, use jsonl!")
+    if parsed_args["quotas"] is not None:
+        parsed_args["quotas"] = load_quotas(parsed_args["quotas"])
     generate_dataset(parsed_args)
@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Online stitching of CLEVR-Dialog dialogs, e.g., to augment while training.
+
+Dialogs are segmented once; stitched dialogs are then produced on demand, in
+chunks, by background processes that prefetch a bounded number of chunks
+ahead of the consumer. Each chunk is seeded from (seed, epoch, worker, chunk),
+so that the stream is reproducible whatever the number of processes.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import contextlib
+import functools
+import itertools
+import multiprocessing
+import random
+import time
+
+from dialog import Dialog
+from segment_store import SegmentStore, imap_bounded, segmented_split
+from triple_keys import derive_seed, get_partitions, get_triple_key
+from triple_sampler import MAX_DUPLICATES, SAMPLERS
+
+
+# Number of stitched dialogs per chunk (the unit of work and of seeding).
+CHUNK_SIZE = 64
+# Triple sampler of a background process, set by init_sampler.
+SAMPLER = None
+
+
+def get_chunk_seed(seed, epoch, worker_id, chunk_id):
+    """Seed of a chunk of stitched dialogs, given its position in the stream.
+    """
+    return derive_seed(seed, epoch, worker_id, chunk_id)
+
+
+def build_sampler(store_path, sampler="signature", worker_id=0, num_workers=1):
+    """Triple sampler over a segment store, for one (data loader) worker.
+
+    With several workers, each only draws the triples whose first dialog it
+    owns (see triple_keys.get_partitions), so that workers do not overlap.
+    """
+    store = SegmentStore(store_path)
+    owned = None
+    if num_workers > 1:
+        owned = get_partitions(store.get_dialog_keys(), num_workers) == worker_id
+    return SAMPLERS[sampler](store, store.get_compatibility_index(), owned)
+
+
+def init_sampler(*args):
+    global SAMPLER
+    SAMPLER = build_sampler(*args)
+
+
+def stitch_chunk(chunk, triple_sampler=None):
+    """Stitches a chunk of distinct triples, seeded independently of others.
+
+    The state of the random module is restored afterwards, so that stitching
+    in the calling process does not affect its other random draws.
+
+    Raises a ValueError if the sampler has fewer distinct triples than the
+    chunk size (see merge_dialogs.iter_stitch_plans).
+
+    Args:
+        chunk: Tuple (chunk_seed, chunk_size)
+        triple_sampler: Sampler to draw triples from (that of the background
+            process by default, see init_sampler)
+
+    Returns:
+        stitched: List of stitched dialogs
+    """
+    chunk_seed, chunk_size = chunk
+    if triple_sampler is None:
+        triple_sampler = SAMPLER
+    random_state = random.getstate()
+    random.seed(chunk_seed)
+    try:
+        triplets = set()
+        stitched = []
+        num_repeated = 0
+        while len(stitched) < chunk_size:
+            dialog_triple = triple_sampler.sample()
+            merged_id = get_triple_key(dialog_triple)
+            if merged_id in triplets:
+                # Fewer distinct triples than the chunk size, almost surely.
+                num_repeated += 1
+                if num_repeated > MAX_DUPLICATES * (len(triplets) + 1):
+                    raise ValueError(
+                        "Only {} distinct triples to stitch {} dialogs from!".format(
+                            len(triplets), chunk_size
+                        )
+                    )
+                continue
+            num_repeated = 0
+            triplets.add(merged_id)
+            stitched.append(Dialog.merge_dialogs(*dialog_triple))
+        return stitched
+    finally:
+        random.setstate(random_state)
+
+
+class OnlineStitcher:
+    """Iterator over freshly stitched dialogs, prefetched in the background.
+
+    Stitched dialogs of an epoch are the concatenation of chunks, each drawn
+    with its own seed (see get_chunk_seed); they only depend on the seed, the
+    epoch, the worker and the chunk size. Triples are distinct within a chunk,
+    and drawn independently across chunks.
+    """
+
+    def __init__(
+        self,
+        store_path,
+        seed=0,
+        sampler="signature",
+        worker_id=0,
+        num_workers=1,
+        num_processes=1,
+        chunk_size=CHUNK_SIZE,
+        max_prefetch=4,
+    ):
+        """Initializes the stitcher; processes are started on first use.
+
+        Args:
+            store_path: Path to the segmented dialogs (see segment_store)
+            seed: Seed of the stitched dialogs
+            sampler: Name of the triple sampler (see triple_sampler.SAMPLERS)
+            worker_id, num_workers: (Data loader) worker consuming the
+                stitched dialogs, and number of such workers
+            num_processes: Number of background processes stitching; with 0,
+                stitch in the calling process (e.g., in a daemonic data loader
+                worker, which cannot start processes)
+            chunk_size: Number of stitched dialogs per chunk
+            max_prefetch: Maximum number of chunks stitched ahead of the
+                consumer, which bounds the memory used
+        """
+        self.store_path = store_path
+        self.seed = seed
+        self.sampler = sampler
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.num_processes = num_processes
+        self.chunk_size = chunk_size
+        self.max_prefetch = max(max_prefetch, 1)
+        self.pool = None
+        self.stitch_chunk = None
+
+    def start(self):
+        """Loads the segmented dialogs, in the background processes if any.
+        """
+        if self.stitch_chunk is not None:
+            return
+        sampler_args = (self.store_path, self.sampler, self.worker_id, self.num_workers)
+        if self.num_processes > 0:
+            self.pool = multiprocessing.Pool(
+                self.num_processes, init_sampler, sampler_args
+            )
+            self.stitch_chunk = stitch_chunk
+        else:
+            self.stitch_chunk = functools.partial(
+                stitch_chunk, triple_sampler=build_sampler(*sampler_args)
+            )
+
+    def close(self):
+        """Stops the background processes, dropping prefetched chunks.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.stitch_chunk = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_epoch(self, epoch, num_dialogs=None):
+        """Iterates over the stitched dialogs of an epoch.
+
+        Args:
+            epoch: Epoch number, to get fresh stitched dialogs each epoch
+            num_dialogs: Number of stitched dialogs (unlimited if None)
+
+        Returns:
+            stitched: Iterator over stitched dialogs, as generate_dataset saves
+        """
+        self.start()
+        if num_dialogs is None:
+            chunk_ids = itertools.count()
+        else:
+            chunk_ids = range(-(-num_dialogs // self.chunk_size))
+        chunks = (
+            (get_chunk_seed(self.seed, epoch, self.worker_id, ii), self.chunk_size)
+            for ii in chunk_ids
+        )
+        if self.pool is not None:
+            stitched_chunks = imap_bounded(
+                self.pool, self.stitch_chunk, chunks, self.max_prefetch
+            )
+        else:
+            stitched_chunks = map(self.stitch_chunk, chunks)
+        stitched = itertools.chain.from_iterable(stitched_chunks)
+        return itertools.islice(stitched, num_dialogs)
+
+
+@contextlib.contextmanager
+def online_stitching(json_path, start=0, stop=None, cache_root=None, **kwargs):
+    """Segments (images [start, stop) of) a CLEVR-Dialog file once, and yields
+    an OnlineStitcher over it; kwargs are passed to OnlineStitcher.
+    """
+    with segmented_split(json_path, start, stop, cache_root=cache_root) as path:
+        with OnlineStitcher(path, **kwargs) as stitcher:
+            yield stitcher
+
+
+def main(args):
+    print("Reading: {}".format(args["input_json_path"]))
+    with online_stitching(
+        args["input_json_path"],
+        cache_root=args["cache_root"],
+        seed=args["random_seed"],
+        sampler=args["sampler"],
+        num_processes=args["num_processes"],
+    ) as stitcher:
+        for epoch in range(args["num_epochs"]):
+            start_time = time.perf_counter()
+            num_stitched = 0
+            for _ in stitcher.iter_epoch(epoch, args["num_dialogs"]):
+                num_stitched += 1
+            wall_time = time.perf_counter() - start_time
+            print(
+                "Epoch {}: {} stitched dialogs, {:.0f} dialogs/s".format(
+                    epoch, num_stitched, num_stitched / max(wall_time, 1e-9)
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--input_json_path", required=True, help="Path to CLEVR-Dialog JSON file"
+    )
+    parser.add_argument(
+        "--num_dialogs", type=int, default=10000, help="Stitched dialogs per epoch"
+    )
+    parser.add_argument("--num_epochs", type=int, default=2, help="Number of epochs")
+    parser.add_argument("--random_seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        default=2,
+        help="Number of background processes stitching",
+    )
+    parser.add_argument(
+        "--sampler",
+        default="signature",
+        choices=sorted(SAMPLERS),
+        help="Sampler for compatible triples",
+    )
+    parser.add_argument(
+        "--cache_root",
+        default=None,
+        help="Path to cache segmented dialogs, reused across runs",
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)
@@ -0,0 +1,316 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Stages of a pipeline running concurrently, connected by bounded queues.
+
+Reading and writing run in threads, and CPU bound stages in processes. The
+busy time of each stage and the depth of each queue are monitored, to find
+the stage that bottlenecks the pipeline: its utilization is high, and the
+queue before it full.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import contextlib
+import inspect
+import queue
+import threading
+import time
+
+
+# Interval between samples of the depth of the queues.
+QUEUE_SAMPLE_SECONDS = 0.05
+# Interval at which a producer waiting on a full queue checks whether the
+# consumer stopped.
+STOP_CHECK_SECONDS = 0.1
+# Marks the end of the items of a queue.
+END_OF_QUEUE = object()
+
+
+class PipelineMonitor:
+    """Busy time of the stages of a pipeline, and depth of its queues.
+
+    Thread safe; queues are sampled in a background thread while running.
+    """
+
+    enabled = True
+
+    def __init__(self, sample_seconds=QUEUE_SAMPLE_SECONDS):
+        self.sample_seconds = sample_seconds
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.queues = collections.OrderedDict()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_time = None
+        self.end_time = None
+
+    def add_stage(self, name, num_workers=1):
+        """Declares a stage, run by a number of workers (threads or processes).
+        """
+        with self.lock:
+            self.stages.setdefault(
+                name, {"num_workers": num_workers, "busy_seconds": 0.0, "items": 0}
+            )
+
+    def add_busy(self, name, seconds, items=1):
+        """Adds time a stage spent working on items (e.g., in another process).
+        """
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {"num_workers": 1, "busy_seconds": 0.0, "items": 0}
+            self.stages[name]["busy_seconds"] += seconds
+            self.stages[name]["items"] += items
+
+    @contextlib.contextmanager
+    def busy(self, name, items=1):
+        """Context to time a stage working on items.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_busy(name, time.perf_counter() - start_time, items)
+
+    def add_queue(self, name, get_depth, capacity=None):
+        """Declares a queue between stages, whose depth is given by get_depth.
+        """
+        with self.lock:
+            self.queues[name] = {
+                "get_depth": get_depth,
+                "capacity": capacity,
+                "num_samples": 0,
+                "total_depth": 0,
+                "max_depth": 0,
+            }
+
+    def remove_queue(self, name):
+        """Stops sampling a queue (its statistics are kept).
+        """
+        with self.lock:
+            self.queues[name]["get_depth"] = None
+
+    def sample_queues(self):
+        while not self.stopped.wait(self.sample_seconds):
+            with self.lock:
+                for stats in self.queues.values():
+                    if stats["get_depth"] is None:
+                        continue
+                    depth = stats["get_depth"]()
+                    stats["num_samples"] += 1
+                    stats["total_depth"] += depth
+                    stats["max_depth"] = max(stats["max_depth"], depth)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.sample_queues, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.end_time = time.perf_counter()
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def to_dict(self):
+        """Utilization (fraction of busy time of the workers) of each stage,
+        and mean and maximum depth of each queue.
+        """
+        end_time = self.end_time or time.perf_counter()
+        wall_time = max(end_time - (self.start_time or end_time), 1e-9)
+        with self.lock:
+            stages = {
+                name: dict(
+                    stage,
+                    utilization=stage["busy_seconds"]
+                    / (wall_time * max(stage["num_workers"], 1)),
+                )
+                for name, stage in self.stages.items()
+            }
+            queues = {
+                name: {
+                    "capacity": stats["capacity"],
+                    "mean_depth": stats["total_depth"] / max(stats["num_samples"], 1),
+                    "max_depth": stats["max_depth"],
+                }
+                for name, stats in self.queues.items()
+            }
+        return {"wall_seconds": wall_time, "stages": stages, "queues": queues}
+
+    def print_summary(self):
+        report = self.to_dict()
+        for name, stage in report["stages"].items():
+            print(
+                "Stage {}: {:.0%} utilization of {} worker(s), {} items".format(
+                    name, stage["utilization"], stage["num_workers"], stage["items"]
+                )
+            )
+        for name, stats in report["queues"].items():
+            print(
+                "Queue {}: mean depth {:.1f}, max {} (capacity {})".format(
+                    name, stats["mean_depth"], stats["max_depth"], stats["capacity"]
+                )
+            )
+
+
+class NullMonitor:
+    """Drop-in for PipelineMonitor that records nothing.
+    """
+
+    enabled = False
+    null_context = contextlib.nullcontext()
+
+    def add_stage(self, name, num_workers=1):
+        pass
+
+    def add_busy(self, name, seconds, items=1):
+        pass
+
+    def busy(self, name, items=1):
+        return self.null_context
+
+    def add_queue(self, name, get_depth, capacity=None):
+        pass
+
+    def remove_queue(self, name):
+        pass
+
+
+NULL_MONITOR = NullMonitor()
+
+
+def iter_in_thread(iterable, max_pending, name, monitor=NULL_MONITOR):
+    """Iterates over an iterable in a background thread, max_pending ahead.
+
+    Items are produced (e.g., read from disk) while the consumer works on the
+    previous ones. Errors of the producer are raised to the consumer. If the
+    consumer stops early, the producer stops too, closing the iterable (e.g.,
+    its files) if it is a generator.
+
+    Args:
+        iterable: Iterable to produce the items
+        max_pending: Capacity of the queue of produced items
+        name: Name of the producing stage (and of its queue)
+        monitor: PipelineMonitor to record the busy time and queue depth in
+    """
+    items = queue.Queue(max_pending)
+    stopped = threading.Event()
+    monitor.add_stage(name)
+    monitor.add_queue(name, items.qsize, max_pending)
+
+    def put(entry):
+        # Waits for room in the queue, unless the consumer stopped.
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=STOP_CHECK_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = None
+        try:
+            iterator = iter(iterable)
+            while not stopped.is_set():
+                with monitor.busy(name):
+                    item = next(iterator, END_OF_QUEUE)
+                if item is END_OF_QUEUE:
+                    put((END_OF_QUEUE, None))
+                    return
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((None, error))
+        finally:
+            if inspect.isgenerator(iterator):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is END_OF_QUEUE:
+                break
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+        monitor.remove_queue(name)
+
+
+class ThreadedConsumer:
+    """Consumes items in a background thread, in order, through a bounded queue.
+
+    put blocks while the queue is full, so that a slow consumer (e.g., writing
+    to disk) holds back the producer. Errors of the consumer are raised on
+    the next put, or on close.
+    """
+
+    def __init__(self, consume, max_pending, name, monitor=NULL_MONITOR):
+        """Starts the consumer thread.
+
+        Args:
+            consume: Function called on each item
+            max_pending: Capacity of the queue of items to consume
+            name: Name of the consuming stage (and of its queue)
+            monitor: PipelineMonitor to record the busy time and queue depth
+        """
+        self.consume = consume
+        self.name = name
+        self.monitor = monitor
+        self.items = queue.Queue(max_pending)
+        self.error = None
+        monitor.add_queue(name, self.items.qsize, max_pending)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.items.get()
+            if item is END_OF_QUEUE:
+                return
+            if self.error is not None:
+                continue
+            try:
+                with self.monitor.busy(self.name):
+                    self.consume(item)
+            except BaseException as error:
+                self.error = error
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item):
+        self.raise_error()
+        self.items.put(item)
+
+    def close(self):
+        """Waits for all the items to be consumed.
+        """
+        self.items.put(END_OF_QUEUE)
+        self.thread.join()
+        self.monitor.remove_queue(self.name)
+        self.raise_error()
+
+
+if __name__ == "__main__":
+    pass
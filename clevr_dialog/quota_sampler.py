@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Stitching towards quotas of strata of stitched dialogs.
+
+Strata are declared in a JSON file, e.g.,
+
+    {
+        "strata": [
+            {"name": "far", "fraction": 0.5, "min_distance": 8},
+            {"name": "abab", "fraction": 0.3, "merge_type": "ABAB"},
+            {"name": "count", "fraction": 0.2, "templates": {"count-all": 2}}
+        ],
+        "max_attempts": 1000
+    }
+
+where each stratum takes a fraction of the stitched dialogs, with a merge type
+(three dialogs by default, ABAB or ABA for two), a minimum distance of the
+farthest dependent round in the stitched dialog, and minimum numbers of rounds
+of some templates. Each stitched dialog is drawn for an under-filled stratum
+(in proportion to what is left of its quota): split points (from the context
+recallers) and interleaving orders are drawn again for the same dialogs until
+the plan falls in an under-filled stratum, instead of discarding the dialogs.
+Stitching stops as soon as all the quotas are met; strata that cannot be
+filled (max_attempts draws in a row without a plan for them) are reported.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import json
+import os
+import random
+
+from dialog import Dialog, StitchPlan
+from run_stats import NULL_STATS
+from triple_keys import get_triple_key
+
+
+# Number of dialogs stitched by each merge type.
+MERGE_TYPES = {"three": 3, "ABAB": 2, "ABA": 2}
+# Draws in a row without a plan for a stratum before it is deemed unfillable.
+MAX_ATTEMPTS = 1000
+# Plans drawn for the same dialogs before drawing other dialogs.
+MAX_PLANS = 8
+
+
+def load_quotas(json_path):
+    """Loads and checks the strata of quotas.
+
+    Args:
+        json_path: Path to the JSON file of strata (see module docstring)
+
+    Returns:
+        quotas: Dictionary with the list of strata (with the defaults filled
+            in) and max_attempts
+    """
+    with open(json_path, "r") as file_id:
+        quotas = json.load(file_id)
+    strata = []
+    for stratum in quotas["strata"]:
+        stratum = dict(
+            {"merge_type": "three", "min_distance": 0, "templates": {}}, **stratum
+        )
+        if stratum["merge_type"] not in MERGE_TYPES:
+            raise ValueError("Merge type invalid: {}!".format(stratum["merge_type"]))
+        if stratum["fraction"] <= 0:
+            raise ValueError("Fraction must be positive: {}!".format(stratum["name"]))
+        strata.append(stratum)
+    names = [ii["name"] for ii in strata]
+    if not strata or len(set(names)) != len(names):
+        raise ValueError("Strata need distinct names: {}!".format(names))
+    return {
+        "strata": strata,
+        "max_attempts": quotas.get("max_attempts", MAX_ATTEMPTS),
+    }
+
+
+def allocate_quotas(strata, num_dialogs):
+    """Splits num_dialogs across strata, in proportion to their fractions.
+
+    Counts are rounded by largest remainder, so that they sum to num_dialogs.
+    """
+    fractions = [ii["fraction"] for ii in strata]
+    shares = [num_dialogs * ii / sum(fractions) for ii in fractions]
+    counts = [int(ii) for ii in shares]
+    order = sorted(range(len(strata)), key=lambda ii: counts[ii] - shares[ii])
+    for ii in order[: num_dialogs - sum(counts)]:
+        counts[ii] += 1
+    return counts
+
+
+def get_quota_report_path(save_root, split):
+    """Path to the report of the quotas of a saved split.
+    """
+    return os.path.join(save_root, "deep_clevr_dialog_{}.quotas.json".format(split))
+
+
+def merge_quota_reports(reports):
+    """Merges the reports of the quotas of units of work (see get_report).
+    """
+    merged = {"num_attempts": 0, "num_duplicates": 0, "strata": {}}
+    for report in reports:
+        merged["num_attempts"] += report["num_attempts"]
+        merged["num_duplicates"] += report["num_duplicates"]
+        for name, stratum in report["strata"].items():
+            total = merged["strata"].setdefault(
+                name, {"quota": 0, "filled": 0, "unfillable": False}
+            )
+            total["quota"] += stratum["quota"]
+            total["filled"] += stratum["filled"]
+            total["unfillable"] |= stratum["unfillable"]
+    return merged
+
+
+class QuotaStitcher:
+    """Plans stitched dialogs until the quotas of all strata are met.
+    """
+
+    def __init__(
+        self,
+        triple_sampler,
+        quotas,
+        num_dialogs,
+        max_plans=MAX_PLANS,
+        stats=NULL_STATS,
+    ):
+        """Initializes the quotas.
+
+        Args:
+            triple_sampler: Sampler of compatible triples (see triple_sampler);
+                merge types of two dialogs stitch the first two of a triple
+            quotas: Strata and max_attempts (see load_quotas)
+            num_dialogs: Number of stitched dialogs, split across strata
+            max_plans: Plans drawn for the same dialogs before drawing others
+            stats: RunStats to record the time spent sampling and merging in
+        """
+        self.triple_sampler = triple_sampler
+        self.strata = quotas["strata"]
+        self.max_attempts = quotas["max_attempts"]
+        self.max_plans = max_plans
+        self.stats = stats
+        self.counts = allocate_quotas(self.strata, num_dialogs)
+        self.filled = [0] * len(self.strata)
+        # Draws in a row without a plan for each stratum.
+        self.failures = [0] * len(self.strata)
+        self.unfillable = [False] * len(self.strata)
+        self.num_attempts = 0
+        self.num_duplicates = 0
+
+    def get_open_strata(self):
+        """Strata not filled yet, and not deemed unfillable.
+        """
+        return [
+            ii
+            for ii in range(len(self.strata))
+            if self.filled[ii] < self.counts[ii] and not self.unfillable[ii]
+        ]
+
+    @staticmethod
+    def plan_dialogs(dialogs, merge_type):
+        """Draws split points and an interleaving order for the dialogs.
+        """
+        if merge_type == "three":
+            spans = Dialog.plan_three_dialogs(*dialogs)
+        else:
+            spans = Dialog.plan_two_dialogs(*dialogs, merge_type=merge_type)
+        return StitchPlan(tuple(dialogs), spans)
+
+    @staticmethod
+    def count_templates(dialogs):
+        """Number of rounds of each template in the dialogs (in any plan).
+        """
+        templates = collections.Counter()
+        for dialog in dialogs:
+            templates.update(ii.get("template", None) for ii in dialog.data["dialog"])
+        return templates
+
+    def match(self, stratum, plan, templates):
+        """Whether a plan falls in a stratum (of its merge type).
+        """
+        for template, min_count in stratum["templates"].items():
+            if templates[template] < min_count:
+                return False
+        if stratum["min_distance"] > 0:
+            distances = plan.get_stats()["stitched"]
+            if max(distances, default=0) < stratum["min_distance"]:
+                return False
+        return True
+
+    def iter_plans(self):
+        """Yields the planned stitched dialogs, with the name of their stratum.
+        """
+        planned = set()
+        while True:
+            open_strata = self.get_open_strata()
+            if not open_strata:
+                return
+            # Aim for a stratum in proportion to what is left of its quota.
+            target = random.choices(
+                open_strata, [self.counts[ii] - self.filled[ii] for ii in open_strata]
+            )[0]
+            merge_type = self.strata[target]["merge_type"]
+            self.num_attempts += 1
+            with self.stats.stage("sampling"):
+                dialog_triple = self.triple_sampler.sample()
+            dialogs = dialog_triple[: MERGE_TYPES[merge_type]]
+            planned_id = (merge_type, get_triple_key(dialogs))
+            stratum_id = None
+            if planned_id in planned:
+                self.num_duplicates += 1
+            else:
+                # Strata of the same merge type the plans could also fill.
+                candidates = [target] + [
+                    ii
+                    for ii in open_strata
+                    if ii != target and self.strata[ii]["merge_type"] == merge_type
+                ]
+                templates = self.count_templates(dialogs)
+                with self.stats.stage("merging"):
+                    for _ in range(self.max_plans):
+                        plan = self.plan_dialogs(dialogs, merge_type)
+                        for candidate in candidates:
+                            if self.match(self.strata[candidate], plan, templates):
+                                stratum_id = candidate
+                                break
+                        if stratum_id is not None:
+                            break
+
+            if stratum_id is None:
+                self.failures[target] += 1
+                if self.failures[target] >= self.max_attempts:
+                    self.unfillable[target] = True
+                continue
+            planned.add(planned_id)
+            self.filled[stratum_id] += 1
+            self.failures[stratum_id] = 0
+            yield plan, self.strata[stratum_id]["name"]
+
+    def get_report(self):
+        """Quota, number filled and whether unfillable, of each stratum.
+        """
+        return {
+            "num_attempts": self.num_attempts,
+            "num_duplicates": self.num_duplicates,
+            "strata": {
+                stratum["name"]: {
+                    "quota": count,
+                    "filled": filled,
+                    "unfillable": unfillable,
+                }
+                for stratum, count, filled, unfillable in zip(
+                    self.strata, self.counts, self.filled, self.unfillable
+                )
+            },
+        }
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,315 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Random access to the stitched dialogs of a saved split.
+
+An index next to the files of a split, deep_clevr_dialog_<split>.index/,
+locates each record (file, byte offset and size) and maps each source dialog
+(image_index, dialog_index) to the records stitched from it. The index is
+built while saving (merge_dialogs --index), or here from saved files. Files
+and index are memory-mapped, so that fetching a record only decodes that
+record, and the workers of a data loader share their pages.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import collections.abc
+import itertools
+import json
+import os
+
+import numpy as np
+
+from dataset_writer import DATASET_PREFIX, get_dataset_files
+from json_stream import iter_json_array
+from stitch_recipes import RECIPE_PREFIX, RECORD_FORMATS
+from triple_keys import get_dialog_key
+
+
+# Version of the index format.
+INDEX_VERSION = 1
+# Arrays of the index, with their types: location of each record, and the
+# (sorted) dialog keys of the source dialogs with the records using them.
+INDEX_ARRAYS = {
+    "shard_ids": np.int32,
+    "offsets": np.int64,
+    "num_bytes": np.int64,
+    "source_keys": np.int64,
+    "source_records": np.int64,
+}
+
+
+def get_index_path(save_root, split, prefix=DATASET_PREFIX):
+    """Path to the index of a saved split.
+    """
+    return os.path.join(save_root, "{}_{}.index".format(prefix, split))
+
+
+def remove_index(index_path):
+    """Deletes the files of a saved index (see RecordIndexBuilder.save), and
+    its folder once empty.
+    """
+    file_names = ["index.json"] + ["{}.npy".format(key) for key in INDEX_ARRAYS]
+    for file_name in file_names:
+        file_path = os.path.join(index_path, file_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    if os.path.isdir(index_path) and not os.listdir(index_path):
+        os.rmdir(index_path)
+
+
+def get_source_keys(record):
+    """Dialog keys (see triple_keys.get_dialog_key) of the sources of a record.
+    """
+    return [
+        get_dialog_key(image_index, dialog_index)
+        for image_index, dialog_index in zip(
+            record["image_index"], record["dialog_index"]
+        )
+    ]
+
+
+class RecordIndexBuilder:
+    """Collects the location and sources of records as they are written.
+    """
+
+    def __init__(self, base=None):
+        """Initializes the index.
+
+        Args:
+            base: Arrays (see INDEX_ARRAYS) of a saved index to append the
+                records to, see load_index_builder
+        """
+        self.base = base
+        self.locations = []
+        self.source_keys = []
+
+    def add(self, location, source_keys):
+        """Adds the next record.
+
+        Args:
+            location: Tuple (shard_id, offset, num_bytes), see
+                DatasetWriter.write_json
+            source_keys: Dialog keys of its source dialogs
+        """
+        self.locations.append(location)
+        self.source_keys.append(source_keys)
+
+    def save(self, index_path, file_paths):
+        """Saves the index of records written to (uncompressed) files.
+        """
+        if any(ii.endswith(".gz") for ii in file_paths):
+            raise ValueError("Compressed files cannot be indexed!")
+        if not os.path.exists(index_path):
+            os.makedirs(index_path)
+        base = self.base
+        if base is None:
+            base = {key: np.zeros(0, dtype) for key, dtype in INDEX_ARRAYS.items()}
+        num_base = len(base["offsets"])
+        locations = np.asarray(self.locations, dtype=np.int64).reshape(-1, 3)
+        arrays = {
+            "shard_ids": np.concatenate([base["shard_ids"], locations[:, 0]]),
+            "offsets": np.concatenate([base["offsets"], locations[:, 1]]),
+            "num_bytes": np.concatenate([base["num_bytes"], locations[:, 2]]),
+        }
+        # Records of each source dialog, sorted by dialog key (records of the
+        # base come first, as when indexing all the records at once).
+        num_sources = [len(ii) for ii in self.source_keys]
+        source_keys = np.asarray(
+            list(itertools.chain.from_iterable(self.source_keys)), dtype=np.int64
+        )
+        source_keys = np.concatenate([base["source_keys"], source_keys])
+        record_ids = np.arange(num_base, num_base + len(num_sources))
+        source_records = np.concatenate(
+            [base["source_records"], np.repeat(record_ids, num_sources)]
+        )
+        order = np.argsort(source_keys, kind="stable")
+        arrays["source_keys"] = source_keys[order]
+        arrays["source_records"] = source_records[order]
+        for key, dtype in INDEX_ARRAYS.items():
+            np.save(
+                os.path.join(index_path, "{}.npy".format(key)),
+                np.asarray(arrays[key], dtype=dtype),
+            )
+        metadata = {
+            "version": INDEX_VERSION,
+            "num_records": len(arrays["offsets"]),
+            "files": [
+                {"file_name": os.path.basename(ii), "num_bytes": os.path.getsize(ii)}
+                for ii in file_paths
+            ],
+        }
+        with open(os.path.join(index_path, "index.json"), "w") as file_id:
+            json.dump(metadata, file_id, indent=2)
+
+
+def iter_record_locations(file_path):
+    """Yields the records of a (JSON or JSON Lines) file, with their location.
+
+    Yields:
+        record: Tuple (record, offset, num_bytes)
+    """
+    if ".jsonl" not in os.path.basename(file_path):
+        for record, start, end in iter_json_array(file_path, with_offsets=True):
+            yield record, start, end - start
+        return
+    if file_path.endswith(".gz"):
+        raise ValueError("Compressed files cannot be indexed!")
+    offset = 0
+    with open(file_path, "rb") as file_id:
+        for line in file_id:
+            data = line.rstrip(b"\r\n")
+            if data.strip():
+                yield json.loads(data), offset, len(data)
+            offset += len(line)
+
+
+def build_index(save_root, split, prefix=DATASET_PREFIX):
+    """Indexes the saved files of a split.
+
+    Records are numbered in the order they were written, round-robin over the
+    shards (see DatasetWriter).
+
+    Returns:
+        index_path: Path to the index
+    """
+    file_paths = get_dataset_files(save_root, split, prefix)
+    builder = RecordIndexBuilder()
+    shards = [iter_record_locations(ii) for ii in file_paths]
+    for records in itertools.zip_longest(*shards):
+        for shard_id, located in enumerate(records):
+            if located is not None:
+                record, offset, num_bytes = located
+                builder.add((shard_id, offset, num_bytes), get_source_keys(record))
+    index_path = get_index_path(save_root, split, prefix)
+    builder.save(index_path, file_paths)
+    return index_path
+
+
+def load_index_builder(save_root, split, prefix=DATASET_PREFIX):
+    """Builder that appends records to the index of a saved split.
+
+    The index is built from the files first if missing or out of date (e.g.,
+    saved by an interrupted run after appending to the files).
+    """
+    try:
+        dataset = IndexedDataset(save_root, split, prefix)
+    except (OSError, ValueError):
+        build_index(save_root, split, prefix)
+        dataset = IndexedDataset(save_root, split, prefix)
+    return RecordIndexBuilder(
+        {key: np.asarray(getattr(dataset, key)) for key in INDEX_ARRAYS}
+    )
+
+
+class IndexedDataset(collections.abc.Sequence):
+    """Read-only, memory-mapped view of the records of a saved split.
+
+    Records are decoded on access. Files are mapped on first access in each
+    process, so that the dataset can be passed to data loader workers.
+    """
+
+    def __init__(self, save_root, split, prefix=DATASET_PREFIX):
+        index_path = get_index_path(save_root, split, prefix)
+        with open(os.path.join(index_path, "index.json"), "r") as file_id:
+            metadata = json.load(file_id)
+        if metadata["version"] != INDEX_VERSION:
+            raise ValueError("Index version mismatch: {}!".format(index_path))
+        self.file_paths = []
+        for file_info in metadata["files"]:
+            file_path = os.path.join(save_root, file_info["file_name"])
+            if os.path.getsize(file_path) != file_info["num_bytes"]:
+                raise ValueError("Index out of date: {}!".format(file_path))
+            self.file_paths.append(file_path)
+        for key in INDEX_ARRAYS:
+            array_path = os.path.join(index_path, "{}.npy".format(key))
+            setattr(self, key, np.load(array_path, mmap_mode="r"))
+        self.files = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["files"] = None
+        return state
+
+    def open_files(self):
+        self.files = [
+            np.memmap(ii, dtype=np.uint8, mode="r")
+            if os.path.getsize(ii)
+            else np.zeros(0, dtype=np.uint8)
+            for ii in self.file_paths
+        ]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get_bytes(self, index):
+        """Encoded (JSON) record, without decoding it.
+        """
+        if self.files is None:
+            self.open_files()
+        start = int(self.offsets[index])
+        end = start + int(self.num_bytes[index])
+        return self.files[self.shard_ids[index]][start:end].tobytes()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ii] for ii in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Record index out of range!")
+        return json.loads(self.get_bytes(index))
+
+    def get_record_ids(self, image_index, dialog_index):
+        """Ids of the records stitched from a source dialog, in order.
+        """
+        dialog_key = get_dialog_key(image_index, dialog_index)
+        start, end = np.searchsorted(
+            self.source_keys, [dialog_key, dialog_key + 1], side="left"
+        )
+        return np.asarray(self.source_records[start:end])
+
+    def get_records(self, image_index, dialog_index):
+        """Records stitched from a source dialog.
+        """
+        return [self[int(ii)] for ii in self.get_record_ids(image_index, dialog_index)]
+
+
+def main(args):
+    prefix = RECIPE_PREFIX if args["record_format"] == "recipe" else DATASET_PREFIX
+    for split in args["splits"]:
+        print("Indexing: {}".format(split))
+        index_path = build_index(args["save_root"], split, prefix)
+        num_records = len(IndexedDataset(args["save_root"], split, prefix))
+        print("Saved index of {} records: {}".format(num_records, index_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--save_root", required=True, help="Path to the stitched dataset"
+    )
+    parser.add_argument(
+        "--splits",
+        nargs="+",
+        default=["val", "test", "train"],
+        help="Splits to index",
+    )
+    parser.add_argument(
+        "--record_format",
+        default="dialog",
+        choices=RECORD_FORMATS,
+        help="Index stitched dialogs, or recipes (see stitch_recipes)",
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)
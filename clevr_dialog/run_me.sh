@@ -23,5 +23,6 @@ python merge_dialogs.py \
 
 # Compute dependencies.
 # python evaluate_dependence.py \
-#     --input_clevr_path="data/clevr_train_raw_70k.json" \
-#     --input_deep_clevr_path="data/deep_clevr_dialog_train.json"
+#     --clevr_train_json="data/clevr_train_raw_70k.json" \
+#     --clevr_val_json="data/clevr_val_raw_70k.json" \
+#     --save_root="data/" --save_json_path="data/dependence.json"
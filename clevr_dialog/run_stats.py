@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Instrumentation of a run: time spent per stage, counters and peak memory.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import contextlib
+import resource
+import sys
+import threading
+import time
+
+
+def get_peak_rss_mb():
+    """Peak resident memory of this process, in MB.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    if sys.platform == "darwin":
+        return peak_rss / 2 ** 20
+    return peak_rss / 2 ** 10
+
+
+class RunStats:
+    """Wall and CPU time spent per stage, and counters, within a process.
+
+    Reports of several processes (see to_dict) can be aggregated with merge.
+    Stages can be timed from several threads.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context to time a stage (accumulated over all calls).
+        """
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_time(
+                name,
+                time.perf_counter() - start_wall,
+                time.process_time() - start_cpu,
+            )
+
+    def add_time(self, name, wall_time, cpu_time, calls=1):
+        """Adds time spent in a stage, e.g., measured in another process.
+        """
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {
+                    "wall_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "calls": 0,
+                }
+            stage = self.stages[name]
+            stage["wall_seconds"] += wall_time
+            stage["cpu_seconds"] += cpu_time
+            stage["calls"] += calls
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def timed_iter(self, name, iterable):
+        """Yields from an iterable, timing the production of each item.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def to_dict(self):
+        """Report of the stages, counters and peak memory of the process.
+        """
+        with self.lock:
+            return {
+                "wall_seconds": time.perf_counter() - self.start_wall,
+                "cpu_seconds": time.process_time() - self.start_cpu,
+                "peak_rss_mb": get_peak_rss_mb(),
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    @staticmethod
+    def merge(reports):
+        """Aggregates the reports of several processes.
+
+        Times and counters are summed; the peak memory is both summed (upper
+        bound for processes running concurrently) and maximized.
+        """
+        reports = [ii for ii in reports if ii is not None]
+        merged = {
+            "num_processes": sum(ii.get("num_processes", 1) for ii in reports),
+            "cpu_seconds": sum(ii["cpu_seconds"] for ii in reports),
+            "peak_rss_mb": max([ii["peak_rss_mb"] for ii in reports], default=0.0),
+            "total_peak_rss_mb": sum(ii["peak_rss_mb"] for ii in reports),
+            "stages": collections.OrderedDict(),
+            "counters": collections.Counter(),
+        }
+        for report in reports:
+            for name, stage in report["stages"].items():
+                merged_stage = merged["stages"].setdefault(
+                    name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0}
+                )
+                for key in merged_stage:
+                    merged_stage[key] += stage[key]
+            merged["counters"].update(report["counters"])
+        merged["stages"] = dict(merged["stages"])
+        merged["counters"] = dict(merged["counters"])
+        return merged
+
+
+class NullStats:
+    """Drop-in for RunStats that records nothing, when instrumentation is off.
+    """
+
+    enabled = False
+    null_context = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self.null_context
+
+    def add_time(self, name, wall_time, cpu_time, calls=1):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def timed_iter(self, name, iterable):
+        return iterable
+
+    def to_dict(self):
+        return None
+
+
+NULL_STATS = NullStats()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,505 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Compact, memory-mapped store of segmented CLEVR-Dialog dialogs.
+
+Segmentation is done once (sharded across processes) and written to a
+directory of flat arrays; stitching workers then open the store read-only
+and share its pages through the OS page cache.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import collections.abc
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from attribute_vocab import ATTRIBUTE_VOCAB, decode_attributes, get_attribute_bit
+from compatibility_index import CompatibilityIndex
+from dialog import Dialog
+from json_stream import iter_json_array
+from pipeline import NULL_MONITOR, iter_in_thread
+from run_stats import NULL_STATS
+from triple_keys import get_dialog_key
+
+
+# Version of the segmentation and the store format; bump to invalidate
+# cached stores whenever either changes.
+SEGMENT_STORE_VERSION = 3
+# Number of images segmented per task.
+SHARD_SIZE = 250
+# Flat arrays in the store, with their types.
+STORE_ARRAYS = {
+    "image_index": np.int64,
+    "dialog_index": np.int64,
+    "record_offsets": np.int64,
+    "recaller_offsets": np.int64,
+    "recaller_rounds": np.int32,
+    "recaller_known": np.uint64,
+    "recaller_focus": np.uint64,
+}
+
+
+def segment_images(images, exclude=None):
+    """Segments all dialogs of a list of images into flat arrays.
+
+    Args:
+        images: Raw CLEVR-Dialog data (list of images with 5 dialogs each)
+        exclude: Set of keys of dialogs to skip, if any (see validate_source)
+
+    Returns:
+        shard: Dictionary of lists (see STORE_ARRAYS), encoded records, the
+            attribute vocabulary used for the masks, and the (wall, CPU) time
+            taken
+    """
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    shard = {key: [] for key in STORE_ARRAYS if not key.endswith("_offsets")}
+    shard.update({"record_sizes": [], "recaller_counts": [], "records": []})
+    for image in images:
+        for dialog_index in range(len(image["dialogs"])):
+            if exclude and (
+                get_dialog_key(image["image_index"], dialog_index) in exclude
+            ):
+                continue
+            dialog = Dialog(image, dialog_index)
+            dialog.segment_dialog(keep_graphs=False)
+            record = json.dumps(
+                {
+                    "image_filename": dialog.image_filename,
+                    "split": dialog.split,
+                    "caption": dialog.data["caption"],
+                    "dialog": dialog.data["dialog"],
+                    "dependence": dialog.data["dependence"],
+                    "turn_focus_attrs": [
+                        ii["turn_focus_attrs"] for ii in dialog.context_recaller
+                    ],
+                }
+            ).encode("utf-8")
+            shard["image_index"].append(dialog.image_index)
+            shard["dialog_index"].append(dialog_index)
+            shard["records"].append(record)
+            shard["record_sizes"].append(len(record))
+            shard["recaller_counts"].append(len(dialog.context_recaller))
+            for context_datum in dialog.context_recaller:
+                shard["recaller_rounds"].append(context_datum["round_id"])
+                shard["recaller_known"].append(context_datum["known_mask"])
+                shard["recaller_focus"].append(context_datum["focus_mask"])
+    shard["vocab"] = list(ATTRIBUTE_VOCAB)
+    shard["time"] = (
+        time.perf_counter() - start_wall,
+        time.process_time() - start_cpu,
+    )
+    return shard
+
+
+def remap_masks(masks, vocab):
+    """Remaps attribute masks encoded with another vocabulary to ours.
+
+    Args:
+        masks: List of integer masks
+        vocab: Attribute vocabulary used to encode the masks
+
+    Returns:
+        masks: List of integer masks in the vocabulary of this process
+    """
+    bits = [get_attribute_bit(value) for value in vocab]
+    if bits == list(range(len(vocab))):
+        return masks
+    remapped = []
+    for mask in masks:
+        new_mask = 0
+        for bit, new_bit in enumerate(bits):
+            if mask & (1 << bit):
+                new_mask |= 1 << new_bit
+        remapped.append(new_mask)
+    return remapped
+
+
+def write_segment_store(
+    store_path, shards, stats=NULL_STATS, monitor=NULL_MONITOR
+):
+    """Writes segmented shards (in order) to a store directory.
+
+    Args:
+        store_path: Directory to write the store to
+        shards: Iterable of shards from segment_images
+        stats: RunStats to record the segmentation time in
+        monitor: PipelineMonitor to record the segmentation and writing in
+    """
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    arrays = {key: [] for key in STORE_ARRAYS if not key.endswith("_offsets")}
+    record_sizes = []
+    recaller_counts = []
+    with open(os.path.join(store_path, "records.bin"), "wb") as file_id:
+        for shard in shards:
+            stats.add_time("segmentation", *shard["time"])
+            monitor.add_busy("segment", shard["time"][0])
+            with monitor.busy("store"):
+                for key in ("recaller_known", "recaller_focus"):
+                    shard[key] = remap_masks(shard[key], shard["vocab"])
+                for key, values in arrays.items():
+                    values.extend(shard[key])
+                record_sizes.extend(shard["record_sizes"])
+                recaller_counts.extend(shard["recaller_counts"])
+                for record in shard["records"]:
+                    file_id.write(record)
+
+    arrays["record_offsets"] = np.cumsum([0] + record_sizes)
+    arrays["recaller_offsets"] = np.cumsum([0] + recaller_counts)
+    for key, dtype in STORE_ARRAYS.items():
+        np.save(
+            os.path.join(store_path, "{}.npy".format(key)),
+            np.asarray(arrays[key], dtype=dtype),
+        )
+    with open(os.path.join(store_path, "vocab.json"), "w") as file_id:
+        json.dump(ATTRIBUTE_VOCAB, file_id)
+    save_num_compatible(store_path, stats)
+
+
+def save_num_compatible(store_path, stats=NULL_STATS):
+    """Counts the dialogs compatible with each dialog of a store, once for
+    all the samplers over it (see CompatibilityIndex.count_compatible).
+    """
+    with stats.stage("compatibility"):
+        index = SegmentStore(store_path).get_compatibility_index()
+        np.save(
+            os.path.join(store_path, "num_compatible.npy"), index.count_compatible()
+        )
+
+
+def concat_segment_stores(store_paths, store_path, chunk_size=1 << 22):
+    """Concatenates stores (in order) into a new store directory.
+
+    Args:
+        store_paths: Paths to the stores to concatenate
+        store_path: Directory to write the store to
+        chunk_size: Number of bytes of records copied at a time
+    """
+    stores = [SegmentStore(ii) for ii in store_paths]
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    for key, dtype in STORE_ARRAYS.items():
+        if key.endswith("_offsets"):
+            # Offsets continue from the end of the previous stores.
+            arrays, base = [np.zeros(1, dtype=dtype)], 0
+            for store in stores:
+                offsets = np.asarray(getattr(store, key))
+                arrays.append(offsets[1:] + base)
+                base += offsets[-1]
+        else:
+            arrays = [np.asarray(getattr(store, key)) for store in stores]
+        np.save(
+            os.path.join(store_path, "{}.npy".format(key)),
+            np.concatenate(arrays).astype(dtype),
+        )
+    with open(os.path.join(store_path, "records.bin"), "wb") as file_id:
+        for path in store_paths:
+            with open(os.path.join(path, "records.bin"), "rb") as records_id:
+                shutil.copyfileobj(records_id, file_id, chunk_size)
+    with open(os.path.join(store_path, "vocab.json"), "w") as file_id:
+        json.dump(ATTRIBUTE_VOCAB, file_id)
+    # Dialogs of each store are also compatible with those of the others.
+    save_num_compatible(store_path)
+
+
+def iter_shards(images, shard_size=SHARD_SIZE):
+    """Groups an iterable of images into lists of shard_size images.
+    """
+    shard = []
+    for image in images:
+        shard.append(image)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def imap_bounded(pool, function, inputs, max_pending):
+    """Ordered pool.imap that consumes at most max_pending inputs ahead.
+
+    Unlike pool.imap, inputs are not read eagerly, so that memory stays
+    bounded when inputs are streamed from disk.
+    """
+    pending = collections.deque()
+    for datum in inputs:
+        pending.append(pool.apply_async(function, (datum,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def build_segment_store(
+    images,
+    store_path,
+    num_workers=1,
+    stats=NULL_STATS,
+    pool=None,
+    monitor=NULL_MONITOR,
+    exclude=None,
+):
+    """Segments the dialogs of a split and writes them to a store.
+
+    Images are read in a background thread, a few shards ahead, so that
+    reading the source overlaps with segmentation and writing the store, and
+    only a few shards are held in memory at a time.
+
+    Args:
+        images: Iterable of raw CLEVR-Dialog images (with 5 dialogs each),
+            e.g., from json_stream.iter_json_array
+        store_path: Directory to write the store to
+        num_workers: Number of processes to segment with
+        stats: RunStats to record the time spent reading and segmenting in
+        pool: Pool of (num_workers) processes to segment with, started
+            here if not given
+        monitor: PipelineMonitor to record the reading, segmentation and
+            writing in
+        exclude: Set of keys of dialogs to skip, if any (see validate_source)
+    """
+    function = segment_images
+    if exclude:
+        function = functools.partial(segment_images, exclude=exclude)
+    shards = iter_in_thread(
+        iter_shards(stats.timed_iter("load", images)),
+        2 * num_workers,
+        "read",
+        monitor,
+    )
+    if pool is not None:
+        segmented = imap_bounded(pool, function, shards, 2 * num_workers)
+        write_segment_store(store_path, segmented, stats, monitor)
+    elif num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            segmented = imap_bounded(pool, function, shards, 2 * num_workers)
+            write_segment_store(store_path, segmented, stats, monitor)
+    else:
+        segmented = map(function, shards)
+        write_segment_store(store_path, segmented, stats, monitor)
+
+
+@functools.lru_cache(maxsize=None)
+def hash_file(file_path, chunk_size=1 << 22):
+    """SHA-256 of the content of a file (computed once per process).
+    """
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as file_id:
+        for chunk in iter(lambda: file_id.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_cache_key(json_path, start, stop, exclude=None):
+    """Cache key for the store of images [start, stop) of a CLEVR-Dialog file.
+
+    Depends on the content of the file, the dialogs excluded (if any) and
+    SEGMENT_STORE_VERSION, not the path.
+    """
+    key = "{}_{}_{}_{}".format(
+        hash_file(json_path), start, stop, SEGMENT_STORE_VERSION
+    )
+    if exclude:
+        key += "_" + ",".join(str(ii) for ii in sorted(exclude))
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+@contextlib.contextmanager
+def segmented_split(
+    json_path,
+    start=0,
+    stop=None,
+    num_workers=1,
+    cache_root=None,
+    temp_root=None,
+    stats=NULL_STATS,
+    pool=None,
+    monitor=NULL_MONITOR,
+    exclude=None,
+):
+    """Segments images [start, stop) of a CLEVR-Dialog file into a store.
+
+    Without cache_root, the store is built in a temporary folder and deleted
+    afterwards. Otherwise, it is kept in cache_root under a key that depends
+    on the content of the file (see get_cache_key), and reused as is by later
+    runs, which then skip reading the file and segmenting the dialogs.
+
+    Args:
+        json_path: Path to the CLEVR-Dialog JSON file
+        start, stop: Range of images to segment (stop=None for all)
+        num_workers: Number of processes to segment with
+        cache_root: Folder to cache the stores in
+        temp_root: Folder for the temporary store, when not caching
+        stats: RunStats to record the time spent reading and segmenting in
+        pool: Pool of (num_workers) processes to segment with, if any
+        monitor: PipelineMonitor to record the stages of segmentation in
+        exclude: Set of keys of dialogs to skip, if any (see validate_source)
+
+    Yields:
+        store_path: Path to the store, to open with SegmentStore
+    """
+    images = itertools.islice(iter_json_array(json_path), start, stop)
+    if cache_root is None:
+        with tempfile.TemporaryDirectory(prefix="segments_", dir=temp_root) as path:
+            build_segment_store(
+                images, path, num_workers, stats, pool, monitor, exclude
+            )
+            yield path
+        return
+
+    store_path = os.path.join(
+        cache_root, get_cache_key(json_path, start, stop, exclude)
+    )
+    if os.path.isdir(store_path):
+        print("Loading cached segmentation: {}".format(store_path))
+        stats.count("segmentation_cache_hits")
+    else:
+        if not os.path.exists(cache_root):
+            os.makedirs(cache_root)
+        # Build in a temporary folder and rename, so that the cache never has
+        # partially written stores.
+        temp_path = tempfile.mkdtemp(prefix="segments_", dir=cache_root)
+        try:
+            build_segment_store(
+                images, temp_path, num_workers, stats, pool, monitor, exclude
+            )
+            os.rename(temp_path, store_path)
+        except OSError:
+            # Another run cached the same store meanwhile.
+            if not os.path.isdir(store_path):
+                raise
+        finally:
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+    yield store_path
+
+
+class SegmentStore(collections.abc.Sequence):
+    """Read-only, memory-mapped view of segmented dialogs.
+
+    Behaves as a sequence of Dialog objects, materialized on access. The
+    context recaller entries carry the round ids and the attribute masks
+    (and sets decoded from them); the scene graphs are not stored, only the
+    dependence of each history item.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        for key in STORE_ARRAYS:
+            array_path = os.path.join(store_path, "{}.npy".format(key))
+            setattr(self, key, np.load(array_path, mmap_mode="r"))
+        # Counted when writing the store (not in stores of incremental states
+        # saved before, which are only concatenated to).
+        count_path = os.path.join(store_path, "num_compatible.npy")
+        self.num_compatible = None
+        if os.path.exists(count_path):
+            self.num_compatible = np.load(count_path, mmap_mode="r")
+        records_path = os.path.join(store_path, "records.bin")
+        if os.path.getsize(records_path):
+            self.records = np.memmap(records_path, dtype=np.uint8, mode="r")
+        else:
+            self.records = np.zeros(0, dtype=np.uint8)
+
+        with open(os.path.join(store_path, "vocab.json"), "r") as file_id:
+            vocab = json.load(file_id)
+        for bit, value in enumerate(vocab):
+            if get_attribute_bit(value) != bit:
+                raise ValueError("Attribute vocabulary mismatch: {}!".format(value))
+
+    def __len__(self):
+        return len(self.image_index)
+
+    def get_record(self, index):
+        """Decodes the stored record of a dialog.
+        """
+        start, end = self.record_offsets[index], self.record_offsets[index + 1]
+        return json.loads(self.records[start:end].tobytes().decode("utf-8"))
+
+    def get_context_recaller(self, index, record=None):
+        """Context recaller entries of a dialog.
+        """
+        start, end = self.recaller_offsets[index], self.recaller_offsets[index + 1]
+        if record is None:
+            record = self.get_record(index)
+        context_recaller = []
+        for offset in range(start, end):
+            known_mask = int(self.recaller_known[offset])
+            focus_mask = int(self.recaller_focus[offset])
+            context_recaller.append(
+                {
+                    "round_id": int(self.recaller_rounds[offset]),
+                    "known_attrs": decode_attributes(known_mask),
+                    "focus_attrs": decode_attributes(focus_mask),
+                    "known_mask": known_mask,
+                    "focus_mask": focus_mask,
+                    "turn_focus_attrs": record["turn_focus_attrs"][offset - start],
+                }
+            )
+        return context_recaller
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ii] for ii in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Dialog index out of range!")
+        record = self.get_record(index)
+        dialog_index = int(self.dialog_index[index])
+        dialog_bundle = {
+            "image_filename": record["image_filename"],
+            "image_index": int(self.image_index[index]),
+            "split": record["split"],
+            "dialogs": {
+                dialog_index: {
+                    "caption": record["caption"],
+                    "dialog": record["dialog"],
+                    "dependence": record["dependence"],
+                }
+            },
+        }
+        dialog = Dialog(dialog_bundle, dialog_index)
+        # Scene graphs are not stored.
+        dialog.dialog_graph = None
+        dialog.context_recaller = self.get_context_recaller(index, record)
+        return dialog
+
+    def get_dialog_keys(self):
+        """Dialog keys (see triple_keys.get_dialog_key) of all the dialogs.
+        """
+        return get_dialog_key(
+            np.asarray(self.image_index), np.asarray(self.dialog_index)
+        )
+
+    def get_compatibility_index(self):
+        """CompatibilityIndex over the last context recaller of each dialog.
+        """
+        ends = np.asarray(self.recaller_offsets[1:])
+        valid = ends > np.asarray(self.recaller_offsets[:-1])
+        last = np.maximum(ends - 1, 0)
+        known = np.zeros(len(self), dtype=np.uint64)
+        focus = np.zeros(len(self), dtype=np.uint64)
+        known[valid] = self.recaller_known[last[valid]]
+        focus[valid] = self.recaller_focus[last[valid]]
+        return CompatibilityIndex(known, focus, valid, self.num_compatible)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Stitched dialogs saved as recipes, and materialized on the fly when read.
+
+A recipe only keeps the (image_index, dialog_index) of its source dialogs and
+the spans of rounds taken from each, in order (see dialog.StitchPlan), instead
+of the caption and rounds of all its contexts. Recipes are materialized from
+the segmented source dialogs (see segment_store), which give random access to
+the dialogs of the CLEVR-Dialog file; the most recently used dialogs are kept
+in memory.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import os
+
+import numpy as np
+
+from dataset_writer import (
+    OUTPUT_FORMATS,
+    DatasetWriter,
+    get_dataset_files,
+    iter_dataset_file,
+)
+from dialog import StitchPlan
+from segment_store import SegmentStore, get_cache_key, segmented_split
+from triple_keys import get_dialog_key
+
+
+# Prefix of the files of recipes (see dataset_writer.DatasetWriter).
+RECIPE_PREFIX = "deep_clevr_recipe"
+# Record formats of the stitched dialogs: full dialogs, or recipes.
+RECORD_FORMATS = ("dialog", "recipe")
+# Number of source dialogs kept in memory by a RecipeReader.
+CACHE_SIZE = 1 << 16
+
+
+def get_source_path(save_root, split):
+    """Path to the description of the source dialogs of the recipes of a split.
+    """
+    return os.path.join(save_root, "{}_{}.source.json".format(RECIPE_PREFIX, split))
+
+
+def save_source(save_root, split, json_path, start=0, stop=None, exclude=None):
+    """Saves the source dialogs of the recipes of a split (images [start, stop)
+    of a CLEVR-Dialog file, but for excluded dialog keys), to check them
+    against when materializing.
+    """
+    source = {
+        "file_name": os.path.basename(json_path),
+        "start": start,
+        "stop": stop,
+        "cache_key": get_cache_key(json_path, start, stop, exclude),
+    }
+    if exclude:
+        source["exclude"] = sorted(exclude)
+    with open(get_source_path(save_root, split), "w") as file_id:
+        json.dump(source, file_id, indent=2)
+
+
+class RecipeReader:
+    """Materializes recipes into stitched dialogs, given the source dialogs.
+
+    Materialized dialogs are the same as those merge_dialogs saves (with the
+    statistics of the recipe, if any).
+    """
+
+    def __init__(self, store_path, cache_size=CACHE_SIZE):
+        """Opens the source dialogs.
+
+        Args:
+            store_path: Path to the segmented source dialogs (see segment_store)
+            cache_size: Number of source dialogs kept in memory
+        """
+        self.store = SegmentStore(store_path)
+        dialog_keys = self.store.get_dialog_keys()
+        self.order = np.argsort(dialog_keys, kind="stable")
+        self.dialog_keys = dialog_keys[self.order]
+        self.get_dialog = functools.lru_cache(maxsize=cache_size)(self.load_dialog)
+
+    def load_dialog(self, image_index, dialog_index):
+        """Source dialog, given its image and dialog index.
+        """
+        dialog_key = get_dialog_key(image_index, dialog_index)
+        position = np.searchsorted(self.dialog_keys, dialog_key)
+        if (
+            position == len(self.dialog_keys)
+            or self.dialog_keys[position] != dialog_key
+        ):
+            raise KeyError(
+                "Dialog not in the source: {}, {}".format(image_index, dialog_index)
+            )
+        return self.store[int(self.order[position])]
+
+    def materialize(self, recipe):
+        """Stitched dialog of a recipe.
+        """
+        dialogs = [
+            self.get_dialog(image_index, dialog_index)
+            for image_index, dialog_index in zip(
+                recipe["image_index"], recipe["dialog_index"]
+            )
+        ]
+        stitched_dialog = StitchPlan.from_recipe(recipe, dialogs).materialize()
+        if "stats" in recipe:
+            stitched_dialog["stats"] = recipe["stats"]
+        return stitched_dialog
+
+    def iter_dialogs(self, file_paths):
+        """Yields the stitched dialogs of files (or shards) of recipes.
+
+        Shards are read round-robin, as DatasetWriter writes them, so that the
+        stitched dialogs come in the order they were stitched.
+        """
+        shards = [iter_dataset_file(ii) for ii in file_paths]
+        for recipes in itertools.zip_longest(*shards):
+            for recipe in recipes:
+                if recipe is not None:
+                    yield self.materialize(recipe)
+
+
+@contextlib.contextmanager
+def open_recipes(save_root, split, json_path, cache_root=None, cache_size=CACHE_SIZE):
+    """Opens the recipes of a split saved by merge_dialogs.
+
+    Args:
+        save_root: Folder the recipes were saved to
+        split: Name of the split
+        json_path: Path to the CLEVR-Dialog file the split was stitched from
+        cache_root: Folder to cache the segmented source dialogs in (the cache
+            of merge_dialogs, if any, to reuse them)
+        cache_size: Number of source dialogs kept in memory
+
+    Yields:
+        reader: RecipeReader over the source dialogs
+        file_paths: Files (or shards) of the recipes
+    """
+    with open(get_source_path(save_root, split), "r") as file_id:
+        source = json.load(file_id)
+    start, stop = source["start"], source["stop"]
+    exclude = frozenset(source.get("exclude", []))
+    if get_cache_key(json_path, start, stop, exclude) != source["cache_key"]:
+        raise ValueError(
+            "Recipes of {} not stitched from: {}".format(split, json_path)
+        )
+    file_paths = get_dataset_files(save_root, split, RECIPE_PREFIX)
+    with segmented_split(
+        json_path, start, stop, cache_root=cache_root, exclude=exclude
+    ) as path:
+        yield RecipeReader(path, cache_size), file_paths
+
+
+def main(args):
+    print("Reading: {}".format(args["clevr_json"]))
+    with open_recipes(
+        args["save_root"], args["split"], args["clevr_json"], args["cache_root"]
+    ) as (reader, file_paths):
+        with DatasetWriter(
+            args["output_root"],
+            args["split"],
+            args["output_format"],
+            args["num_shards"],
+            args["compress"],
+        ) as writer:
+            print("Materializing: {}".format(", ".join(file_paths)))
+            for stitched_dialog in reader.iter_dialogs(file_paths):
+                writer.write(stitched_dialog)
+        print(
+            "Saved {} triplets: {}".format(
+                writer.num_records, ", ".join(writer.file_paths)
+            )
+        )
+        print("Source dialogs cache: {}".format(reader.get_dialog.cache_info()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--save_root", required=True, help="Path to the recipes")
+    parser.add_argument("--split", required=True, help="Split to materialize")
+    parser.add_argument(
+        "--clevr_json",
+        required=True,
+        help="Path to the CLEVR-Dialog file the split was stitched from",
+    )
+    parser.add_argument(
+        "--output_root", required=True, help="Path to save the stitched dialogs"
+    )
+    parser.add_argument(
+        "--output_format",
+        default="json",
+        choices=OUTPUT_FORMATS,
+        help="Save a JSON list, or (sharded) JSON Lines",
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=1, help="Number of JSON Lines shards"
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="Compress the output with gzip"
+    )
+    parser.add_argument(
+        "--cache_root",
+        default=None,
+        help="Path to cache segmented dialogs, reused across runs",
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)
@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Seeded generator of synthetic data in the CLEVR-Dialog format.
+
+Only the structure matters (captions, rounds with templates, scene graph
+history with objects, relations, focus and dependence), so that the
+pipeline can be run and benchmarked without the real dataset.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import json
+import random
+
+from attribute_vocab import CLEVR_ATTRIBUTES
+
+
+CAPTION_TEMPLATES = (
+    "extreme-left",
+    "extreme-right",
+    "extreme-front",
+    "extreme-behind",
+    "extreme-center",
+    "unique-obj",
+    "unique-attr",
+    "count-attr",
+    "obj-relation",
+)
+# Question templates, split by whether they refer to an earlier round.
+INDEPENDENT_TEMPLATES = (
+    "count-all",
+    "count-other",
+    "count-attribute",
+    "exist-other",
+    "exist-attribute",
+    "seek-attr-imm",
+    "seek-attr-rel-imm",
+    "count-obj-rel-imm",
+    "exist-obj-rel-imm",
+)
+EARLY_TEMPLATES = (
+    "seek-attr-early",
+    "seek-attr-sim-early",
+    "seek-attr-rel-early",
+    "count-obj-rel-early",
+    "count-obj-exclude-early",
+    "exist-obj-rel-early",
+    "exist-obj-exclude-early",
+)
+RELATIONS = ("left", "right", "front", "behind")
+
+
+def generate_scene(rng, min_objects=3, max_objects=10):
+    """Objects of a synthetic scene, with all their attributes.
+    """
+    return [
+        dict(
+            {"id": object_id},
+            **{key: rng.choice(values) for key, values in CLEVR_ATTRIBUTES.items()}
+        )
+        for object_id in range(rng.randint(min_objects, max_objects))
+    ]
+
+
+def reveal(rng, obj, num_attributes):
+    """Graph item object with some attributes of an object revealed.
+    """
+    keys = rng.sample(sorted(CLEVR_ATTRIBUTES), num_attributes)
+    return dict({"id": obj["id"]}, **{key: obj[key] for key in keys})
+
+
+def generate_dialog(rng, scene, num_rounds=10, early_prob=0.3):
+    """Synthetic dialog (caption, rounds and scene graph history) of a scene.
+
+    Args:
+        rng: Random number generator
+        scene: Objects of the scene (see generate_scene)
+        num_rounds: Number of rounds of the dialog
+        early_prob: Probability of a round referring to an earlier round
+
+    Returns:
+        dialog: Dialog in the CLEVR-Dialog format
+    """
+    caption_obj = rng.choice(scene)
+    history = [
+        {
+            "objects": [reveal(rng, caption_obj, rng.randint(1, 2))],
+            "mergeable": True,
+            "focus_desc": None,
+            "dependence": None,
+        }
+    ]
+    rounds = []
+    for round_id in range(num_rounds):
+        # Rounds after the first refer to earlier rounds (at least once).
+        early = round_id > 0 and (rng.random() < early_prob or round_id == 1)
+        template = rng.choice(EARLY_TEMPLATES if early else INDEPENDENT_TEMPLATES)
+        obj = rng.choice(scene)
+        graph_item = {
+            "objects": [],
+            "mergeable": rng.random() < 0.9,
+            "focus_desc": None,
+            "dependence": None,
+        }
+        if rng.random() < 0.5:
+            graph_item["objects"].append(reveal(rng, obj, 1))
+        if "rel" in template and len(scene) > 1:
+            other = rng.choice([ii for ii in scene if ii is not obj])
+            graph_item["objects"] = [reveal(rng, obj, 0), reveal(rng, other, 0)]
+            graph_item["relation"] = rng.choice(RELATIONS)
+        if early:
+            graph_item["dependence"] = rng.randrange(round_id)
+            focus_key = rng.choice(sorted(CLEVR_ATTRIBUTES))
+            graph_item["focus_desc"] = {
+                "required": [focus_key],
+                focus_key: obj[focus_key],
+            }
+        elif template.endswith("imm") and round_id > 0:
+            graph_item["dependence"] = round_id - 1
+        history.append(graph_item)
+        rounds.append(
+            {
+                "question": "{} question about object {}?".format(
+                    template, obj["id"]
+                ),
+                "answer": str(rng.randint(0, 5)),
+                "template": template,
+            }
+        )
+    return {
+        "caption": "a caption about object {}.".format(caption_obj["id"]),
+        "template": rng.choice(CAPTION_TEMPLATES),
+        "dialog": rounds,
+        "graph": {"history": history},
+    }
+
+
+def generate_images(num_images, seed=0, split="train", num_dialogs=5, **kwargs):
+    """Yields synthetic images, each with its dialogs, in CLEVR-Dialog format.
+
+    Args:
+        num_images: Number of images
+        seed: Seed for the random number generator (same seed, same data)
+        split: CLEVR split of the images
+        num_dialogs: Number of dialogs per image
+        kwargs: Arguments for generate_dialog
+    """
+    rng = random.Random(seed)
+    for image_index in range(num_images):
+        scene = generate_scene(rng)
+        yield {
+            "image_filename": "CLEVR_{}_{:06d}.png".format(split, image_index),
+            "image_index": image_index,
+            "split": split,
+            "dialogs": [
+                generate_dialog(rng, scene, **kwargs) for _ in range(num_dialogs)
+            ],
+        }
+
+
+def save_synthetic_data(json_path, num_images, seed=0, split="train", **kwargs):
+    """Writes synthetic images (see generate_images) to a JSON file.
+    """
+    with open(json_path, "w") as file_id:
+        file_id.write("[")
+        images = generate_images(num_images, seed, split, **kwargs)
+        for index, image in enumerate(images):
+            if index:
+                file_id.write(", ")
+            json.dump(image, file_id)
+        file_id.write("]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--save_json_path", required=True, help="Path to save the JSON file"
+    )
+    parser.add_argument(
+        "--num_images", type=int, default=1000, help="Number of images"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--split", default="train", help="CLEVR split")
+    parser.add_argument(
+        "--num_rounds", type=int, default=10, help="Number of rounds per dialog"
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    save_synthetic_data(
+        parsed_args["save_json_path"],
+        parsed_args["num_images"],
+        parsed_args["seed"],
+        parsed_args["split"],
+        num_rounds=parsed_args["num_rounds"],
+    )
@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Packed integer keys for dialogs and stitched triples, partitioning of
+triples across workers, and seeds derived for units of work.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+
+import numpy as np
+
+
+# A dialog key packs (image_index, dialog_index) into 21 bits, so that a
+# triple of dialog keys fits into a (signed) 64-bit integer.
+DIALOG_INDEX_BITS = 3
+DIALOG_KEY_BITS = 21
+MAX_IMAGE_INDEX = 1 << (DIALOG_KEY_BITS - DIALOG_INDEX_BITS)
+# Multiplier for Fibonacci hashing of dialog keys.
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def get_dialog_key(image_index, dialog_index):
+    """Packs the image and dialog index of a dialog into an integer.
+
+    Args:
+        image_index: Index of the CLEVR image (int or integer array)
+        dialog_index: Index of the dialog for the image (int or integer array)
+
+    Returns:
+        key: Dialog key (int or int64 array)
+    """
+    if isinstance(image_index, np.ndarray):
+        image_index = image_index.astype(np.int64)
+        dialog_index = np.asarray(dialog_index, dtype=np.int64)
+        fits = np.all(image_index < MAX_IMAGE_INDEX)
+        fits = fits and np.all(dialog_index < 1 << DIALOG_INDEX_BITS)
+    else:
+        fits = image_index < MAX_IMAGE_INDEX and dialog_index < 1 << DIALOG_INDEX_BITS
+    if not fits:
+        raise ValueError("Dialog does not fit into a key!")
+    return (image_index << DIALOG_INDEX_BITS) | dialog_index
+
+
+def get_triple_key(dialogs):
+    """Packs the (ordered) dialogs of a stitched triple into an integer.
+
+    Args:
+        dialogs: Sequence of three Dialog objects
+
+    Returns:
+        key: Triple key
+    """
+    key = 0
+    for dialog in dialogs:
+        key = (key << DIALOG_KEY_BITS) | get_dialog_key(
+            dialog.image_index, dialog.dialog_index
+        )
+    return key
+
+
+def unpack_triple_key(key):
+    """Unpacks a triple key into (image_index, dialog_index) for each dialog.
+    """
+    mask = (1 << DIALOG_KEY_BITS) - 1
+    dialog_keys = [(key >> (DIALOG_KEY_BITS * ii)) & mask for ii in (2, 1, 0)]
+    return [
+        (ii >> DIALOG_INDEX_BITS, ii & ((1 << DIALOG_INDEX_BITS) - 1))
+        for ii in dialog_keys
+    ]
+
+
+def get_partitions(dialog_keys, num_partitions):
+    """Assigns dialogs to partitions by hashing their keys.
+
+    A stitched triple is owned by the partition of its first dialog, so
+    partitions of the (ordered) triples never overlap.
+
+    Args:
+        dialog_keys: Array of dialog keys
+        num_partitions: Number of partitions
+
+    Returns:
+        partitions: Array with the partition of each dialog
+    """
+    dialog_keys = np.asarray(dialog_keys, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        hashed = dialog_keys * np.uint64(HASH_MULTIPLIER)
+    return ((hashed >> np.uint64(32)) % np.uint64(num_partitions)).astype(np.int64)
+
+
+def derive_seed(*parts):
+    """Seed derived from the parts identifying a unit of work (and a seed).
+
+    Independent of the process that does the work, unlike drawing seeds from
+    a random number generator in turn.
+    """
+    key = "_".join(str(ii) for ii in parts)
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "little")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,340 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Samplers for triples of compatible dialogs to stitch.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import functools
+import random
+
+import numpy as np
+
+from compatibility_index import CompatibilityIndex
+from dialog import Dialog
+from run_stats import NULL_STATS
+from triple_keys import get_dialog_key
+
+
+# Draws in a row without a new triple, per distinct triple drawn, before
+# deeming that no triples are left (see merge_dialogs.iter_stitch_plans).
+MAX_DUPLICATES = 50
+
+
+class RejectionSampler:
+    """Samples random triples until one of them is mergeable.
+
+    Dialogs without a context recaller are never mergeable, and are not drawn
+    (as with SignatureSampler, both are uniform over the same triples).
+    """
+
+    def __init__(self, dialogs, index=None, owned=None, stats=NULL_STATS):
+        """Initializes the sampler.
+
+        Args:
+            dialogs: List of Dialog objects after segment_dialog
+            index: CompatibilityIndex over the dialogs, built if not given, to
+                find the dialogs with a context recaller
+            owned: Boolean array of dialogs allowed as the first dialog (all
+                by default), see triple_keys.get_partitions
+            stats: RunStats to record the time spent checking compatibility
+        """
+        self.dialogs = dialogs
+        self.stats = stats
+        # Only time the checks when instrumented, they are the inner loop.
+        if stats.enabled:
+            self.check_mergeability = self.check_mergeability_timed
+        else:
+            self.check_mergeability = Dialog.check_mergeability
+        if index is None:
+            index = CompatibilityIndex.from_dialogs(dialogs)
+        self.valid = np.asarray(index.valid, dtype=bool)
+        self.valid_ids = np.flatnonzero(self.valid).tolist()
+        self.set_owned(owned)
+        self.num_sampled = 0
+        self.num_accepted = 0
+
+    def set_owned(self, owned=None):
+        """Restricts the first dialog to owned dialogs (all if None).
+        """
+        if owned is None:
+            self.owned = None
+            num_owned = len(self.valid_ids)
+        else:
+            owned = np.asarray(owned, dtype=bool) & self.valid
+            self.owned = np.flatnonzero(owned).tolist()
+            num_owned = len(self.owned)
+        if len(self.valid_ids) < 3 or not num_owned:
+            raise ValueError("No compatible triples to sample from!")
+
+    def sample(self):
+        """Samples a triple of compatible dialogs.
+
+        Returns:
+            dialog_triple: List of three Dialog objects
+        """
+        while True:
+            if self.owned is None:
+                dialog_ids = random.sample(self.valid_ids, 3)
+            else:
+                first = random.choice(self.owned)
+                others = random.sample(self.valid_ids, 2)
+                if first in others:
+                    continue
+                dialog_ids = [first] + others
+            dialog_triple = [self.dialogs[ii] for ii in dialog_ids]
+            self.num_sampled += 1
+            if self.check_mergeability(*dialog_triple):
+                self.num_accepted += 1
+                return dialog_triple
+
+    def check_mergeability_timed(self, *dialogs):
+        with self.stats.stage("compatibility"):
+            return Dialog.check_mergeability(*dialogs)
+
+    def get_acceptance_rate(self):
+        """Fraction of sampled triples that were mergeable.
+        """
+        return self.num_accepted / max(self.num_sampled, 1)
+
+
+class SignatureSampler:
+    """Samples triples from the neighbourhood of compatible dialogs.
+
+    Dialogs are grouped by the (known, focus) attribute signature of their
+    last context recaller, and compatibility only depends on the signature.
+    The first dialog is drawn with weight c * (c - 1), where c is the number
+    of dialogs compatible with it; the other two are drawn from that
+    compatible set, so only the compatibility between the last two is left
+    to chance. This gives the same distribution as RejectionSampler: uniform
+    over ordered triples of distinct, compatible dialogs.
+    """
+
+    def __init__(
+        self,
+        dialogs,
+        index=None,
+        owned=None,
+        block_size=1024,
+        cache_size=256,
+        stats=NULL_STATS,
+    ):
+        """Groups dialogs by signature and counts compatible dialogs.
+
+        Args:
+            dialogs: List of Dialog objects after segment_dialog
+            index: CompatibilityIndex over the dialogs, built if not given
+            owned: Boolean array of dialogs allowed as the first dialog (all
+                by default), see triple_keys.get_partitions
+            block_size: Number of groups processed at once when counting
+            cache_size: Number of groups whose neighbour weights are cached
+            stats: RunStats to record the time spent computing compatibility
+        """
+        self.dialogs = dialogs
+        self.stats = stats
+        self.get_neighbour_weights = functools.lru_cache(maxsize=cache_size)(
+            self.compute_neighbour_weights
+        )
+        if index is None:
+            index = CompatibilityIndex.from_dialogs(dialogs)
+        signatures = np.stack([index.known, index.focus], axis=1)[index.valid]
+        signatures, group_ids = np.unique(signatures, axis=0, return_inverse=True)
+        group_ids = group_ids.reshape(-1)
+        valid_ids = np.flatnonzero(index.valid)
+        order = np.argsort(group_ids, kind="stable")
+        boundaries = np.searchsorted(group_ids[order], np.arange(len(signatures) + 1))
+        self.groups = [
+            valid_ids[order[start:end]].tolist()
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+        ]
+        self.known = signatures[:, 0]
+        self.focus = signatures[:, 1]
+        self.group_sizes = np.diff(boundaries).astype(np.float64)
+        self.block_size = block_size
+        # Number of (other) dialogs compatible with a dialog in each group,
+        # from the index if counted there (see segment_store), or else
+        # counted once the group has owned dialogs (NaN until then).
+        if index.num_compatible is not None:
+            first_ids = valid_ids[order[boundaries[:-1]]]
+            self.num_compatible = index.num_compatible[first_ids].astype(np.float64)
+        else:
+            self.num_compatible = np.full(len(self.groups), np.nan)
+        self.set_owned(owned)
+        self.num_sampled = 0
+        self.num_accepted = 0
+
+    def set_owned(self, owned=None):
+        """Restricts the first dialog to owned dialogs (all if None).
+
+        Cheap compared to building a sampler, to reuse it across partitions.
+        """
+        # Members of each group that can be drawn as the first dialog.
+        if owned is None:
+            self.owned_groups = self.groups
+        else:
+            owned = np.asarray(owned, dtype=bool)
+            self.owned_groups = [
+                [ii for ii in group if owned[ii]] for group in self.groups
+            ]
+        owned_sizes = np.array([len(ii) for ii in self.owned_groups], dtype=np.float64)
+        self.count_compatible(np.flatnonzero(owned_sizes))
+        num_compatible = np.where(owned_sizes > 0, self.num_compatible, 0)
+        first_weights = owned_sizes * num_compatible * (num_compatible - 1)
+        self.first_weights = np.cumsum(first_weights)
+        if not len(self.groups) or self.first_weights[-1] <= 0:
+            raise ValueError("No compatible triples to sample from!")
+
+        # Triples RejectionSampler draws from: of dialogs with a recaller.
+        num_valid = self.group_sizes.sum()
+        self.num_triples = owned_sizes.sum() * (num_valid - 1) * (num_valid - 2)
+
+    def count_compatible(self, rows):
+        """Counts the dialogs compatible with groups (rows) not counted yet.
+
+        Only groups with owned dialogs are counted, e.g., groups of the few
+        new dialogs when stitching incrementally.
+        """
+        rows = rows[np.isnan(self.num_compatible[rows])]
+        with self.stats.stage("compatibility"):
+            for start in range(0, len(rows), self.block_size):
+                block = rows[start : start + self.block_size]
+                self.num_compatible[block] = self.get_compatible(
+                    block
+                ) @ self.group_sizes - self.get_compatible(block, True)
+
+    def get_compatible(self, rows, diagonal=False):
+        """Compatibility of groups (rows) with all groups, or with themselves.
+        """
+        if diagonal:
+            known, focus = self.known[rows], self.focus[rows]
+            return ((known & focus) == 0).astype(np.float64)
+        known, focus = self.known[rows, None], self.focus[rows, None]
+        return (
+            ((known & self.focus[None, :]) == 0) & ((self.known[None, :] & focus) == 0)
+        ).astype(np.float64)
+
+    def get_acceptance_rate(self):
+        """Acceptance rate that rejection sampling would have had.
+
+        Estimated from the fraction of neighbourhood draws that were accepted.
+        """
+        neighbour_rate = self.num_accepted / max(self.num_sampled, 1)
+        return neighbour_rate * self.first_weights[-1] / self.num_triples
+
+    @staticmethod
+    def sample_cumulative(cumulative_weights):
+        """Samples an index given (non-decreasing) cumulative weights.
+        """
+        threshold = random.random() * cumulative_weights[-1]
+        index = np.searchsorted(cumulative_weights, threshold, side="right")
+        return min(int(index), len(cumulative_weights) - 1)
+
+    def compute_neighbour_weights(self, group_id):
+        """Cumulative number of dialogs in each group compatible with a group.
+        """
+        with self.stats.stage("compatibility"):
+            compatible = self.get_compatible([group_id])[0]
+            return np.cumsum(compatible * self.group_sizes)
+
+    def sample(self):
+        """Samples a triple of compatible dialogs.
+
+        Returns:
+            dialog_triple: List of three Dialog objects
+        """
+        while True:
+            self.num_sampled += 1
+            first_group = self.sample_cumulative(self.first_weights)
+            first = random.choice(self.owned_groups[first_group])
+            # Draw from the compatible dialogs, other than the ones drawn.
+            neighbour_weights = self.get_neighbour_weights(first_group)
+            second, third = first, first
+            while second == first:
+                second_group = self.sample_cumulative(neighbour_weights)
+                second = random.choice(self.groups[second_group])
+            while third in (first, second):
+                third_group = self.sample_cumulative(neighbour_weights)
+                third = random.choice(self.groups[third_group])
+
+            compatible = (self.known[second_group] & self.focus[third_group]) == 0 and (
+                self.known[third_group] & self.focus[second_group]
+            ) == 0
+            if compatible:
+                self.num_accepted += 1
+                return [self.dialogs[first], self.dialogs[second], self.dialogs[third]]
+
+
+class NewDialogSampler:
+    """Samples triples with at least one new dialog, e.g., appended to the
+    source since the dialogs were last stitched (see incremental).
+
+    Wraps a sampler over all (old and new) dialogs, drawing the first dialog
+    among the new ones. A triple is kept if its first dialog is its new dialog
+    with the smallest key (with probability 1 / number of new dialogs in it),
+    and then shuffled. As compatibility does not depend on the order of the
+    dialogs, this is uniform over ordered compatible triples with a new dialog.
+    A triple is owned by the partition of its new dialog with the smallest key.
+    """
+
+    def __init__(self, triple_sampler, dialog_keys, new, owned=None):
+        """Initializes the sampler.
+
+        Args:
+            triple_sampler: Sampler over all the dialogs (see SAMPLERS)
+            dialog_keys: Array of dialog keys (see triple_keys.get_dialog_key)
+            new: Boolean array of new dialogs
+            owned: Boolean array of dialogs owning triples (all by default),
+                see triple_keys.get_partitions
+        """
+        self.triple_sampler = triple_sampler
+        self.new = np.asarray(new, dtype=bool)
+        self.new_keys = set(np.asarray(dialog_keys)[self.new].tolist())
+        self.set_owned(owned)
+        self.num_accepted = 0
+
+    def set_owned(self, owned=None):
+        """Restricts triples to those owned by owned dialogs (all if None).
+        """
+        if owned is None:
+            self.triple_sampler.set_owned(self.new)
+        else:
+            self.triple_sampler.set_owned(self.new & np.asarray(owned, dtype=bool))
+
+    @property
+    def num_sampled(self):
+        return self.triple_sampler.num_sampled
+
+    def sample(self):
+        """Samples a triple of compatible dialogs, at least one of them new.
+
+        Returns:
+            dialog_triple: List of three Dialog objects
+        """
+        while True:
+            dialog_triple = list(self.triple_sampler.sample())
+            keys = [
+                get_dialog_key(ii.image_index, ii.dialog_index) for ii in dialog_triple
+            ]
+            if keys[0] == min(ii for ii in keys if ii in self.new_keys):
+                self.num_accepted += 1
+                random.shuffle(dialog_triple)
+                return dialog_triple
+
+    def get_acceptance_rate(self):
+        """Fraction of sampled triples that were kept.
+        """
+        return self.num_accepted / max(self.num_sampled, 1)
+
+
+SAMPLERS = {"rejection": RejectionSampler, "signature": SignatureSampler}
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,302 @@
+#! /usr/bin/env python
+"""Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Validation of the source CLEVR-Dialog dialogs, before stitching them.
+
+Each dialog is checked for what segmenting and stitching it relies on:
+(a) structure: the rounds, templates and scene graph history (one item for
+    the caption and one per round, each mergeable or not) are there, and the
+    dialog has a key (see triple_keys.get_dialog_key)
+(b) attributes: objects have integer ids, and the attributes of an object do
+    not clash across the history (see DialogGraph.merge_update_scene_graph)
+(c) relations: relations are between (the first) two distinct objects
+(d) focus: focus descriptions list the attributes they require, and context
+    recallers have one, if only None (see Dialog.segment_dialog)
+(e) dependence: each round depends on nothing or an earlier round
+(f) segmentation: Dialog.segment_dialog runs, whatever else it relies on
+Images are validated in parallel shards. A report counts the invalid dialogs
+per check (with a few examples), and an exclusion list gives their keys, for
+merge_dialogs --exclusions to skip them.
+
+Author(s): Satwik Kottur
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+from dialog import Dialog
+from dialog_graph import find_attribute_clash
+from json_stream import iter_json_array
+from pipeline import iter_in_thread
+from segment_store import hash_file, imap_bounded, iter_shards
+from triple_keys import DIALOG_INDEX_BITS, MAX_IMAGE_INDEX, get_dialog_key
+
+
+# Version of the checks; bump whenever they change.
+VALIDATION_VERSION = 2
+CHECKS = (
+    "structure",
+    "attributes",
+    "relations",
+    "focus",
+    "dependence",
+    "segmentation",
+)
+# Number of examples kept per check in the report.
+NUM_EXAMPLES = 5
+
+
+def check_dialog(dialog):
+    """Checks a source dialog, stopping at the first issue.
+
+    Args:
+        dialog: Dialog of a CLEVR-Dialog image (caption, rounds and graph)
+
+    Returns:
+        issue: Tuple (check, round_id, message), round_id being None for the
+            caption, or None if the dialog is valid
+    """
+    rounds = dialog.get("dialog", None) if isinstance(dialog, dict) else None
+    if not isinstance(rounds, list):
+        return "structure", None, "No list of rounds"
+    history = dialog.get("graph", {}).get("history", None)
+    if not isinstance(history, list) or len(history) != len(rounds) + 1:
+        return "structure", None, "No history item per round (and caption)"
+    for round_id, round_datum in enumerate(rounds):
+        if not isinstance(round_datum.get("template", None), str):
+            return "structure", round_id, "No template"
+
+    objects = {}
+    for item_id, graph_item in enumerate(history):
+        round_id = item_id - 1 if item_id else None
+        if not isinstance(graph_item.get("objects", None), list):
+            return "structure", round_id, "No list of objects"
+        if not isinstance(graph_item.get("mergeable", None), bool):
+            return "structure", round_id, "Not marked mergeable or not"
+        for new_obj in graph_item["objects"]:
+            if not isinstance(new_obj.get("id", None), int):
+                return "attributes", round_id, "Object without integer id"
+            obj = objects.setdefault(new_obj["id"], {})
+            attr = find_attribute_clash(obj, new_obj)
+            if attr is not None:
+                message = "Attribute {} of object {} does not match"
+                return "attributes", round_id, message.format(attr, new_obj["id"])
+            obj.update(new_obj)
+
+        if "relation" in graph_item:
+            if not isinstance(graph_item["relation"], str):
+                return "relations", round_id, "Relation is not a string"
+            if len(graph_item["objects"]) < 2:
+                return "relations", round_id, "Relation without two objects"
+            id1, id2 = [ii["id"] for ii in graph_item["objects"][:2]]
+            if id1 == id2:
+                message = "Relation of object {} to itself"
+                return "relations", round_id, message.format(id1)
+
+        focus_desc = graph_item.get("focus_desc", None)
+        if focus_desc is not None:
+            required = focus_desc.get("required", None)
+            if not isinstance(required, list) or any(
+                ii not in focus_desc for ii in required
+            ):
+                return "focus", round_id, "Focus without its required attributes"
+        elif round_id and "focus_desc" not in graph_item:
+            template = rounds[round_id]["template"]
+            # Context recallers (see Dialog.segment_dialog).
+            if "early" in template and "sim" not in template:
+                return "focus", round_id, "Context recaller without focus"
+
+        focus_id = graph_item.get("dependence", None)
+        if focus_id is not None:
+            if round_id is None:
+                return "dependence", round_id, "Caption depends on a round"
+            if not isinstance(focus_id, int) or not 0 <= focus_id < round_id:
+                message = "Depends on round {}, not an earlier round"
+                return "dependence", round_id, message.format(focus_id)
+    return None
+
+
+def validate_images(images):
+    """Validates all dialogs of a list of images.
+
+    Args:
+        images: Raw CLEVR-Dialog data (list of images with 5 dialogs each)
+
+    Returns:
+        shard: Dictionary with the number of images and dialogs, and the
+            issues (image_index, dialog_index, check, round_id, message)
+    """
+    shard = {"num_images": len(images), "num_dialogs": 0, "issues": []}
+    for image in images:
+        image_index = image.get("image_index", None)
+        dialogs = image.get("dialogs", None)
+        if not isinstance(image_index, int) or not 0 <= image_index < MAX_IMAGE_INDEX:
+            raise ValueError("Image index invalid: {}!".format(image_index))
+        if not isinstance(dialogs, list) or len(dialogs) > 1 << DIALOG_INDEX_BITS:
+            raise ValueError("Dialogs of image {} invalid!".format(image_index))
+        shard["num_dialogs"] += len(dialogs)
+        for dialog_index, dialog in enumerate(dialogs):
+            try:
+                issue = check_dialog(dialog)
+            except (AttributeError, KeyError, TypeError) as error:
+                # Items of unexpected types, e.g., a round that is not a dict.
+                issue = ("structure", None, repr(error))
+            if issue is None:
+                # Segment as merge_dialogs does, so that whatever the checks
+                # above miss is caught here rather than while generating.
+                try:
+                    Dialog(image, dialog_index).segment_dialog(keep_graphs=False)
+                except Exception as error:
+                    issue = ("segmentation", None, repr(error))
+            if issue is not None:
+                shard["issues"].append((image_index, dialog_index) + issue)
+    return shard
+
+
+def validate_source(json_path, num_workers=1, pool=None):
+    """Validates the dialogs of a CLEVR-Dialog file, in parallel shards.
+
+    Images without a valid index or list of dialogs cannot be excluded, and
+    raise a ValueError.
+
+    Args:
+        json_path: Path to the CLEVR-Dialog JSON file
+        num_workers: Number of processes to validate with
+        pool: Pool of (num_workers) processes to validate with, started here
+            if not given
+
+    Returns:
+        report: Dictionary with the source, the number of images and dialogs,
+            and the number of invalid dialogs per check, with examples
+        excluded: Sorted list of [image_index, dialog_index] of the invalid
+            dialogs
+    """
+    start_time = time.perf_counter()
+    shards = iter_in_thread(
+        iter_shards(iter_json_array(json_path)), 2 * num_workers, "read"
+    )
+    if pool is not None:
+        validated = imap_bounded(pool, validate_images, shards, 2 * num_workers)
+        results = list(validated)
+    elif num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            validated = imap_bounded(pool, validate_images, shards, 2 * num_workers)
+            results = list(validated)
+    else:
+        results = [validate_images(shard) for shard in shards]
+
+    issues = [ii for shard in results for ii in shard["issues"]]
+    issues.sort(key=lambda ii: ii[:2])
+    report = {
+        "version": VALIDATION_VERSION,
+        "source": {
+            "file_name": os.path.basename(json_path),
+            "sha256": hash_file(json_path),
+        },
+        "num_images": sum(shard["num_images"] for shard in results),
+        "num_dialogs": sum(shard["num_dialogs"] for shard in results),
+        "num_excluded": len(issues),
+        "checks": {check: {"num_dialogs": 0, "examples": []} for check in CHECKS},
+        "time": time.perf_counter() - start_time,
+    }
+    for image_index, dialog_index, check, round_id, message in issues:
+        report["checks"][check]["num_dialogs"] += 1
+        examples = report["checks"][check]["examples"]
+        if len(examples) < NUM_EXAMPLES:
+            examples.append(
+                {
+                    "image_index": image_index,
+                    "dialog_index": dialog_index,
+                    "round_id": round_id,
+                    "message": message,
+                }
+            )
+    excluded = [[ii[0], ii[1]] for ii in issues]
+    return report, excluded
+
+
+def save_exclusions(save_path, report, excluded):
+    """Saves the dialogs to exclude from stitching, for a source file.
+    """
+    exclusions = {
+        "version": VALIDATION_VERSION,
+        "source": report["source"],
+        "excluded": excluded,
+    }
+    with open(save_path, "w") as file_id:
+        json.dump(exclusions, file_id)
+
+
+def load_exclusions(exclusion_paths):
+    """Loads exclusion lists (see save_exclusions), by source.
+
+    Args:
+        exclusion_paths: Paths to the exclusion lists
+
+    Returns:
+        exclusions: Dictionary from the sha256 of each source file to the
+            frozenset of keys of the dialogs to exclude
+    """
+    exclusions = {}
+    for exclusion_path in exclusion_paths:
+        with open(exclusion_path, "r") as file_id:
+            saved = json.load(file_id)
+        if saved["version"] != VALIDATION_VERSION:
+            raise ValueError("Exclusions outdated: {}!".format(exclusion_path))
+        keys = exclusions.get(saved["source"]["sha256"], frozenset())
+        exclusions[saved["source"]["sha256"]] = keys.union(
+            get_dialog_key(*ii) for ii in saved["excluded"]
+        )
+    return exclusions
+
+
+def main(args):
+    print("Validating: {}".format(args["input_json_path"]))
+    report, excluded = validate_source(args["input_json_path"], args["num_workers"])
+    for check in CHECKS:
+        print("{}: {} dialogs".format(check, report["checks"][check]["num_dialogs"]))
+    print(
+        "Excluded {} of {} dialogs ({} images) in {:.1f}s".format(
+            report["num_excluded"],
+            report["num_dialogs"],
+            report["num_images"],
+            report["time"],
+        )
+    )
+    print("Saving report: {}".format(args["save_json_path"]))
+    with open(args["save_json_path"], "w") as file_id:
+        json.dump(report, file_id, indent=2)
+    print("Saving exclusions: {}".format(args["exclusion_path"]))
+    save_exclusions(args["exclusion_path"], report, excluded)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--input_json_path", required=True, help="Path to CLEVR-Dialog JSON file"
+    )
+    parser.add_argument(
+        "--save_json_path", required=True, help="Path to save the report to"
+    )
+    parser.add_argument(
+        "--exclusion_path",
+        required=True,
+        help="Path to save the dialogs to exclude to (see merge_dialogs)",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=4, help="Number of workers to validate"
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)